@@ -28,6 +28,14 @@ from .lib import (
     ERROR_CODE,  # noqa: F401
     get_errors_of_chunk,  # noqa: F401
     acropalypse,  # noqa: F401
+    find_acropalypse_data,  # noqa: F401
+    reconstruct_acropalypse_data,  # noqa: F401
+    iter_scanlines,  # noqa: F401
+    decode_region,  # noqa: F401
+    iter_chunks,  # noqa: F401
+    parallel_decompress,  # noqa: F401
+    new_chunk,  # noqa: F401
+    write_at,  # noqa: F401
 )
 
 from .bmp import create_bmp  # noqa: F401
@@ -36,6 +44,88 @@ from .ppm import (
     write_ascii_ppm,  # noqa: F401
     create_ppm,  # noqa: F401
 )
+from .preview import (
+    decode_preview,  # noqa: F401
+    decode_adam7_passes,  # noqa: F401
+)
+from .cache import (
+    ChunkCache,  # noqa: F401
+    read_chunk_table,  # noqa: F401
+    scan_chunk_table,  # noqa: F401
+)
+from .metadata import inspect_file  # noqa: F401
+from .text import (
+    TextChunk,  # noqa: F401
+    TextIndex,  # noqa: F401
+    build_text_index,  # noqa: F401
+    decode_text_chunk,  # noqa: F401
+    get_text_chunks,  # noqa: F401
+)
+from .apng import (
+    Animation,  # noqa: F401
+    read_animation,  # noqa: F401
+)
+from .diff import (
+    diff_files,  # noqa: F401
+    read_chunk_headers,  # noqa: F401
+)
+from .repair import (
+    repair_chunks,  # noqa: F401
+    repair_file,  # noqa: F401
+)
+from .recover import (
+    infer_dimensions,  # noqa: F401
+    recover_acropalypse,  # noqa: F401
+    recover_ihdr,  # noqa: F401
+    recover_ihdr_of_chunks,  # noqa: F401
+)
+from .pixels import (
+    PixelBuffer,  # noqa: F401
+    decode_pixels,  # noqa: F401
+)
+from .deflate import (
+    DeflateBlock,  # noqa: F401
+    iter_deflate_blocks,  # noqa: F401
+    iter_zlib_blocks,  # noqa: F401
+)
+from .hashing import (
+    ImageHashes,  # noqa: F401
+    hamming_distance,  # noqa: F401
+    hash_file,  # noqa: F401
+    hash_stream,  # noqa: F401
+)
+from .stats import (
+    ImageStats,  # noqa: F401
+    compute_stats,  # noqa: F401
+    stats_file,  # noqa: F401
+)
+from .scan import (
+    check_acropalypse,  # noqa: F401
+    find_duplicates,  # noqa: F401
+    reconstruct_acropalypse,  # noqa: F401
+    scan_acropalypse,  # noqa: F401
+    scan_hashes,  # noqa: F401
+)
+from .patch import (
+    get_modified_chunks,  # noqa: F401
+    patch_file,  # noqa: F401
+    plan_patch,  # noqa: F401
+)
+from .report import (
+    iter_chunk_records,  # noqa: F401
+    iter_file_records,  # noqa: F401
+    iter_records,  # noqa: F401
+    write_records,  # noqa: F401
+)
+from .server import (
+    AnalysisServer,  # noqa: F401
+    serve,  # noqa: F401
+)
+from .watch import (
+    WatchIndex,  # noqa: F401
+    scan_changes,  # noqa: F401
+    watch_directory,  # noqa: F401
+)
 from .cli import (
     cli_main,  # noqa: F401
     CLI,  # noqa: F401
@@ -0,0 +1,256 @@
+"""Animated PNG (APNG) support"""
+
+from concurrent.futures import ProcessPoolExecutor
+import struct
+from typing import Dict, List, NamedTuple, Optional
+from .lib import (
+    Chunk,
+    calculate_decompressed_length,
+    decode_ihdr,
+    get_bytes_per_pixel,
+    get_data_of_chunk,
+    get_type_of_chunk,
+    iter_chunks,
+    parse_idat,
+    try_decompress,
+)
+
+# dispose_op values
+APNG_DISPOSE_OP_NONE = 0
+APNG_DISPOSE_OP_BACKGROUND = 1
+APNG_DISPOSE_OP_PREVIOUS = 2
+
+# blend_op values
+APNG_BLEND_OP_SOURCE = 0
+APNG_BLEND_OP_OVER = 1
+
+
+class FrameControl(NamedTuple):
+    """Content of a fcTL chunk"""
+
+    sequence_number: int
+    width: int
+    height: int
+    x_offset: int
+    y_offset: int
+    delay_num: int
+    delay_den: int
+    dispose_op: int
+    blend_op: int
+
+
+class Frame(NamedTuple):
+    """A frame of an animation, with its compressed data"""
+
+    control: FrameControl
+    # compressed pieces (IDAT data, or fdAT data without the sequence number)
+    data: List[bytes]
+    is_default_image: bool
+
+
+def decode_fctl(data: bytes) -> FrameControl:
+    """Decode the fcTL chunk data"""
+    return FrameControl(*struct.unpack(">IIIIIHHBB", data[:26]))
+
+
+def _check_frame_control(frame: Frame, index, width, height):
+    """Check that a frame is inside the canvas (and covers it when it is the
+    default image), raises ValueError if not"""
+    control = frame.control
+    if control.width == 0 or control.height == 0:
+        raise ValueError(f"Frame {index} is empty")
+    if (
+        control.x_offset + control.width > width
+        or control.y_offset + control.height > height
+    ):
+        raise ValueError(
+            f"Frame {index} of {control.width}x{control.height} at"
+            f" ({control.x_offset}, {control.y_offset}) is outside the canvas"
+            f" of {width}x{height}"
+        )
+    if frame.is_default_image and (control.width, control.height) != (width, height):
+        raise ValueError(f"Frame {index} is the default image but not of its size")
+
+
+def _decode_frame(args):
+    """Inflate and unfilter the data of a frame (runs in a worker process)"""
+    data, width, height, bit_depth, color_type = args
+    expected_length = calculate_decompressed_length(
+        width, height, bit_depth, color_type
+    )
+    decompressed = try_decompress(data, expected_length=expected_length)
+    if decompressed is None:
+        raise ValueError("Invalid frame data")
+    return parse_idat(decompressed, width, height, bit_depth, color_type)
+
+
+class Animation:
+    """Animated PNG, the frames are indexed when created but only decoded
+    when requested"""
+
+    def __init__(self, chunks: List[Chunk]):
+        self.num_frames = 0
+        self.num_plays = 0
+        self.frames: List[Frame] = []
+        self._decoded: Dict[int, bytearray] = {}
+        ihdr = None
+        control: Optional[FrameControl] = None
+        data: List[bytes] = []
+        is_default_image = False
+        for one_chunk in chunks:
+            chunk_type = get_type_of_chunk(one_chunk)
+            chunk_data = get_data_of_chunk(one_chunk)
+            if chunk_type == b"IHDR":
+                ihdr = decode_ihdr(chunk_data)
+            elif chunk_type == b"acTL":
+                self.num_frames, self.num_plays = struct.unpack(">II", chunk_data[:8])
+            elif chunk_type == b"fcTL":
+                if control is not None:
+                    self.frames.append(Frame(control, data, is_default_image))
+                control = decode_fctl(chunk_data)
+                data = []
+                is_default_image = False
+            elif chunk_type == b"IDAT" and control is not None:
+                # the default image is the first frame
+                data.append(chunk_data)
+                is_default_image = True
+            elif chunk_type == b"fdAT" and control is not None:
+                data.append(chunk_data[4:])
+        if control is not None:
+            self.frames.append(Frame(control, data, is_default_image))
+        if ihdr is None:
+            raise ValueError("No IHDR chunk")
+        (
+            self.width,
+            self.height,
+            self.bit_depth,
+            self.color_type,
+            _,
+            _,
+            interlace_method,
+        ) = ihdr
+        if interlace_method != 0:
+            raise NotImplementedError("Interlaced animations are not supported")
+        for index, frame in enumerate(self.frames):
+            _check_frame_control(frame, index, self.width, self.height)
+        self.bpp = get_bytes_per_pixel(self.bit_depth, self.color_type)
+
+    def _frame_args(self, index):
+        """Arguments of `_decode_frame` for a frame"""
+        frame = self.frames[index]
+        return (
+            b"".join(frame.data),
+            frame.control.width,
+            frame.control.height,
+            self.bit_depth,
+            self.color_type,
+        )
+
+    def decode_frame(self, index: int) -> bytearray:
+        """Decode a frame: the pixels of its own region, not composed"""
+        if index not in self._decoded:
+            self._decoded[index] = _decode_frame(self._frame_args(index))
+        return self._decoded[index]
+
+    def decode_frames(self, workers: Optional[int] = None) -> List[bytearray]:
+        """Decode all the frames in parallel, each frame has its own zlib stream"""
+        missing = [i for i in range(len(self.frames)) if i not in self._decoded]
+        if len(missing) > 1 and workers != 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                decoded = executor.map(
+                    _decode_frame, [self._frame_args(i) for i in missing]
+                )
+                self._decoded.update(zip(missing, decoded))
+        for index in missing:
+            self.decode_frame(index)
+        return [self._decoded[i] for i in range(len(self.frames))]
+
+    def compose_frames(self, workers: Optional[int] = None) -> List[bytearray]:
+        """Render every frame on the canvas, applying the dispose and blend ops
+
+        Returns the pixels of the full canvas for each frame
+        """
+        decoded = self.decode_frames(workers)
+        bpp = self.bpp
+        bytes_per_sample = self.bit_depth // 8
+        # without alpha, every pixel is opaque and OVER is the same as SOURCE
+        has_alpha = self.color_type in (4, 6)
+        canvas_row = self.width * bpp
+        canvas = bytearray(canvas_row * self.height)
+        rendered = []
+        for index, (frame, pixels) in enumerate(zip(self.frames, decoded)):
+            control = frame.control
+            frame_row = control.width * bpp
+            rows = [
+                slice(
+                    (control.y_offset + y) * canvas_row + control.x_offset * bpp,
+                    (control.y_offset + y) * canvas_row
+                    + control.x_offset * bpp
+                    + frame_row,
+                )
+                for y in range(control.height)
+            ]
+            dispose_op = control.dispose_op
+            if dispose_op == APNG_DISPOSE_OP_PREVIOUS and index == 0:
+                dispose_op = APNG_DISPOSE_OP_BACKGROUND
+            saved = [canvas[row] for row in rows]
+            for y, row in enumerate(rows):
+                source = pixels[y * frame_row : (y + 1) * frame_row]
+                if control.blend_op == APNG_BLEND_OP_OVER and has_alpha:
+                    canvas[row] = _blend_over(
+                        source, canvas[row], bpp // bytes_per_sample, bytes_per_sample
+                    )
+                else:
+                    canvas[row] = source
+            rendered.append(bytearray(canvas))
+            if dispose_op == APNG_DISPOSE_OP_BACKGROUND:
+                for row in rows:
+                    canvas[row] = bytes(frame_row)
+            elif dispose_op == APNG_DISPOSE_OP_PREVIOUS:
+                for row, saved_row in zip(rows, saved):
+                    canvas[row] = saved_row
+        return rendered
+
+
+def _blend_over(source, destination, channels=4, bytes_per_sample=1) -> bytearray:
+    """Blend a row of pixels over another one, alpha is the last channel
+
+    `channels`: 2 for gray and alpha, 4 for RGBA
+    `bytes_per_sample`: 2 for 16-bit samples (big-endian)
+    """
+    size = bytes_per_sample
+    bpp = channels * size
+    maximum = (1 << (8 * size)) - 1
+    alpha_start = (channels - 1) * size
+    # bytes of the alpha samples (both bytes are 255 or 0 for the extremes)
+    alpha_bytes = [source[alpha_start + i :: bpp] for i in range(size)]
+    if all(alpha.count(255) == len(alpha) for alpha in alpha_bytes):
+        return bytearray(source)
+    if all(alpha.count(0) == len(alpha) for alpha in alpha_bytes):
+        return bytearray(destination)
+    result = bytearray(destination)
+    for i in range(0, len(source), bpp):
+        source_alpha = int.from_bytes(source[i + alpha_start : i + bpp], "big")
+        if source_alpha == maximum:
+            result[i : i + bpp] = source[i : i + bpp]
+        elif source_alpha != 0:
+            destination_alpha = int.from_bytes(
+                destination[i + alpha_start : i + bpp], "big"
+            )
+            u = source_alpha * maximum
+            v = (maximum - source_alpha) * destination_alpha
+            total = u + v
+            for start in range(i, i + alpha_start, size):
+                value = (
+                    int.from_bytes(source[start : start + size], "big") * u
+                    + int.from_bytes(destination[start : start + size], "big") * v
+                ) // total
+                result[start : start + size] = value.to_bytes(size, "big")
+            result[i + alpha_start : i + bpp] = (total // maximum).to_bytes(size, "big")
+    return result
+
+
+def read_animation(filename: str) -> Animation:
+    """Read an animated PNG file, without decoding its frames"""
+    with open(filename, "rb") as fp:
+        return Animation(list(iter_chunks(fp)))
@@ -1,8 +1,39 @@
-def png_to_bmp_data(width, height, bit_depth, color_type, raw_data):
-    """Convert parsed PNG raw data to BMP pixel data."""
-    # Determine number of color and alpha planes
+"""BMP file format support."""
+
+from .lib import write_at
+
+
+def get_planes(color_type):
+    """Get the number of color and alpha planes of a PNG color type"""
     alpha_planes = 1 if color_type & 4 else 0  # Alpha channel
     color_planes = 3 if color_type & 2 else 1  # RGB or grayscale
+    return color_planes, alpha_planes
+
+
+def convert_row_to_bmp(row, bytes_per_pixel, color_planes, alpha_planes):
+    """Convert a row of PNG pixels to BMP pixels (without the padding)"""
+    width = len(row) // bytes_per_pixel
+    if color_planes == 3:  # RGB to BGR conversion
+        out_bpp = 3 + alpha_planes
+        bmp_row = bytearray(width * out_bpp)
+        bmp_row[0::out_bpp] = row[2::bytes_per_pixel]
+        bmp_row[1::out_bpp] = row[1::bytes_per_pixel]
+        bmp_row[2::out_bpp] = row[0::bytes_per_pixel]
+        if alpha_planes:
+            bmp_row[3::out_bpp] = row[3::bytes_per_pixel]  # alpha if present
+        return bmp_row
+    # Grayscale: convert to BGR by repeating the gray value
+    bmp_row = bytearray(width * 3)
+    gray = row[0::bytes_per_pixel]
+    bmp_row[0::3] = gray
+    bmp_row[1::3] = gray
+    bmp_row[2::3] = gray
+    return bmp_row
+
+
+def png_to_bmp_data(width, height, bit_depth, color_type, raw_data):
+    """Convert parsed PNG raw data to BMP pixel data."""
+    color_planes, alpha_planes = get_planes(color_type)
 
     planes = color_planes + alpha_planes
     bytes_per_pixel = (bit_depth // 8) * planes
@@ -13,19 +44,7 @@ def png_to_bmp_data(width, height, bit_depth, color_type, raw_data):
     for y in range(height - 1, -1, -1):  # BMP stores rows bottom to top
         row_start = y * row_size
         row = raw_data[row_start : row_start + row_size]
-
-        if color_planes == 3:  # RGB to BGR conversion
-            for x in range(0, len(row), bytes_per_pixel):
-                # Convert RGB to BGR
-                bmp_data.extend([row[x + 2], row[x + 1], row[x]])  # BGR format
-                if alpha_planes:
-                    bmp_data.append(row[x + 3])  # Append alpha if present
-        elif color_planes == 1:  # Grayscale
-            for x in range(0, len(row), bytes_per_pixel):
-                # Grayscale value (single channel)
-                bmp_data.extend(
-                    [row[x]] * 3
-                )  # Convert to BGR by repeating the gray value
+        bmp_data += convert_row_to_bmp(row, bytes_per_pixel, color_planes, alpha_planes)
 
         # Add padding to the row if necessary
         bmp_data.extend([0] * (padded_row_size - row_size))
@@ -33,9 +52,9 @@ def png_to_bmp_data(width, height, bit_depth, color_type, raw_data):
     return bmp_data
 
 
-def write_bmp(filename, width, height, bit_depth, planes, pixel_data):
-    """Write the BMP file with headers and pixel data."""
-    file_size = 14 + 40 + len(pixel_data)  # BMP file header + DIB header + pixel data
+def bmp_headers(width, height, bit_depth, planes, image_size):
+    """Create the BMP file header and the DIB header."""
+    file_size = 14 + 40 + image_size  # BMP file header + DIB header + pixel data
     bmp_file_header = bytearray(
         [
             0x42,
@@ -78,10 +97,10 @@ def write_bmp(filename, width, height, bit_depth, planes, pixel_data):
             0x00,
             0x00,
             0x00,  # Compression (0 = None)
-            len(pixel_data) & 0xFF,
-            (len(pixel_data) >> 8) & 0xFF,
-            (len(pixel_data) >> 16) & 0xFF,
-            (len(pixel_data) >> 24) & 0xFF,  # Image size
+            image_size & 0xFF,
+            (image_size >> 8) & 0xFF,
+            (image_size >> 16) & 0xFF,
+            (image_size >> 24) & 0xFF,  # Image size
             0xC4,
             0x0E,
             0x00,
@@ -101,18 +120,54 @@ def write_bmp(filename, width, height, bit_depth, planes, pixel_data):
         ]
     )
 
+    return bmp_file_header + dib_header
+
+
+def write_bmp(filename, width, height, bit_depth, planes, pixel_data):
+    """Write the BMP file with headers and pixel data."""
+    headers = bmp_headers(width, height, bit_depth, planes, len(pixel_data))
     # Open the file and write the BMP headers and pixel data
     with open(filename, "wb") as f:
-        f.write(bmp_file_header)
-        f.write(dib_header)
+        f.write(headers)
         f.write(pixel_data)
 
 
+def stream_bmp(filename, width, height, bit_depth, color_type, scanlines):
+    """Create a BMP file from PNG scanlines, one row at a time.
+
+    `scanlines`: iterable of the pixel values of each row, top to bottom
+    (like `iter_scanlines`)
+
+    The file is preallocated and each row is written at its place
+    (BMP stores rows bottom to top), so only one row is in memory.
+    """
+    if bit_depth != 8:
+        raise NotImplementedError("Only 8-bit images can be converted to BMP")
+    color_planes, alpha_planes = get_planes(color_type)
+    planes = color_planes + alpha_planes
+    bytes_per_pixel = (bit_depth // 8) * planes
+    row_size = width * bytes_per_pixel
+    padded_row_size = (row_size + 3) & ~3  # BMP rows must be multiple of 4 bytes
+    padding = bytes(padded_row_size - row_size)
+    headers = bmp_headers(width, height, bit_depth, planes, padded_row_size * height)
+    with open(filename, "wb") as f:
+        f.write(headers)
+        f.truncate(len(headers) + padded_row_size * height)
+        f.flush()
+        for y, row in enumerate(scanlines):
+            if y >= height:
+                break
+            bmp_row = convert_row_to_bmp(
+                row, bytes_per_pixel, color_planes, alpha_planes
+            )
+            offset = len(headers) + (height - 1 - y) * padded_row_size
+            write_at(f, bmp_row + padding, offset)
+
+
 def create_bmp(filename, width, height, bit_depth, color_type, raw_data):
     """Create a BMP file from PNG parameters."""
     # Determine the number of color and alpha planes
-    alpha_planes = 1 if color_type & 4 else 0  # Alpha channel
-    color_planes = 3 if color_type & 2 else 1  # RGB or grayscale
+    color_planes, alpha_planes = get_planes(color_type)
 
     # Total planes (color + alpha)
     planes = color_planes + alpha_planes
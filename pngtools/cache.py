@@ -0,0 +1,321 @@
+"""Persistent cache of the chunk tables of PNG files"""
+
+from os import listdir, makedirs, remove, replace, stat, utime
+from os.path import abspath, expanduser, join
+import hashlib
+import struct
+import zlib
+from typing import List, NamedTuple, Optional, Tuple
+from .lib import PNG_MAGIC, decode_ihdr
+
+DEFAULT_CACHE_DIR = join(expanduser("~"), ".cache", "pngtools")
+
+# size of the blocks read from the files
+READ_BLOCK_SIZE = 1024 * 1024
+
+# fraction of the maximum size kept by an eviction, so that the next
+# puts do not scan the directory again
+EVICTION_TARGET = 0.9
+
+_TABLE_MAGIC = b"PNGTCT\x00\x01"
+_ENTRY_EXTENSION = ".tbl"
+_IHDR_FORMAT = ">IIBBBBB"
+_CHUNK_FORMAT = ">QI4s?"
+
+
+class ChunkEntry(NamedTuple):
+    """A chunk of the table, without its data"""
+
+    offset: int  # offset of the length field in the file
+    length: int
+    chunk_type: bytes
+    crc_ok: Optional[bool]  # None when the CRC was not checked
+
+
+class ChunkTable(NamedTuple):
+    """Chunks of a file, as they are laid out on disk"""
+
+    size: int
+    signatures: List[int]  # offsets of the PNG signatures
+    ihdr: Optional[Tuple[int, int, int, int, int, int, int]]  # see decode_ihdr()
+    chunks: List[ChunkEntry]
+
+
+class _SignatureReader:
+    """Read a file sequentially and find the PNG signatures in what is read"""
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.position = 0
+        self.signatures = []
+        self.tail = b""
+
+    def read(self, read_len):
+        """Read data and look for signatures (also across two reads)"""
+        data = self.fp.read(read_len)
+        window = self.tail + data
+        start = self.position - len(self.tail)
+        idx = window.find(PNG_MAGIC)
+        while idx != -1:
+            self.signatures.append(start + idx)
+            idx = window.find(PNG_MAGIC, idx + 1)
+        self.tail = window[-(len(PNG_MAGIC) - 1) :]
+        self.position += len(data)
+        return data
+
+    def read_all(self):
+        """Read the rest of the file"""
+        while len(self.read(READ_BLOCK_SIZE)) > 0:
+            pass
+
+
+def _walk_chunks(reader, offset, size):
+    """Read the chunks from `offset` and check their CRC
+
+    Returns the IHDR fields and the list of chunk entries
+    """
+    ihdr = None
+    chunks = []
+    while offset + 8 <= size:
+        header = reader.read(8)
+        length = int.from_bytes(header[:4], byteorder="big")
+        chunk_type = header[4:]
+        end = offset + 12 + length
+        if end > size:
+            # truncated chunk or wrong length
+            chunks.append(ChunkEntry(offset, length, chunk_type, False))
+            break
+        crc = zlib.crc32(chunk_type)
+        remaining = length
+        data = b""
+        while remaining > 0:
+            block = reader.read(min(remaining, READ_BLOCK_SIZE))
+            if chunk_type == b"IHDR" and length == 13:
+                data += block
+            crc = zlib.crc32(block, crc)
+            remaining -= len(block)
+        crc_ok = reader.read(4) == (crc & 0xFFFFFFFF).to_bytes(4, "big")
+        if ihdr is None and len(data) == 13:
+            ihdr = decode_ihdr(data)
+        chunks.append(ChunkEntry(offset, length, chunk_type, crc_ok))
+        offset = end
+    return ihdr, chunks
+
+
+def scan_chunk_table(filename: str) -> ChunkTable:
+    """Read a file and build its chunk table
+
+    The chunks are read from the first PNG signature, the data is streamed
+    to check the CRC but never kept
+    """
+    size = stat(filename).st_size
+    with open(filename, "rb") as fp:
+        reader = _SignatureReader(fp)
+        if reader.read(len(PNG_MAGIC)) == PNG_MAGIC:
+            ihdr, chunks = _walk_chunks(reader, len(PNG_MAGIC), size)
+            reader.read_all()
+            return ChunkTable(size, reader.signatures, ihdr, chunks)
+        # not a PNG at the start: find the first signature, then go back to it
+        reader.read_all()
+        signatures = reader.signatures
+        if len(signatures) == 0:
+            return ChunkTable(size, signatures, None, [])
+        fp.seek(signatures[0] + len(PNG_MAGIC))
+        ihdr, chunks = _walk_chunks(fp, signatures[0] + len(PNG_MAGIC), size)
+        return ChunkTable(size, signatures, ihdr, chunks)
+
+
+def encode_chunk_table(table: ChunkTable, key=b"") -> bytes:
+    """Encode a chunk table in a compact binary format"""
+    parts = [
+        _TABLE_MAGIC,
+        struct.pack(">H", len(key)),
+        key,
+        struct.pack(">QI", table.size, len(table.signatures)),
+    ]
+    parts.extend(struct.pack(">Q", offset) for offset in table.signatures)
+    if table.ihdr is None:
+        parts.append(b"\x00")
+    else:
+        parts.append(b"\x01" + struct.pack(_IHDR_FORMAT, *table.ihdr))
+    parts.append(struct.pack(">I", len(table.chunks)))
+    parts.extend(struct.pack(_CHUNK_FORMAT, *entry) for entry in table.chunks)
+    return b"".join(parts)
+
+
+def decode_chunk_table(data: bytes) -> Tuple[bytes, ChunkTable]:
+    """Decode a chunk table encoded with `encode_chunk_table`
+
+    Returns the key and the table
+    """
+    if data[: len(_TABLE_MAGIC)] != _TABLE_MAGIC:
+        raise ValueError("Not a chunk table")
+    offset = len(_TABLE_MAGIC)
+    (key_len,) = struct.unpack_from(">H", data, offset)
+    offset += 2
+    key = data[offset : offset + key_len]
+    offset += key_len
+    size, nb_signatures = struct.unpack_from(">QI", data, offset)
+    offset += 12
+    signatures = list(struct.unpack_from(f">{nb_signatures}Q", data, offset))
+    offset += 8 * nb_signatures
+    ihdr = None
+    if data[offset] == 1:
+        ihdr = struct.unpack_from(_IHDR_FORMAT, data, offset + 1)
+        offset += struct.calcsize(_IHDR_FORMAT)
+    offset += 1
+    (nb_chunks,) = struct.unpack_from(">I", data, offset)
+    offset += 4
+    chunks = [
+        ChunkEntry(*fields)
+        for fields in struct.iter_unpack(
+            _CHUNK_FORMAT,
+            data[offset : offset + nb_chunks * struct.calcsize(_CHUNK_FORMAT)],
+        )
+    ]
+    return key, ChunkTable(size, signatures, ihdr, chunks)
+
+
+class ChunkCache:
+    """Persistent cache of chunk tables, stored in a directory
+
+    The entries are keyed by (path, size, mtime, inode) or, with `by_content`,
+    by a hash of the content of the file. The least recently used entries are
+    removed when the directory gets bigger than `max_size` bytes.
+
+    The size of the directory is kept up to date by the puts, it is only
+    read again (listdir and stat of every entry) by the evictions, so the
+    entries written by other processes are counted at the next eviction.
+    """
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_size=64 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        self._size: Optional[int] = None  # unknown until the first eviction
+        makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def get_key(filename: str, by_content=False) -> bytes:
+        """Get the key of a file"""
+        if by_content:
+            digest = hashlib.blake2b()
+            with open(filename, "rb") as fp:
+                for block in iter(lambda: fp.read(READ_BLOCK_SIZE), b""):
+                    digest.update(block)
+            return b"content:" + digest.hexdigest().encode()
+        file_stat = stat(filename)
+        return (
+            f"stat:{abspath(filename)}:{file_stat.st_size}"
+            f":{file_stat.st_mtime_ns}:{file_stat.st_ino}"
+        ).encode("utf-8", "surrogateescape")
+
+    def _path(self, key: bytes) -> str:
+        """Get the path of the entry of a key"""
+        name = hashlib.sha1(key).hexdigest()
+        return join(self.directory, name + _ENTRY_EXTENSION)
+
+    def get(self, filename: str, by_content=False) -> Optional[ChunkTable]:
+        """Get the chunk table of a file, None if it is not in the cache"""
+        key = self.get_key(filename, by_content)
+        path = self._path(key)
+        try:
+            with open(path, "rb") as fp:
+                stored_key, table = decode_chunk_table(fp.read())
+        except (OSError, ValueError, struct.error):
+            return None
+        if stored_key != key:
+            return None
+        # mark the entry as recently used
+        utime(path)
+        return table
+
+    def put(self, filename: str, table: ChunkTable, by_content=False):
+        """Store the chunk table of a file"""
+        key = self.get_key(filename, by_content)
+        path = self._path(key)
+        tmp_path = path + ".tmp"
+        data = encode_chunk_table(table, key)
+        try:
+            old_size = stat(path).st_size
+        except FileNotFoundError:
+            old_size = 0
+        with open(tmp_path, "wb") as fp:
+            fp.write(data)
+        replace(tmp_path, path)
+        if self._size is None:
+            self.evict()
+            return
+        self._size += len(data) - old_size
+        if self._size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries if the cache is too big
+
+        The entries are removed until the cache is `EVICTION_TARGET` of its
+        maximum size
+        """
+        entries = []
+        for name in listdir(self.directory):
+            if name.endswith(_ENTRY_EXTENSION):
+                entry_stat = stat(join(self.directory, name))
+                entries.append((entry_stat.st_mtime_ns, entry_stat.st_size, name))
+        entries.sort()
+        total = sum(entry_size for _, entry_size, _ in entries)
+        if total > self.max_size:
+            for _, entry_size, name in entries:
+                if total <= self.max_size * EVICTION_TARGET:
+                    break
+                try:
+                    remove(join(self.directory, name))
+                except FileNotFoundError:
+                    pass
+                total -= entry_size
+        self._size = total
+
+    def clear(self):
+        """Remove all the entries"""
+        for name in listdir(self.directory):
+            if name.endswith(_ENTRY_EXTENSION):
+                remove(join(self.directory, name))
+        self._size = 0
+
+
+def read_chunk_table(
+    filename: str, cache: Optional[ChunkCache] = None, by_content=False
+):
+    """Get the chunk table of a file, from the cache if possible
+
+    An unchanged file only needs a stat (or a hash with `by_content`)
+    and the loading of its table
+    """
+    if cache is not None:
+        table = cache.get(filename, by_content)
+        if table is not None:
+            return table
+    table = scan_chunk_table(filename)
+    if cache is not None:
+        cache.put(filename, table, by_content)
+    return table
+
+
+def print_chunk_table(table: ChunkTable):
+    """Print a chunk table"""
+    print(f"Size: {table.size} bytes, PNG signatures at {table.signatures}")
+    if table.ihdr is not None:
+        width, height, bit_depth, color_type, _, _, interlace_method = table.ihdr
+        print(
+            f"IHDR: {width}x{height}, bit depth {bit_depth},"
+            f" color type {color_type}, interlace {interlace_method}"
+        )
+    print_chunk_entries(table.chunks)
+
+
+def print_chunk_entries(entries: List[ChunkEntry]):
+    """Print the entries of a chunk table"""
+    for i, entry in enumerate(entries):
+        chunk_type = entry.chunk_type.decode("latin-1")
+        print(
+            f"Chunk {i:2d}: Offset={entry.offset}, Length={entry.length},"
+            f" Type={chunk_type}, CRC ok={entry.crc_ok}"
+        )
@@ -2,11 +2,11 @@
 
 """pngtools cli"""
 
+from bisect import bisect_right
 from os.path import join, expanduser
 import cmd2
 from .lib import (
     ERROR_CODE,
-    acropalypse,
     get_errors_of_chunk,
     parse_idat,
     write_png,
@@ -22,9 +22,43 @@ from .lib import (
     get_type_of_chunk,
     decode_ihdr,
     read_file,
+    calculate_decompressed_length,
+    iter_scanlines,
+)
+from .bmp import stream_bmp
+from .ppm import convert_rgba_to_rgb, create_ppm, stream_ppm
+from .preview import decode_preview
+from .cache import ChunkCache, print_chunk_table, read_chunk_table
+from .metadata import inspect_file, print_file_info
+from .text import get_text_chunks
+from .apng import Animation
+from .diff import diff_files, print_diff
+from .repair import print_repairs, repair_file
+from .recover import (
+    create_ihdr_from_fields,
+    recover_acropalypse,
+    recover_ihdr_of_chunks,
+)
+from .patch import get_modified_chunks, patch_file
+from .report import iter_chunk_records, iter_records, write_records
+from .server import (
+    DEFAULT_HOST,
+    DEFAULT_PORT,
+    MAX_BODY_SIZE,
+    MAX_DECODED_SIZE,
+    serve,
+)
+from .deflate import BLOCK_TYPE_NAMES, iter_zlib_blocks
+from .stats import compute_stats, print_stats
+from .watch import DEFAULT_INTERVAL, watch_directory
+from .scan import (
+    find_duplicates,
+    print_checks,
+    print_hashes,
+    reconstruct_acropalypse,
+    scan_acropalypse,
+    scan_hashes,
 )
-from .bmp import create_bmp
-from .ppm import convert_rgba_to_rgb, create_ppm
 
 PATH_HISTORY = join(expanduser("~"), ".pngtools_history.dat")
 
@@ -33,6 +67,8 @@ class CLI(cmd2.Cmd):
     """pngtools CLI"""
 
     chunks = []
+    filename = None  # file the chunks were read from
+    original_chunks = []  # chunks as read, to find the modified ones
 
     def __init__(self):
         super().__init__(
@@ -41,16 +77,96 @@ class CLI(cmd2.Cmd):
         self.prompt = "pngtools> "
         self.debug = True
 
+    def _load_chunks(self, chunks, filename=None):
+        """Replace the chunks, `filename` is the file they can be patched in
+        (None when they do not come from a file as is)"""
+        self.chunks = chunks
+        self.filename = filename
+        self.original_chunks = list(chunks or []) if filename is not None else []
+
     read_file_parser = cmd2.Cmd2ArgumentParser()
     read_file_parser.add_argument("filename", help="Path to the file")
 
     @cmd2.with_argparser(read_file_parser)
     def do_read_file(self, args):
         """Read a PNG file"""
-        self.chunks = read_file(args.filename)
+        self._load_chunks(read_file(args.filename), args.filename)
 
     complete_read_file = cmd2.Cmd.path_complete  # complete file path
 
+    repair_file_parser = cmd2.Cmd2ArgumentParser()
+    repair_file_parser.add_argument("filename", help="Path to the file")
+
+    @cmd2.with_argparser(repair_file_parser)
+    def do_repair_file(self, args):
+        """Read a damaged file, resynchronizing on the next valid chunk after
+        each corrupted one"""
+        chunks, repairs = repair_file(args.filename)
+        # the repaired chunks are not laid out like the file
+        self._load_chunks(chunks)
+        print_chunks(self.chunks)
+        print_repairs(repairs)
+
+    complete_repair_file = cmd2.Cmd.path_complete  # complete file path
+
+    chunk_table_parser = cmd2.Cmd2ArgumentParser()
+    chunk_table_parser.add_argument("filename", help="Path to the file")
+    chunk_table_parser.add_argument(
+        "--no-cache", action="store_true", help="Do not use the chunk table cache"
+    )
+
+    @cmd2.with_argparser(chunk_table_parser)
+    def do_chunk_table(self, args):
+        """Show the chunk table of a file (offsets, lengths, CRC validity)"""
+        cache = None if args.no_cache else ChunkCache()
+        print_chunk_table(read_chunk_table(args.filename, cache))
+
+    complete_chunk_table = cmd2.Cmd.path_complete  # complete file path
+
+    inspect_parser = cmd2.Cmd2ArgumentParser()
+    inspect_parser.add_argument("filename", help="Path to the file")
+
+    @cmd2.with_argparser(inspect_parser)
+    def do_inspect(self, args):
+        """Show the metadata of a file, without reading the image data"""
+        print_file_info(inspect_file(args.filename))
+
+    complete_inspect = cmd2.Cmd.path_complete  # complete file path
+
+    diff_parser = cmd2.Cmd2ArgumentParser()
+    diff_parser.add_argument("filename_a", help="Path to the first file")
+    diff_parser.add_argument("filename_b", help="Path to the second file")
+
+    @cmd2.with_argparser(diff_parser)
+    def do_diff(self, args):
+        """Compare the chunks and the pixels of two files"""
+        print_diff(diff_files(args.filename_a, args.filename_b))
+
+    report_parser = cmd2.Cmd2ArgumentParser()
+    report_parser.add_argument(
+        "paths",
+        nargs="*",
+        help="Files and directories to report, the loaded chunks if none",
+    )
+    report_parser.add_argument("--output", help="Output file (default: stdout)")
+
+    @cmd2.with_argparser(report_parser)
+    def do_report(self, args):
+        """Write NDJSON records (one JSON object per line) of files or of the
+        loaded chunks"""
+        if len(args.paths) > 0:
+            records = iter_records(args.paths)
+        else:
+            records = iter_chunk_records(self.chunks)
+        if args.output is None:
+            write_records(records, self.stdout)
+            return
+        with open(args.output, "w", encoding="utf-8") as fp:
+            count = write_records(records, fp)
+        print(f"{count} records written to {args.output}")
+
+    complete_report = cmd2.Cmd.path_complete  # complete file path
+
     def do_show_chunks(self, _args):
         """Show the chunks"""
         if self.chunks:
@@ -70,6 +186,28 @@ class CLI(cmd2.Cmd):
         else:
             print("No chunks to write")
 
+    def do_patch_png(self, _args):
+        """Write the modified chunks in the file they were read from, in place
+        when the chunks keep their size"""
+        if not self.chunks:
+            print("No chunks to write")
+            return
+        if self.filename is None:
+            print("The chunks were not read as is from a file, use write_png")
+            return
+        modified = get_modified_chunks(self.original_chunks, self.chunks)
+        print(f"Modified chunks: {modified}")
+        patch = patch_file(self.filename, self.original_chunks, self.chunks)
+        if patch is None:
+            print(f"The file was rewritten: {self.filename}")
+        else:
+            mode = "in place" if patch.in_place else "from the first change"
+            print(
+                f"Patched {self.filename} {mode}: {patch.bytes_written} bytes"
+                f" written in {len(patch.writes)} writes"
+            )
+        self.original_chunks = list(self.chunks)
+
     delete_chunk_parser = cmd2.Cmd2ArgumentParser()
     delete_chunk_parser.add_argument("index", type=int, help="Index to delete")
 
@@ -169,6 +307,41 @@ class CLI(cmd2.Cmd):
         if self.chunks:
             self.chunks[0] = create_ihdr_chunk(width, height)
 
+    recover_ihdr_parser = cmd2.Cmd2ArgumentParser()
+    recover_ihdr_parser.add_argument(
+        "--search-fields",
+        action="store_true",
+        help="Also search the bit depth, color type and interlace method",
+    )
+    recover_ihdr_parser.add_argument(
+        "--max-width", type=int, default=65535, help="Largest width searched"
+    )
+    recover_ihdr_parser.add_argument(
+        "--max-height", type=int, default=65535, help="Largest height searched"
+    )
+
+    @cmd2.with_argparser(recover_ihdr_parser)
+    def do_recover_ihdr(self, args):
+        """Find the IHDR fields matching the CRC of the IHDR chunk and the
+        length of the IDAT data, replace the chunk if there is one candidate"""
+        index, candidates = recover_ihdr_of_chunks(
+            self.chunks, args.max_width, args.max_height, args.search_fields
+        )
+        if index is None:
+            print("No IHDR chunk")
+            return
+        for ihdr in candidates:
+            width, height, bit_depth, color_type, _, _, interlace_method = ihdr
+            print(
+                f"{width}x{height}, bit depth {bit_depth},"
+                f" color type {color_type}, interlace {interlace_method}"
+            )
+        if len(candidates) == 1:
+            self.chunks[index] = create_ihdr_from_fields(candidates[0])
+            print("IHDR chunk replaced")
+        else:
+            print(f"{len(candidates)} candidates, IHDR chunk not replaced")
+
     remove_by_type_parser = cmd2.Cmd2ArgumentParser()
     remove_by_type_parser.add_argument("chunk_type", help="Type of chunk")
 
@@ -207,20 +380,89 @@ class CLI(cmd2.Cmd):
                 print("Filter method:", filter_method)
                 print("Interlace method:", interlace_method)
 
+    def do_show_text(self, _args):
+        """Show the text chunks (tEXt, zTXt and iTXt)"""
+        if self.chunks:
+            for text in get_text_chunks(self.chunks):
+                chunk_type = text.chunk_type.decode("latin-1")
+                print(f"{chunk_type} {text.keyword}: {text.value}")
+        else:
+            print("No chunks")
+
+    def do_show_frames(self, _args):
+        """Show the frames of an animated PNG"""
+        if self.chunks:
+            animation = Animation(self.chunks)
+            print(f"{animation.num_frames} frames, {animation.num_plays} plays")
+            for i, frame in enumerate(animation.frames):
+                control = frame.control
+                default = " (default image)" if frame.is_default_image else ""
+                print(
+                    f"Frame {i:2d}: {control.width}x{control.height}"
+                    f" at ({control.x_offset}, {control.y_offset}),"
+                    f" delay {control.delay_num}/{control.delay_den},"
+                    f" dispose {control.dispose_op}, blend {control.blend_op},"
+                    f" {len(frame.data)} chunks{default}"
+                )
+        else:
+            print("No chunks")
+
+    def do_show_stats(self, _args):
+        """Show the histograms, the unique colors and the alpha usage"""
+        if self.chunks:
+            ihdr = decode_ihdr(get_data_of_chunk(self.chunks[0]))
+            print_stats(compute_stats(extract_idat(self.chunks), ihdr))
+        else:
+            print("No chunks")
+
+    def do_show_deflate_blocks(self, _args):
+        """Show the deflate blocks of the IDAT data, without inflating it"""
+        if not self.chunks:
+            print("No chunks")
+            return
+        # start of the data of each IDAT chunk in the zlib data
+        idat = []
+        start = 0
+        for index, one_chunk in enumerate(self.chunks):
+            if get_type_of_chunk(one_chunk) == b"IDAT":
+                idat.append((start, index))
+                start += len(get_data_of_chunk(one_chunk))
+        data = b"".join(extract_idat(self.chunks))
+        end = 0
+        try:
+            for i, block in enumerate(iter_zlib_blocks(data)):
+                byte = block.offset // 8
+                chunk_start, chunk_index = idat[bisect_right(idat, (byte, 1 << 32)) - 1]
+                final = ", final" if block.final else ""
+                print(
+                    f"Block {i:3d}: bit {block.offset} (chunk {chunk_index}"
+                    f" byte {byte - chunk_start}), {BLOCK_TYPE_NAMES[block.block_type]}"
+                    f"{final}, header {block.header_length} bits,"
+                    f" {block.length} bits, output {block.output_start}"
+                    f"-{block.output_end}"
+                )
+                end = block.output_end
+        except (NotImplementedError, ValueError) as e:
+            print(f"Invalid deflate data: {e}")
+        print(f"Uncompressed length: {end}")
+
     def do_add_iend(self, _args):
         """Add an IEND chunk"""
         if self.chunks:
             self.chunks.append(create_iend_chunk())
 
     acropalypse_parser = cmd2.Cmd2ArgumentParser()
-    acropalypse_parser.add_argument("origin_width", type=int, help="Original width")
-    acropalypse_parser.add_argument("origin_height", type=int, help="Original height")
+    acropalypse_parser.add_argument(
+        "origin_width", type=int, nargs="?", help="Original width (inferred)"
+    )
+    acropalypse_parser.add_argument(
+        "origin_height", type=int, nargs="?", help="Original height (inferred)"
+    )
 
     @cmd2.with_argparser(acropalypse_parser)
     def do_acropalypse(self, args):
-        """Try acropalypse"""
-        origin_width = int(args.origin_width)
-        origin_height = int(args.origin_height)
+        """Try acropalypse, the original dimensions are inferred when they are
+        not given"""
         (
             _width,
             _height,
@@ -239,17 +481,19 @@ class CLI(cmd2.Cmd):
             print("No IEND chunk found")
             return
         print("More than one IEND chunk !")
-        self.chunks = [
+        damaged = [
             chunk
-            for i, chunk in enumerate(self.chunks)
+            for chunk in self.chunks
             if ERROR_CODE["WRONG_CRC"] in get_errors_of_chunk(chunk)
         ]
-        self.chunks = extract_sub_chunks(self.chunks[0])
+        self._load_chunks(extract_sub_chunks(damaged[0]))
         print("Hidden chunks:")
         print_chunks(self.chunks)
-        data = acropalypse(
-            self.chunks, origin_width, origin_height, bit_depth, color_type
+        origin_width, origin_height, data = recover_acropalypse(
+            self.chunks, bit_depth, color_type, args.origin_width, args.origin_height
         )
+        if data is None:
+            return
         if color_type == 6:
             # RGBA to RGB - we remove the 4th value of each pixel
             data = convert_rgba_to_rgb(data)
@@ -257,35 +501,207 @@ class CLI(cmd2.Cmd):
         create_ppm(output_file, origin_width, origin_height, data)
         print(f"Output file: {output_file}")
 
+    scan_acropalypse_parser = cmd2.Cmd2ArgumentParser()
+    scan_acropalypse_parser.add_argument(
+        "paths", nargs="+", help="Files and directories to scan"
+    )
+    scan_acropalypse_parser.add_argument(
+        "--workers", type=int, default=None, help="Number of processes"
+    )
+    scan_acropalypse_parser.add_argument(
+        "--reconstruct",
+        action="store_true",
+        help="Reconstruct the flagged files, the dimensions are inferred",
+    )
+    scan_acropalypse_parser.add_argument(
+        "--width", type=int, help="Original width, to reconstruct the flagged files"
+    )
+    scan_acropalypse_parser.add_argument(
+        "--height", type=int, help="Original height, to reconstruct the flagged files"
+    )
+
+    @cmd2.with_argparser(scan_acropalypse_parser)
+    def do_scan_acropalypse(self, args):
+        """Find the files with PNG data after their IEND chunk, only the end
+        of the files is read"""
+        checks = scan_acropalypse(args.paths, args.workers)
+        print_checks(checks)
+        if not args.reconstruct and (args.width is None or args.height is None):
+            return
+        for check in checks:
+            if not check.flagged:
+                continue
+            width, height, data = reconstruct_acropalypse(
+                check.filename, args.width, args.height, check
+            )
+            if data is None:
+                continue
+            if len(data) == width * height * 4:
+                # RGBA to RGB - we remove the 4th value of each pixel
+                data = convert_rgba_to_rgb(data)
+            output_file = check.filename + ".acropalypse.ppm"
+            create_ppm(output_file, width, height, data, binary=True)
+            print(f"Output file: {output_file}")
+
+    complete_scan_acropalypse = cmd2.Cmd.path_complete  # complete file path
+
+    def _decode_scanlines(self, workers=1):
+        """Decode the image of the chunks one scanline at a time
+
+        With several workers the data is inflated in parallel first
+        Returns the IHDR fields and the scanlines
+        """
+        ihdr = decode_ihdr(get_data_of_chunk(self.chunks[0]))
+        width, height, bit_depth, color_type, _, _, interlace_method = ihdr
+        if workers == 1:
+            scanlines = iter_scanlines(
+                extract_idat(self.chunks),
+                width,
+                height,
+                bit_depth,
+                color_type,
+                interlace_method,
+            )
+            return ihdr, scanlines
+        decomp = try_decompress(
+            b"".join(extract_idat(self.chunks)),
+            expected_length=calculate_decompressed_length(
+                width, height, bit_depth, color_type, interlace_method
+            ),
+            workers=workers,
+        )
+        data = parse_idat(
+            decomp, width, height, bit_depth, color_type, interlace_method
+        )
+        row_length = len(data) // height
+        scanlines = (data[y * row_length : (y + 1) * row_length] for y in range(height))
+        return ihdr, scanlines
+
+    hash_files_parser = cmd2.Cmd2ArgumentParser()
+    hash_files_parser.add_argument(
+        "paths", nargs="+", help="Files and directories to hash"
+    )
+    hash_files_parser.add_argument(
+        "--workers", type=int, default=None, help="Number of processes"
+    )
+    hash_files_parser.add_argument(
+        "--duplicates",
+        choices=["pixels", "structure", "ahash", "dhash"],
+        help="Only print the groups of files with the same hash",
+    )
+
+    @cmd2.with_argparser(hash_files_parser)
+    def do_hash_files(self, args):
+        """Compute the structural, pixel and perceptual hashes of files"""
+        hashes = scan_hashes(args.paths, args.workers)
+        if args.duplicates is None:
+            print_hashes(hashes)
+            return
+        groups = find_duplicates(hashes, args.duplicates)
+        for group in groups:
+            print(" ".join(group))
+        print(f"{len(groups)} groups of duplicates")
+
+    complete_hash_files = cmd2.Cmd.path_complete  # complete file path
+
+    serve_parser = cmd2.Cmd2ArgumentParser()
+    serve_parser.add_argument("--host", default=DEFAULT_HOST, help="Address to bind")
+    serve_parser.add_argument(
+        "--port", type=int, default=DEFAULT_PORT, help="Port to listen on"
+    )
+    serve_parser.add_argument(
+        "--workers", type=int, default=None, help="Number of processes"
+    )
+    serve_parser.add_argument(
+        "--max-body-size",
+        type=int,
+        default=MAX_BODY_SIZE,
+        help="Largest PNG file accepted, in bytes",
+    )
+    serve_parser.add_argument(
+        "--memory-limit",
+        type=int,
+        default=MAX_DECODED_SIZE,
+        help="Largest decompressed image data, in bytes",
+    )
+
+    @cmd2.with_argparser(serve_parser)
+    def do_serve(self, args):
+        """Run the HTTP analysis service: POST a PNG file to /analyze
+        (?decode=ppm or bmp), GET /metrics"""
+        serve(args.host, args.port, args.workers, args.max_body_size, args.memory_limit)
+
+    watch_parser = cmd2.Cmd2ArgumentParser()
+    watch_parser.add_argument("directory", help="Directory to watch")
+    watch_parser.add_argument(
+        "--index", help="Path of the index (default: in the cache directory)"
+    )
+    watch_parser.add_argument(
+        "--interval",
+        type=float,
+        default=DEFAULT_INTERVAL,
+        help="Seconds between two scans",
+    )
+    watch_parser.add_argument(
+        "--workers", type=int, default=None, help="Number of processes"
+    )
+    watch_parser.add_argument(
+        "--iterations",
+        type=int,
+        default=None,
+        help="Number of scans (default: no limit)",
+    )
+
+    @cmd2.with_argparser(watch_parser)
+    def do_watch(self, args):
+        """Poll a directory and analyze its new and changed PNG files"""
+        watch_directory(
+            args.directory, args.index, args.interval, args.workers, args.iterations
+        )
+
+    complete_watch = cmd2.Cmd.path_complete  # complete file path
+
     bitmap_parser = cmd2.Cmd2ArgumentParser()
     bitmap_parser.add_argument("filename", help="Output filename")
+    bitmap_parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of threads inflating the data (default: 1)",
+    )
 
     @cmd2.with_argparser(bitmap_parser)
     def do_create_bmp(self, args):
-        """Create a bmp from the chunks"""
-        out_filename = args.filename
-        data_idat = b"".join(extract_idat(self.chunks))
-        (
-            width,
-            height,
-            bit_depth,
-            color_type,
-            _,
-            _,
-            _,
-        ) = decode_ihdr(get_data_of_chunk(self.chunks[0]))
-        decomp = try_decompress(data_idat)
-        data = parse_idat(decomp, width, height, bit_depth, color_type)
-        create_bmp(out_filename, width, height, bit_depth, color_type, data)
+        """Create a bmp from the chunks, one scanline at a time"""
+        ihdr, scanlines = self._decode_scanlines(args.workers)
+        width, height, bit_depth, color_type, _, _, _ = ihdr
+        stream_bmp(args.filename, width, height, bit_depth, color_type, scanlines)
 
     ppm_parser = cmd2.Cmd2ArgumentParser()
     ppm_parser.add_argument("filename", help="Output filename")
+    ppm_parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of threads inflating the data (default: 1)",
+    )
 
     @cmd2.with_argparser(ppm_parser)
     def do_create_ppm(self, args):
-        """Create a ppm from the chunks"""
-        out_filename = args.filename
-        data_idat = b"".join(extract_idat(self.chunks))
+        """Create a ppm from the chunks, one scanline at a time"""
+        ihdr, scanlines = self._decode_scanlines(args.workers)
+        width, height, bit_depth, color_type, _, _, _ = ihdr
+        stream_ppm(args.filename, width, height, color_type, scanlines, bit_depth)
+
+    preview_parser = cmd2.Cmd2ArgumentParser()
+    preview_parser.add_argument("filename", help="Output filename")
+    preview_parser.add_argument(
+        "--scale", type=int, default=8, help="Downscale factor (default: 8)"
+    )
+
+    @cmd2.with_argparser(preview_parser)
+    def do_create_preview(self, args):
+        """Create a low resolution ppm from the chunks"""
         (
             width,
             height,
@@ -293,14 +709,25 @@ class CLI(cmd2.Cmd):
             color_type,
             _,
             _,
-            _,
+            interlace_method,
         ) = decode_ihdr(get_data_of_chunk(self.chunks[0]))
-        decomp = try_decompress(data_idat)
-        data = parse_idat(decomp, width, height, bit_depth, color_type)
-        if color_type == 6:
-            # RGBA to RGB - we remove the 4th value of each pixel
-            data = convert_rgba_to_rgb(data)
-        create_ppm(out_filename, width, height, data, binary=True)
+        preview_width, preview_height, data = decode_preview(
+            extract_idat(self.chunks),
+            width,
+            height,
+            bit_depth,
+            color_type,
+            interlace_method,
+            args.scale,
+        )
+        row_length = len(data) // preview_height
+        rows = (
+            data[y * row_length : (y + 1) * row_length] for y in range(preview_height)
+        )
+        stream_ppm(
+            args.filename, preview_width, preview_height, color_type, rows, bit_depth
+        )
+        print(f"Preview of {preview_width}x{preview_height} pixels")
 
     def do_exit(self, _args):
         """Exit the program"""
@@ -0,0 +1,375 @@
+"""Reading of the deflate block structure, without inflating the data"""
+
+from functools import lru_cache
+from typing import Dict, Iterator, List, NamedTuple, Tuple
+
+# block types (BTYPE)
+BLOCK_STORED = 0
+BLOCK_FIXED = 1
+BLOCK_DYNAMIC = 2
+
+# order of the code lengths of the code length alphabet
+CODE_LENGTH_ORDER = (16, 17, 18, 0, 8, 7, 9, 6, 10, 5, 11, 4, 12, 3, 13, 2, 14, 1, 15)
+
+MAX_LITERAL_CODES = 286
+MAX_DISTANCE_CODES = 30
+END_OF_BLOCK = 256
+
+BLOCK_TYPE_NAMES = {
+    BLOCK_STORED: "stored",
+    BLOCK_FIXED: "fixed",
+    BLOCK_DYNAMIC: "dynamic",
+}
+
+# base lengths and extra bits of the length symbols (257 to 285)
+LENGTH_BASE = (
+    3, 4, 5, 6, 7, 8, 9, 10, 11, 13, 15, 17, 19, 23, 27, 31,
+    35, 43, 51, 59, 67, 83, 99, 115, 131, 163, 195, 227, 258,
+)  # fmt: skip
+LENGTH_EXTRA = (
+    0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 1, 1, 2, 2, 2, 2,
+    3, 3, 3, 3, 4, 4, 4, 4, 5, 5, 5, 5, 0,
+)  # fmt: skip
+
+# base distances and extra bits of the distance symbols (0 to 29)
+DISTANCE_BASE = (
+    1, 2, 3, 4, 5, 7, 9, 13, 17, 25, 33, 49, 65, 97, 129, 193,
+    257, 385, 513, 769, 1025, 1537, 2049, 3073, 4097, 6145, 8193, 12289,
+    16385, 24577,
+)  # fmt: skip
+DISTANCE_EXTRA = (
+    0, 0, 0, 0, 1, 1, 2, 2, 3, 3, 4, 4, 5, 5, 6, 6,
+    7, 7, 8, 8, 9, 9, 10, 10, 11, 11, 12, 12, 13, 13,
+)  # fmt: skip
+
+# code lengths of the fixed Huffman codes
+FIXED_LITERAL_LENGTHS = (8,) * 144 + (9,) * 112 + (7,) * 24 + (8,) * 8
+FIXED_DISTANCE_LENGTHS = (5,) * 32
+
+
+class BitReader:
+    """Read the bits of deflate data, least significant bit first"""
+
+    def __init__(self, data, bit_offset=0):
+        self.data = data
+        self.position = bit_offset
+        self.size = len(data) * 8
+
+    def read_bits(self, count) -> int:
+        """Read an integer of `count` bits"""
+        position = self.position
+        end = position + count
+        if end > self.size:
+            raise ValueError("Unexpected end of the deflate data")
+        self.position = end
+        value = int.from_bytes(self.data[position >> 3 : (end + 7) >> 3], "little")
+        return (value >> (position & 7)) & ((1 << count) - 1)
+
+    def align(self):
+        """Skip the bits up to the next byte boundary"""
+        self.position = (self.position + 7) & ~7
+
+
+class BlockHeader(NamedTuple):
+    """Header of a deflate block"""
+
+    offset: int  # bit offset of the block in the data
+    final: bool
+    block_type: int
+    # code lengths of the dynamic blocks, empty for the other types
+    literal_lengths: Tuple[int, ...]
+    distance_lengths: Tuple[int, ...]
+    length: int  # length of the header in bits
+
+
+def huffman_code(lengths, allow_incomplete=True) -> Dict[Tuple[int, int], int]:
+    """Build a canonical Huffman code from code lengths
+
+    Returns a dict of (length, code) to symbol. Like zlib, raises ValueError
+    for an over-subscribed code and for an incomplete code, except when
+    `allow_incomplete` is set and the code has a single code of one bit.
+    """
+    counts = [0] * 16
+    for length in lengths:
+        counts[length] += 1
+    counts[0] = 0
+    left = 1
+    for length in range(1, 16):
+        left = (left << 1) - counts[length]
+        if left < 0:
+            raise ValueError("Over-subscribed Huffman code")
+    max_length = max(lengths, default=0)
+    if left > 0 and max_length > 0 and not (allow_incomplete and max_length == 1):
+        raise ValueError("Incomplete Huffman code")
+    next_code = [0] * 16
+    code = 0
+    for length in range(1, 16):
+        code = (code + counts[length - 1]) << 1
+        next_code[length] = code
+    codes = {}
+    for symbol, length in enumerate(lengths):
+        if length != 0:
+            codes[(length, next_code[length])] = symbol
+            next_code[length] += 1
+    return codes
+
+
+def decode_symbol(reader: BitReader, codes, max_length=15) -> int:
+    """Decode a symbol with a code of `huffman_code`"""
+    code = 0
+    for length in range(1, max_length + 1):
+        code = (code << 1) | reader.read_bits(1)
+        symbol = codes.get((length, code))
+        if symbol is not None:
+            return symbol
+    raise ValueError("Invalid Huffman code")
+
+
+def _read_code_lengths(reader: BitReader) -> Tuple[List[int], List[int]]:
+    """Read the code lengths of a dynamic block (after BFINAL and BTYPE)"""
+    hlit = reader.read_bits(5) + 257
+    hdist = reader.read_bits(5) + 1
+    hclen = reader.read_bits(4) + 4
+    if hlit > MAX_LITERAL_CODES or hdist > MAX_DISTANCE_CODES:
+        raise ValueError("Too many length or distance symbols")
+    code_length_lengths = [0] * 19
+    for i in range(hclen):
+        code_length_lengths[CODE_LENGTH_ORDER[i]] = reader.read_bits(3)
+    if max(code_length_lengths) == 0:
+        raise ValueError("Empty code length code")
+    code_length_codes = huffman_code(code_length_lengths, allow_incomplete=False)
+    lengths: List[int] = []
+    total = hlit + hdist
+    while len(lengths) < total:
+        symbol = decode_symbol(reader, code_length_codes, 7)
+        if symbol < 16:
+            lengths.append(symbol)
+            continue
+        if symbol == 16:
+            if len(lengths) == 0:
+                raise ValueError("Repeated code length without a previous length")
+            value = lengths[-1]
+            repeat = 3 + reader.read_bits(2)
+        elif symbol == 17:
+            value = 0
+            repeat = 3 + reader.read_bits(3)
+        else:
+            value = 0
+            repeat = 11 + reader.read_bits(7)
+        if len(lengths) + repeat > total:
+            raise ValueError("Too many code lengths")
+        lengths.extend([value] * repeat)
+    literal_lengths = lengths[:hlit]
+    distance_lengths = lengths[hlit:]
+    if literal_lengths[END_OF_BLOCK] == 0:
+        raise ValueError("Missing end-of-block code")
+    return literal_lengths, distance_lengths
+
+
+def read_block_header(reader: BitReader) -> BlockHeader:
+    """Read the header of a deflate block and check it like zlib does
+
+    For a dynamic block, the code lengths are decoded and both Huffman codes
+    are checked, so most of the invalid blocks are rejected without
+    inflating any data. Raises ValueError for an invalid header.
+    """
+    offset = reader.position
+    final = reader.read_bits(1) == 1
+    block_type = reader.read_bits(2)
+    literal_lengths: List[int] = []
+    distance_lengths: List[int] = []
+    if block_type == BLOCK_DYNAMIC:
+        literal_lengths, distance_lengths = _read_code_lengths(reader)
+        huffman_code(literal_lengths)
+        huffman_code(distance_lengths)
+    elif block_type == 3:
+        raise ValueError("Invalid block type")
+    return BlockHeader(
+        offset,
+        final,
+        block_type,
+        tuple(literal_lengths),
+        tuple(distance_lengths),
+        reader.position - offset,
+    )
+
+
+class DecodeTable(NamedTuple):
+    """Lookup table of a Huffman code, indexed by the next `bits` bits
+
+    Each entry is `symbol << 4 | code length`, 0 for the invalid codes
+    """
+
+    entries: List[int]
+    bits: int
+
+
+class DeflateBlock(NamedTuple):
+    """Position of a deflate block in the compressed and uncompressed data"""
+
+    offset: int  # bit offset of the block
+    final: bool
+    block_type: int
+    header_length: int  # bits, with LEN and NLEN for a stored block
+    length: int  # bits of the whole block
+    output_start: int  # range of the uncompressed data of the block
+    output_end: int
+
+
+def decode_table(lengths) -> DecodeTable:
+    """Build the lookup table of the canonical Huffman code of `lengths`
+
+    The codes are stored bit-reversed (deflate packs them from their most
+    significant bit), so one lookup of the next bits decodes a symbol.
+    """
+    bits = max(lengths, default=0)
+    entries = [0] * (1 << bits)
+    for (length, code), symbol in huffman_code(lengths).items():
+        reversed_code = int(f"{code:0{length}b}"[::-1], 2)
+        step = 1 << length
+        entries[reversed_code::step] = [symbol << 4 | length] * (
+            (len(entries) - reversed_code + step - 1) // step
+        )
+    return DecodeTable(entries, bits)
+
+
+@lru_cache(maxsize=1)
+def _get_fixed_tables() -> Tuple[DecodeTable, DecodeTable]:
+    """Lookup tables of the fixed Huffman codes, built once"""
+    return decode_table(FIXED_LITERAL_LENGTHS), decode_table(FIXED_DISTANCE_LENGTHS)
+
+
+def skip_compressed_data(
+    reader: BitReader, literals: DecodeTable, distances: DecodeTable, output=0
+) -> int:
+    """Decode the symbols of a Huffman block up to its end without producing
+    its data, returns the number of uncompressed bytes
+
+    Only the sizes of the literals and of the copies are added up; `output`
+    (the uncompressed bytes before the block) is used to reject the
+    distances too far back. The bits are read in a local buffer refilled 6
+    bytes at a time, enough for a length and a distance.
+    """
+    data = reader.data
+    end = reader.size
+    position = reader.position
+    index = position >> 3
+    buffer = 0
+    count = -(position & 7)
+    if count:
+        buffer = data[index] >> (position & 7)
+        count += 8
+        index += 1
+    literal_entries, literal_mask = literals.entries, (1 << literals.bits) - 1
+    distance_entries, distance_mask = distances.entries, (1 << distances.bits) - 1
+    size = 0
+    while True:
+        if count < 48:
+            buffer |= int.from_bytes(data[index : index + 6], "little") << count
+            index += 6
+            count += 48
+            if (index << 3) - count > end:
+                raise ValueError("Unexpected end of the deflate data")
+        entry = literal_entries[buffer & literal_mask]
+        length = entry & 15
+        if length == 0:
+            raise ValueError("Invalid literal/length code")
+        buffer >>= length
+        count -= length
+        symbol = entry >> 4
+        if symbol < END_OF_BLOCK:
+            size += 1
+            continue
+        if symbol == END_OF_BLOCK:
+            break
+        symbol -= 257
+        if symbol >= len(LENGTH_BASE):
+            raise ValueError("Invalid length symbol")
+        extra = LENGTH_EXTRA[symbol]
+        copy = LENGTH_BASE[symbol] + (buffer & ((1 << extra) - 1))
+        buffer >>= extra
+        count -= extra
+        entry = distance_entries[buffer & distance_mask]
+        length = entry & 15
+        if length == 0:
+            raise ValueError("Invalid distance code")
+        buffer >>= length
+        count -= length
+        symbol = entry >> 4
+        if symbol >= len(DISTANCE_BASE):
+            raise ValueError("Invalid distance symbol")
+        extra = DISTANCE_EXTRA[symbol]
+        distance = DISTANCE_BASE[symbol] + (buffer & ((1 << extra) - 1))
+        buffer >>= extra
+        count -= extra
+        if distance > output + size:
+            raise ValueError("Invalid distance too far back")
+        size += copy
+    position = (index << 3) - count
+    if position > end:
+        raise ValueError("Unexpected end of the deflate data")
+    reader.position = position
+    return size
+
+
+def iter_deflate_blocks(data, bit_offset=0) -> Iterator[DeflateBlock]:
+    """Walk the blocks of raw deflate data, up to the final block
+
+    The stored blocks are skipped with their length and the Huffman blocks
+    with `skip_compressed_data`, so the data is never inflated. Raises
+    ValueError at the first invalid block (the valid blocks before it are
+    yielded).
+    """
+    reader = BitReader(data, bit_offset)
+    output = 0
+    while True:
+        header = read_block_header(reader)
+        if header.block_type == BLOCK_STORED:
+            reader.align()
+            length = reader.read_bits(16)
+            if reader.read_bits(16) != length ^ 0xFFFF:
+                raise ValueError("Invalid stored block length")
+            header_length = reader.position - header.offset
+            if reader.position + 8 * length > reader.size:
+                raise ValueError("Unexpected end of the deflate data")
+            reader.position += 8 * length
+            size = length
+        else:
+            header_length = header.length
+            if header.block_type == BLOCK_FIXED:
+                literals, distances = _get_fixed_tables()
+            else:
+                literals = decode_table(header.literal_lengths)
+                distances = decode_table(header.distance_lengths)
+            size = skip_compressed_data(reader, literals, distances, output)
+        yield DeflateBlock(
+            header.offset,
+            header.final,
+            header.block_type,
+            header_length,
+            reader.position - header.offset,
+            output,
+            output + size,
+        )
+        output += size
+        if header.final:
+            return
+
+
+def read_zlib_header(data) -> int:
+    """Check the header of zlib data, returns its length in bytes"""
+    if len(data) < 2:
+        raise ValueError("Unexpected end of the zlib data")
+    if data[0] & 15 != 8 or data[0] >> 4 > 7:
+        raise ValueError("Unknown compression method")
+    if (data[0] << 8 | data[1]) % 31 != 0:
+        raise ValueError("Incorrect zlib header check")
+    if data[1] & 0x20:
+        raise NotImplementedError("Preset dictionaries are not supported")
+    return 2
+
+
+def iter_zlib_blocks(data) -> Iterator[DeflateBlock]:
+    """Walk the deflate blocks of zlib data (like the IDAT data), the bit
+    offsets are from the start of the zlib header"""
+    return iter_deflate_blocks(data, read_zlib_header(data) * 8)
@@ -0,0 +1,236 @@
+"""Structural diff between two PNG files"""
+
+from difflib import SequenceMatcher
+from os import SEEK_END, SEEK_SET
+import zlib
+from typing import List, NamedTuple, Optional
+from .lib import PNG_MAGIC, decode_ihdr, get_bytes_per_pixel, iter_scanlines
+
+# size of the blocks compared when looking for the first different byte
+COMPARE_BLOCK_SIZE = 64 * 1024
+
+
+class ChunkHeader(NamedTuple):
+    """Header and CRC of a chunk, its data is not read"""
+
+    offset: int  # offset of the length field in the file
+    length: int
+    chunk_type: bytes
+    crc: Optional[bytes]  # None for a truncated chunk
+
+
+class ChunkDiff(NamedTuple):
+    """Difference between two aligned chunks"""
+
+    status: str  # "same", "changed", "removed" (only in a) or "added" (only in b)
+    chunk_type: bytes
+    index_a: Optional[int]
+    index_b: Optional[int]
+    first_difference: Optional[int]  # offset of the first different byte of the data
+
+
+class FileDiff(NamedTuple):
+    """Differences between two PNG files"""
+
+    chunks: List[ChunkDiff]
+    same_pixels: Optional[bool]  # None when the images could not be decoded
+    first_different_row: Optional[int]
+    first_different_column: Optional[int]  # first different pixel of that row
+
+
+def read_chunk_headers(fp, stop_at=None) -> List[ChunkHeader]:
+    """Read the headers and the CRC of the chunks of a file, the data is skipped
+
+    `stop_at`: type of the last chunk to read, like b"IEND"
+    """
+    size = fp.seek(0, SEEK_END)
+    fp.seek(0, SEEK_SET)
+    if fp.read(len(PNG_MAGIC)) != PNG_MAGIC:
+        raise ValueError("File is not a PNG")
+    headers = []
+    offset = len(PNG_MAGIC)
+    while offset + 8 <= size:
+        fp.seek(offset, SEEK_SET)
+        header = fp.read(8)
+        length = int.from_bytes(header[:4], byteorder="big")
+        chunk_type = header[4:]
+        end = offset + 12 + length
+        if end > size:
+            headers.append(ChunkHeader(offset, length, chunk_type, None))
+            break
+        fp.seek(end - 4, SEEK_SET)
+        headers.append(ChunkHeader(offset, length, chunk_type, fp.read(4)))
+        offset = end
+        if chunk_type == stop_at:
+            break
+    return headers
+
+
+def _iter_data(fp, header: ChunkHeader, block_size=COMPARE_BLOCK_SIZE):
+    """Read the data of a chunk by blocks"""
+    remaining = header.length
+    fp.seek(header.offset + 8, SEEK_SET)
+    while remaining > 0:
+        block = fp.read(min(remaining, block_size))
+        if len(block) == 0:
+            return
+        remaining -= len(block)
+        yield block
+
+
+def _read_data(fp, header: ChunkHeader) -> bytes:
+    """Read the data of a chunk"""
+    return b"".join(_iter_data(fp, header))
+
+
+def _first_difference(fp_a, header_a, fp_b, header_b) -> Optional[int]:
+    """Find the offset of the first different byte of the data of two chunks"""
+    position = 0
+    for block_a, block_b in zip(_iter_data(fp_a, header_a), _iter_data(fp_b, header_b)):
+        if block_a != block_b:
+            for i, (byte_a, byte_b) in enumerate(zip(block_a, block_b)):
+                if byte_a != byte_b:
+                    return position + i
+        position += len(block_a)
+    if header_a.length != header_b.length:
+        return min(header_a.length, header_b.length)
+    return None
+
+
+def _align_chunks(fp_a, headers_a, fp_b, headers_b) -> List[ChunkDiff]:
+    """Align the chunks of two files on (type, length, CRC)"""
+    keys_a = [(h.chunk_type, h.length, h.crc) for h in headers_a]
+    keys_b = [(h.chunk_type, h.length, h.crc) for h in headers_b]
+    matcher = SequenceMatcher(None, keys_a, keys_b, autojunk=False)
+    diffs = []
+    for tag, a_start, a_end, b_start, b_end in matcher.get_opcodes():
+        if tag == "equal":
+            for i, j in zip(range(a_start, a_end), range(b_start, b_end)):
+                diffs.append(ChunkDiff("same", headers_a[i].chunk_type, i, j, None))
+            continue
+        i, j = a_start, b_start
+        while i < a_end and j < b_end:
+            if headers_a[i].chunk_type == headers_b[j].chunk_type:
+                # same type: only now the data is compared
+                first_difference = _first_difference(
+                    fp_a, headers_a[i], fp_b, headers_b[j]
+                )
+                status = "changed" if first_difference is not None else "same"
+                diffs.append(
+                    ChunkDiff(status, headers_a[i].chunk_type, i, j, first_difference)
+                )
+                i += 1
+                j += 1
+            elif a_end - i >= b_end - j:
+                diffs.append(
+                    ChunkDiff("removed", headers_a[i].chunk_type, i, None, None)
+                )
+                i += 1
+            else:
+                diffs.append(ChunkDiff("added", headers_b[j].chunk_type, None, j, None))
+                j += 1
+        for i in range(i, a_end):
+            diffs.append(ChunkDiff("removed", headers_a[i].chunk_type, i, None, None))
+        for j in range(j, b_end):
+            diffs.append(ChunkDiff("added", headers_b[j].chunk_type, None, j, None))
+    return diffs
+
+
+def _get_ihdr(fp, headers: List[ChunkHeader]):
+    """Decode the first IHDR chunk of a file"""
+    for header in headers:
+        if header.chunk_type == b"IHDR" and header.length == 13:
+            return decode_ihdr(_read_data(fp, header))
+    return None
+
+
+def _iter_idat(fp, headers: List[ChunkHeader]):
+    """Read the data of the IDAT chunks, one chunk at a time"""
+    for header in headers:
+        if header.chunk_type == b"IDAT" and header.crc is not None:
+            yield _read_data(fp, header)
+
+
+def _compare_pixels(fp_a, headers_a, fp_b, headers_b):
+    """Decode both images in lockstep and find the first different scanline
+
+    An interlaced image is fully decoded by `iter_scanlines` before its first
+    scanline, so with interlaced images both images can be in memory.
+    Returns (same_pixels, row, column)
+    """
+    ihdr_a = _get_ihdr(fp_a, headers_a)
+    ihdr_b = _get_ihdr(fp_b, headers_b)
+    if ihdr_a is None or ihdr_b is None:
+        return None, None, None
+    width, height, bit_depth, color_type, _, _, interlace_a = ihdr_a
+    if ihdr_a[:4] != ihdr_b[:4]:
+        # different sizes or pixel formats
+        return False, None, None
+    scanlines_a = iter_scanlines(
+        _iter_idat(fp_a, headers_a), width, height, bit_depth, color_type, interlace_a
+    )
+    scanlines_b = iter_scanlines(
+        _iter_idat(fp_b, headers_b), width, height, bit_depth, color_type, ihdr_b[6]
+    )
+    try:
+        bpp = get_bytes_per_pixel(bit_depth, color_type)
+        for y, (row_a, row_b) in enumerate(zip(scanlines_a, scanlines_b)):
+            if row_a != row_b:
+                for i, (byte_a, byte_b) in enumerate(zip(row_a, row_b)):
+                    if byte_a != byte_b:
+                        return False, y, i // bpp
+    except (NotImplementedError, ValueError, zlib.error) as e:
+        print(e)
+        return None, None, None
+    return True, None, None
+
+
+def diff_files(filename_a: str, filename_b: str) -> FileDiff:
+    """Compare two PNG files
+
+    The chunks are aligned on their type, length and CRC, only the headers
+    and the CRC are read for that. The data of two aligned chunks of the same
+    type is only read when they differ. The pixels are only compared when the
+    IHDR or IDAT chunks differ, both images are decoded one scanline at a time
+    (except the interlaced ones, which are fully decoded in memory).
+    """
+    with open(filename_a, "rb") as fp_a, open(filename_b, "rb") as fp_b:
+        headers_a = read_chunk_headers(fp_a)
+        headers_b = read_chunk_headers(fp_b)
+        chunks = _align_chunks(fp_a, headers_a, fp_b, headers_b)
+        image_changed = any(
+            diff.status != "same" and diff.chunk_type in (b"IHDR", b"IDAT")
+            for diff in chunks
+        )
+        if not image_changed:
+            return FileDiff(chunks, True, None, None)
+        same_pixels, row, column = _compare_pixels(fp_a, headers_a, fp_b, headers_b)
+        return FileDiff(chunks, same_pixels, row, column)
+
+
+def print_diff(diff: FileDiff):
+    """Print the differences between two files"""
+    same = 0
+    for chunk_diff in diff.chunks:
+        if chunk_diff.status == "same":
+            same += 1
+            continue
+        chunk_type = chunk_diff.chunk_type.decode("latin-1")
+        index_a = "-" if chunk_diff.index_a is None else chunk_diff.index_a
+        index_b = "-" if chunk_diff.index_b is None else chunk_diff.index_b
+        detail = ""
+        if chunk_diff.first_difference is not None:
+            detail = f" (first difference at byte {chunk_diff.first_difference})"
+        print(f"Chunk {index_a} -> {index_b}: {chunk_type} {chunk_diff.status}{detail}")
+    print(f"{same} chunks are the same")
+    if diff.same_pixels is None:
+        print("The pixels could not be compared")
+    elif diff.same_pixels:
+        print("The pixels are the same")
+    elif diff.first_different_row is None:
+        print("The images have different sizes or pixel formats")
+    else:
+        print(
+            f"The pixels differ from scanline {diff.first_different_row},"
+            f" pixel {diff.first_different_column}"
+        )
@@ -0,0 +1,203 @@
+"""Exact, perceptual and structural hashes of PNG files, in one pass"""
+
+import hashlib
+import io
+import zlib
+from typing import List, NamedTuple, Optional
+from .lib import (
+    decode_ihdr,
+    get_crc_of_chunk,
+    get_data_of_chunk,
+    get_length_of_chunk,
+    get_type_of_chunk,
+    iter_chunks,
+    iter_scanlines,
+)
+
+# size of the grids of the perceptual hashes (64 bits)
+HASH_SIZE = 8
+
+# size of the blocks of the data after IEND added to the structural hash
+READ_BLOCK_SIZE = 64 * 1024
+
+# number of color samples of each pixel, for the supported color types
+_COLOR_SAMPLES = {0: 1, 2: 3, 4: 1, 6: 3}
+_SAMPLES = {0: 1, 2: 3, 4: 2, 6: 4}
+
+
+class ImageHashes(NamedTuple):
+    """Hashes of a PNG file, as hex strings"""
+
+    structure: str  # chunk headers and CRCs, data after IEND: same file layout
+    pixels: Optional[str]  # pixel values and geometry: same image
+    ahash: Optional[str]  # average hash of the 8x8 gray image
+    dhash: Optional[str]  # difference hash of the 9x8 gray image
+
+
+def _bins(size, count):
+    """Ranges of the source pixels of each cell of a grid"""
+    return [
+        (i * size // count, max((i + 1) * size // count, i * size // count + 1))
+        for i in range(count)
+    ]
+
+
+class _GrayGrid:
+    """Gray image downscaled to `columns` x `rows` by averaging, built
+    one scanline at a time"""
+
+    def __init__(self, width, height, bit_depth, color_type, columns, rows):
+        self.columns = _bins(width, columns)
+        self.rows = _bins(height, rows)
+        bytes_per_sample = bit_depth // 8
+        self.bpp = _SAMPLES[color_type] * bytes_per_sample
+        # offsets of the most significant byte of the color samples
+        self.offsets = [i * bytes_per_sample for i in range(_COLOR_SAMPLES[color_type])]
+        self.sums = [[0] * columns for _ in range(rows)]
+
+    def add_row(self, y, row):
+        """Add the pixels of a scanline to the cells of the grid"""
+        cells = [j for j, (start, end) in enumerate(self.rows) if start <= y < end]
+        if len(cells) == 0:
+            return
+        bpp = self.bpp
+        if len(self.offsets) == 1:
+            weights = [(self.offsets[0], 1000)]
+        else:
+            # luma of ITU-R BT.601
+            weights = list(zip(self.offsets, (299, 587, 114)))
+        sums = []
+        for start, end in self.columns:
+            total = 0
+            for offset, weight in weights:
+                total += weight * sum(row[start * bpp + offset : end * bpp : bpp])
+            sums.append(total)
+        for j in cells:
+            cell_sums = self.sums[j]
+            for i, total in enumerate(sums):
+                cell_sums[i] += total
+
+    def values(self) -> List[List[float]]:
+        """Average gray level of each cell"""
+        return [
+            [
+                total / (1000 * (end - start) * (row_end - row_start))
+                for total, (start, end) in zip(cell_sums, self.columns)
+            ]
+            for cell_sums, (row_start, row_end) in zip(self.sums, self.rows)
+        ]
+
+
+def _bits_to_hex(bits) -> str:
+    """Pack bits (most significant first) in a hex string"""
+    value = 0
+    for bit in bits:
+        value = (value << 1) | bool(bit)
+    return f"{value:0{(len(bits) + 3) // 4}x}"
+
+
+def average_hash(grid: List[List[float]]) -> str:
+    """aHash: a bit for each cell brighter than the mean"""
+    cells = [value for row in grid for value in row]
+    mean = sum(cells) / len(cells)
+    return _bits_to_hex([value > mean for value in cells])
+
+
+def difference_hash(grid: List[List[float]]) -> str:
+    """dHash: a bit for each cell brighter than its left neighbour"""
+    return _bits_to_hex(
+        [row[i + 1] > row[i] for row in grid for i in range(len(row) - 1)]
+    )
+
+
+def hamming_distance(hash_a: str, hash_b: str) -> int:
+    """Number of different bits of two hashes"""
+    return bin(int(hash_a, 16) ^ int(hash_b, 16)).count("1")
+
+
+def _update_structure(structure, one_chunk):
+    """Add the header and the CRC of a chunk to the structural hash"""
+    structure.update(get_length_of_chunk(one_chunk).to_bytes(4, "big"))
+    structure.update(get_type_of_chunk(one_chunk))
+    structure.update(get_crc_of_chunk(one_chunk))
+
+
+def hash_stream(stream, hash_size=HASH_SIZE, memory_limit=None) -> ImageHashes:
+    """Compute the hashes of a PNG stream in a single pass
+
+    The chunks are read once: each chunk updates the structural hash (its
+    data is not hashed, the CRC stands for it, but the data after IEND is),
+    and the IDAT data is decoded
+    one scanline at a time to update the exact pixel hash and the downscaled
+    grids of the perceptual hashes. Only a chunk and two scanlines are in
+    memory. The pixel and perceptual hashes are None when the image cannot
+    be decoded (or its format is not supported).
+    """
+    if isinstance(stream, (bytes, bytearray, memoryview)):
+        stream = io.BytesIO(stream)
+    structure = hashlib.blake2b(digest_size=16)
+    chunks = iter_chunks(stream, stop_at=b"IEND", memory_limit=memory_limit)
+    ihdr = None
+    first_idat = None
+    for one_chunk in chunks:
+        _update_structure(structure, one_chunk)
+        chunk_type = get_type_of_chunk(one_chunk)
+        if chunk_type == b"IHDR" and ihdr is None:
+            if len(get_data_of_chunk(one_chunk)) == 13:
+                ihdr = decode_ihdr(get_data_of_chunk(one_chunk))
+        elif chunk_type == b"IDAT":
+            first_idat = get_data_of_chunk(one_chunk)
+            break
+
+    def iter_idat():
+        """Data of the IDAT chunks, read as the scanlines are decoded"""
+        yield first_idat
+        for one_chunk in chunks:
+            _update_structure(structure, one_chunk)
+            if get_type_of_chunk(one_chunk) != b"IDAT":
+                return
+            yield get_data_of_chunk(one_chunk)
+
+    pixels = ahash = dhash = None
+    if ihdr is not None and first_idat is not None:
+        width, height, bit_depth, color_type, _, _, interlace_method = ihdr
+        if bit_depth in (8, 16) and color_type in _SAMPLES:
+            pixel_hash = hashlib.blake2b(digest_size=16)
+            pixel_hash.update(f"{width}x{height}:{bit_depth}:{color_type}".encode())
+            average = _GrayGrid(
+                width, height, bit_depth, color_type, hash_size, hash_size
+            )
+            difference = _GrayGrid(
+                width, height, bit_depth, color_type, hash_size + 1, hash_size
+            )
+            try:
+                for y, row in enumerate(
+                    iter_scanlines(
+                        iter_idat(),
+                        width,
+                        height,
+                        bit_depth,
+                        color_type,
+                        interlace_method,
+                    )
+                ):
+                    pixel_hash.update(row)
+                    average.add_row(y, row)
+                    difference.add_row(y, row)
+                pixels = pixel_hash.hexdigest()
+                ahash = average_hash(average.values())
+                dhash = difference_hash(difference.values())
+            except (ValueError, zlib.error):
+                pass
+    # the chunks after the image data
+    for one_chunk in chunks:
+        _update_structure(structure, one_chunk)
+    for block in iter(lambda: stream.read(READ_BLOCK_SIZE), b""):
+        structure.update(block)
+    return ImageHashes(structure.hexdigest(), pixels, ahash, dhash)
+
+
+def hash_file(filename: str, hash_size=HASH_SIZE) -> ImageHashes:
+    """Compute the hashes of a PNG file, see `hash_stream`"""
+    with open(filename, "rb") as fp:
+        return hash_stream(fp, hash_size)
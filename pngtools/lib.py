@@ -1,9 +1,21 @@
 """pngtools library"""
 
-from os import fstat
+from concurrent.futures import ThreadPoolExecutor
+from os import SEEK_END, SEEK_SET, fstat
 from os.path import exists
+from stat import S_ISREG
+import io
+from functools import lru_cache
+from itertools import repeat
 import zlib
 from typing import List, Tuple
+from .deflate import BLOCK_DYNAMIC, BitReader, read_block_header
+
+try:
+    from os import pwrite
+except ImportError:
+    # Windows
+    pwrite = None
 
 ERROR_CODE = {
     "WRONG_LENGTH": "Wrong length",
@@ -32,10 +44,43 @@ CHUNKS_TYPES = {
     b"iTXt": "International textual data",
     b"tEXt": "Textual data",
     b"zTXt": "Compressed textual data",
+    b"acTL": "Animation control",
+    b"fcTL": "Frame control",
+    b"fdAT": "Frame data",
 }
 
 PNG_MAGIC = b"\x89PNG\r\n\x1a\n"
 
+# maximum number of bytes that can be read for a chunk or inflated from IDAT data
+# change it to allow bigger images (or to be more strict)
+MEMORY_LIMIT = 512 * 1024 * 1024
+
+# number of samples of each pixel, for each color type
+SAMPLES_PER_PIXEL = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+# size of the compressed slices given to the inflater
+INFLATE_CHUNK_SIZE = 64 * 1024
+
+# minimum size of the compressed segments inflated in parallel
+PARALLEL_SEGMENT_SIZE = 1024 * 1024
+
+# end of the empty stored block written by a full or sync flush
+FLUSH_MARKER = b"\x00\x00\xff\xff"
+
+# size of the deflate window
+DEFLATE_WINDOW_SIZE = 32 * 1024
+
+
+# Adam7 pattern: (x_start, y_start, x_step, y_step)
+ADAM7_PASSES = [
+    (0, 0, 8, 8),  # pass 1
+    (4, 0, 8, 8),  # pass 2
+    (0, 4, 4, 8),  # pass 3
+    (2, 0, 4, 4),  # pass 4
+    (0, 2, 2, 4),  # pass 5
+    (1, 0, 2, 2),  # pass 6
+    (0, 1, 1, 2),  # pass 7
+]
 
 # chunk is a list of 5 elements (for now) -> can change in the future
 # [length, chunk_type, data, crc, errors]
@@ -60,15 +105,40 @@ class ReaderHelper:
             return data
 
     def size(self):
-        """Get the size of the file or buffer"""
+        """Get the size of the file or buffer
+
+        Returns None if the size is unknown (pipes, sockets...)
+        """
         if self.is_file:
-            return fstat(self.fp.fileno()).st_size
+            try:
+                file_stat = fstat(self.fp.fileno())
+                if S_ISREG(file_stat.st_mode):
+                    return file_stat.st_size
+            except (AttributeError, OSError):
+                pass
+            try:
+                position = self.fp.tell()
+                size = self.fp.seek(0, SEEK_END)
+                self.fp.seek(position, SEEK_SET)
+                return size
+            except (AttributeError, OSError):
+                return None
         else:
             return len(self.fp)
 
 
-def read_chunk(file: ReaderHelper, total_size):
-    """Read a chunk from a file"""
+def get_memory_limit(memory_limit=None):
+    """Get the memory limit to use, `MEMORY_LIMIT` if not specified"""
+    if memory_limit is None:
+        return MEMORY_LIMIT
+    return memory_limit
+
+
+def read_chunk(file: ReaderHelper, total_size, memory_limit=None):
+    """Read a chunk from a file
+
+    `memory_limit`: maximum length of data to read, defaults to `MEMORY_LIMIT`
+    """
     read = file.read(4)
     errors = []
     if read == "":
@@ -79,6 +149,11 @@ def read_chunk(file: ReaderHelper, total_size):
     if data_length > total_size:
         to_read = total_size - 3 * 4
         errors.append(ERROR_CODE["WRONG_LENGTH"])
+    limit = get_memory_limit(memory_limit)
+    if to_read > limit:
+        raise ValueError(
+            f"Chunk length {to_read} is over the memory limit of {limit} bytes"
+        )
     chunk_type = file.read(4)
     if chunk_type not in CHUNKS_TYPES:
         errors.append(ERROR_CODE["WRONG_TYPE"])
@@ -89,6 +164,66 @@ def read_chunk(file: ReaderHelper, total_size):
     return data_length, chunk_type, data, crc, errors
 
 
+def _read_exact(stream, read_len):
+    """Read `read_len` bytes from a stream, less only at the end of the stream"""
+    parts = []
+    remaining = read_len
+    while remaining > 0:
+        data = stream.read(remaining)
+        if not data:
+            break
+        parts.append(data)
+        remaining -= len(data)
+    return b"".join(parts)
+
+
+def iter_chunks(stream, stop_at=None, memory_limit=None):
+    """Iterate over the chunks of a PNG stream
+
+    `stream`: any readable byte stream (file, pipe, `sys.stdin.buffer`,
+    socket file, HTTP response...) or bytes, the size is not needed
+    `stop_at`: type of the last chunk to read, like b"IHDR" or b"IEND"
+    `memory_limit`: maximum length of a chunk, defaults to `MEMORY_LIMIT`
+
+    Yields the chunks as they are read. Stops at the end of the stream, or
+    after a truncated chunk (with the `EOF` error). Stopping the iteration
+    stops the reading.
+    """
+    if isinstance(stream, (bytes, bytearray, memoryview)):
+        stream = io.BytesIO(stream)
+    if _read_exact(stream, len(PNG_MAGIC)) != PNG_MAGIC:
+        raise ValueError("File is not a PNG")
+    limit = get_memory_limit(memory_limit)
+    while True:
+        header = _read_exact(stream, 8)
+        if len(header) == 0:
+            return
+        errors = []
+        length = int.from_bytes(header[:4], byteorder="big")
+        chunk_type = header[4:]
+        if chunk_type not in CHUNKS_TYPES:
+            errors.append(ERROR_CODE["WRONG_TYPE"])
+        if len(header) < 8:
+            errors.append(ERROR_CODE["EOF"])
+            yield new_chunk(length, chunk_type, b"", b"", errors)
+            return
+        if length > limit:
+            raise ValueError(
+                f"Chunk length {length} is over the memory limit of {limit} bytes"
+            )
+        data = _read_exact(stream, length)
+        crc = _read_exact(stream, 4)
+        if len(data) < length or len(crc) < 4:
+            errors.append(ERROR_CODE["EOF"])
+            yield new_chunk(length, chunk_type, data, crc, errors)
+            return
+        if crc != calculate_crc(chunk_type, data):
+            errors.append(ERROR_CODE["WRONG_CRC"])
+        yield new_chunk(length, chunk_type, data, crc, errors)
+        if chunk_type == stop_at:
+            return
+
+
 def try_dec(type_chunk):
     """Try to decode the type of chunk"""
     if type_chunk in CHUNKS_TYPES:
@@ -113,11 +248,24 @@ def get_by_type(chunks: List[Chunk], current_type="IDAT") -> List[Chunk]:
     ]
 
 
-def _new_chunk(length, chunk_type, data, crc, errors) -> Chunk:
+def new_chunk(length, chunk_type, data, crc, errors) -> Chunk:
     """Create a new chunk"""
     return (length, chunk_type, data, crc, errors)
 
 
+def write_at(f, data, offset):
+    """Write data at an offset of a file, with pwrite if available"""
+    if pwrite is None:
+        f.seek(offset, SEEK_SET)
+        f.write(data)
+        return
+    view = memoryview(data)
+    while len(view) > 0:
+        written = pwrite(f.fileno(), view, offset)
+        view = view[written:]
+        offset += written
+
+
 def get_length_of_chunk(one_chunk: Chunk):
     """Get the length of a chunk"""
     return one_chunk[0]
@@ -165,18 +313,48 @@ def decode_phy(chunk: Chunk):
     return x_pixels_per_unit, y_pixels_per_unit, unit_specifier
 
 
-def extract_data(chunks: List[Chunk]):
+def get_expected_length(chunks: List[Chunk]):
+    """Get the decompressed length of the IDAT data announced by the IHDR chunk
+
+    Returns None if there is no usable IHDR chunk
+    """
+    ihdr_chunks = get_by_type(chunks, b"IHDR")
+    if len(ihdr_chunks) == 0 or len(get_data_of_chunk(ihdr_chunks[0])) < 13:
+        return None
+    (
+        width,
+        height,
+        bit_depth,
+        color_type,
+        _,
+        _,
+        interlace_method,
+    ) = decode_ihdr(get_data_of_chunk(ihdr_chunks[0]))
+    try:
+        return calculate_decompressed_length(
+            width, height, bit_depth, color_type, interlace_method
+        )
+    except ValueError:
+        return None
+
+
+def extract_data(chunks: List[Chunk], memory_limit=None):
     """extract data from IDAT chunks and try to decompress it
 
     `chunks`: is a list of chunks
+    `memory_limit`: maximum number of bytes to inflate, defaults to `MEMORY_LIMIT`
     """
 
     assert isinstance(chunks, list)
     data_idat = b"".join(extract_idat(chunks))
-    return try_decompress(data_idat)
+    return try_decompress(
+        data_idat,
+        expected_length=get_expected_length(chunks),
+        memory_limit=memory_limit,
+    )
 
 
-def read_broken_file(filename: str, force_idx=0):
+def read_broken_file(filename: str, force_idx=0, memory_limit=None):
     """Read a broken PNG file"""
     if exists(filename):
         with open(filename, "rb") as fp:
@@ -188,12 +366,12 @@ def read_broken_file(filename: str, force_idx=0):
         print(f"PNG signatures detected at {idxs}")
         chosen_idx = force_idx if force_idx != 0 else idxs[0]
         file = ReaderHelper(file[chosen_idx:])
-        return split_png_chunks(file), idxs
+        return split_png_chunks(file, memory_limit), idxs
     print("File does not exist")
     return None, []
 
 
-def read_file(filename: str, force_read=False):
+def read_file(filename: str, force_read=False, memory_limit=None):
     """Read a PNG file"""
     if exists(filename):
         with open(filename, "rb") as fp:
@@ -202,15 +380,26 @@ def read_file(filename: str, force_read=False):
             else:
                 file = fp
             file = ReaderHelper(file)
-            data = split_png_chunks(file)
+            data = split_png_chunks(file, memory_limit)
         return data
     print("File does not exist")
     return None
 
 
-def split_png_chunks(fp: ReaderHelper):
-    """Split PNG chunks from a file or buffer"""
+def split_png_chunks(fp: ReaderHelper, memory_limit=None):
+    """Split PNG chunks from a file or buffer
+
+    `memory_limit`: maximum length of a chunk, defaults to `MEMORY_LIMIT`
+    """
     size = fp.size()
+    if size is None:
+        # not seekable: read the chunks as they come
+        print("Reading (unknown size)")
+        chunks = []
+        for idx, one_chunk in enumerate(iter_chunks(fp.fp, memory_limit=memory_limit)):
+            print_chunks([one_chunk], idx)
+            chunks.append(one_chunk)
+        return chunks
     print(f"Reading ({size} bytes)")
     remaining_size = size
     magic_len = len(PNG_MAGIC)
@@ -223,27 +412,27 @@ def split_png_chunks(fp: ReaderHelper):
     while True:
         if remaining_size <= 0:
             break
-        length, chunk_type, data, crc, errors = read_chunk(fp, remaining_size)
+        length, chunk_type, data, crc, errors = read_chunk(
+            fp, remaining_size, memory_limit
+        )
         if ERROR_CODE["EOF"] in errors:
             break
         remaining_size -= length + 4 + len(chunk_type) + len(crc)
         if ERROR_CODE["WRONG_LENGTH"] in errors:
             if len(data) > 0 and data[-4:] == b"IEND":
-                chunk1 = _new_chunk(
-                    length, chunk_type, data[:-12], data[-12:-8], errors
-                )
+                chunk1 = new_chunk(length, chunk_type, data[:-12], data[-12:-8], errors)
                 print_chunks([chunk1], idx)
                 chunks.append(chunk1)
                 len_iend = int.from_bytes(data[-8:-4], byteorder="big")
                 iend_errors = []
                 if len_iend > 0:
                     iend_errors.append(ERROR_CODE["WRONG_LENGTH"])
-                chunk2 = _new_chunk(len_iend, data[-4:], b"", crc, iend_errors)
+                chunk2 = new_chunk(len_iend, data[-4:], b"", crc, iend_errors)
                 idx += 1
                 print_chunks([chunk2], idx)
                 chunks.append(chunk2)
         else:
-            chunk_to_add = _new_chunk(length, chunk_type, data, crc, errors)
+            chunk_to_add = new_chunk(length, chunk_type, data, crc, errors)
             print_chunks([chunk_to_add], idx)
             chunks.append(chunk_to_add)
         idx += 1
@@ -303,7 +492,7 @@ def create_ihdr_chunk(width, height):
         + b"\x00"  # Interlace method
     )
     crc = calculate_crc(chunk_type, data)
-    return _new_chunk(len(data), chunk_type, data, crc, [])
+    return new_chunk(len(data), chunk_type, data, crc, [])
 
 
 def create_iend_chunk():
@@ -311,7 +500,7 @@ def create_iend_chunk():
     chunk_type = b"IEND"
     data = b""
     crc = calculate_crc(chunk_type, data)
-    return _new_chunk(len(data), chunk_type, data, crc, [])
+    return new_chunk(len(data), chunk_type, data, crc, [])
 
 
 def remove_chunk_by_type(chunks: List[Chunk], filter_type) -> List[Chunk]:
@@ -330,7 +519,7 @@ def fix_chunk(chunk: Chunk) -> Chunk:
         chunk_type = b"IDAT"
     crc = calculate_crc(chunk_type, data)
     errors = []
-    return _new_chunk(length, chunk_type, data, crc, errors)
+    return new_chunk(length, chunk_type, data, crc, errors)
 
 
 def get_indices(x: list, value: int) -> list:
@@ -388,7 +577,7 @@ def extract_sub_chunks(one_chunk: Chunk) -> List[Chunk]:
             errors.append(ERROR_CODE["WRONG_CRC"])
         if ERROR_CODE["WRONG_LENGTH"] in errors:
             real_length = len(data)
-        chunk = _new_chunk(
+        chunk = new_chunk(
             real_length,
             type_idat,
             data,
@@ -399,15 +588,187 @@ def extract_sub_chunks(one_chunk: Chunk) -> List[Chunk]:
     return chunks
 
 
-def try_decompress(data):
-    """Try to decompress data"""
+def try_decompress(data, expected_length=None, memory_limit=None, workers=1):
+    """Try to decompress data
+
+    `expected_length`: length of the decompressed data if known
+    (see `calculate_decompressed_length`), the output is preallocated
+    and the inflating stops once it is full
+    `memory_limit`: maximum number of bytes to inflate, defaults to `MEMORY_LIMIT`
+    `workers`: number of threads inflating the data (None for the default
+    of `ThreadPoolExecutor`), see `parallel_decompress`
+    """
+    limit = get_memory_limit(memory_limit)
+    if expected_length is not None and expected_length > limit:
+        raise ValueError(
+            f"Decompressed data needs {expected_length} bytes,"
+            f" over the memory limit of {limit} bytes"
+        )
     try:
-        return zlib.decompress(data)
+        if workers != 1:
+            decompressed = parallel_decompress(data, workers, memory_limit=limit)
+            if expected_length is not None:
+                decompressed = decompressed[:expected_length]
+            return decompressed
+        if expected_length is None:
+            return _decompress_limited(data, limit)
+        return _decompress_into(data, expected_length)
     except zlib.error as e:
         print(e)
     return None
 
 
+def _decompress_limited(data, limit):
+    """Decompress data, raise an error if the output is bigger than `limit`"""
+    decompressor = zlib.decompressobj()
+    decompressed = decompressor.decompress(data, limit + 1)
+    if len(decompressed) > limit:
+        raise ValueError(f"Decompressed data is over the memory limit of {limit} bytes")
+    if not decompressor.eof:
+        raise zlib.error(
+            "Error -5 while decompressing data: incomplete or truncated stream"
+        )
+    return decompressed
+
+
+def _decompress_into(data, expected_length):
+    """Decompress data into a preallocated buffer of `expected_length` bytes
+
+    Stops as soon as the buffer is full, the data after is ignored.
+    """
+    output = bytearray(expected_length)
+    view = memoryview(output)
+    decompressor = zlib.decompressobj()
+    position = 0
+    data = memoryview(data)
+    for start in range(0, len(data), INFLATE_CHUNK_SIZE):
+        pending = data[start : start + INFLATE_CHUNK_SIZE]
+        while len(pending) > 0 and position < expected_length:
+            out = decompressor.decompress(pending, expected_length - position)
+            view[position : position + len(out)] = out
+            position += len(out)
+            pending = decompressor.unconsumed_tail
+        if position == expected_length or decompressor.eof:
+            break
+    view.release()
+    if position < expected_length:
+        if not decompressor.eof:
+            raise zlib.error(
+                "Error -5 while decompressing data: incomplete or truncated stream"
+            )
+        del output[position:]
+    return output
+
+
+def find_flush_points(data, min_distance=PARALLEL_SEGMENT_SIZE):
+    """Find the candidate restart points of a zlib stream
+
+    A flush ends with an empty stored block, so with the byte aligned
+    `FLUSH_MARKER`. Returns the offsets just after these markers, at least
+    `min_distance` bytes apart. These are only candidates: the marker can
+    appear by chance in the compressed data, and the data after a sync
+    flush (unlike a full flush) can still refer to the data before.
+    """
+    points = []
+    # skip the zlib header and stop before the adler32 checksum
+    end = len(data) - 4
+    idx = data.find(FLUSH_MARKER, 2 + min_distance, end)
+    while idx != -1:
+        point = idx + len(FLUSH_MARKER)
+        if point >= end:
+            break
+        points.append(point)
+        idx = data.find(FLUSH_MARKER, point + min_distance, end)
+    return points
+
+
+def _inflate_segment(segment, limit, zdict=None):
+    """Inflate a segment of a raw deflate stream
+
+    Returns the data, if the end of the stream was reached, and the data after it
+    """
+    if not zdict:
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    else:
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS, zdict=zdict)
+    decompressed = decompressor.decompress(segment, limit + 1)
+    if len(decompressed) > limit:
+        raise ValueError(f"Decompressed data is over the memory limit of {limit} bytes")
+    return decompressed, decompressor.eof, decompressor.unused_data
+
+
+def _try_inflate_segment(segment, limit):
+    """Inflate a segment without the data before it, None if it refers to it"""
+    try:
+        return _inflate_segment(segment, limit)
+    except zlib.error:
+        return None
+
+
+def parallel_decompress(
+    data, workers=None, min_segment_size=PARALLEL_SEGMENT_SIZE, memory_limit=None
+):
+    """Decompress zlib data in parallel, splitting it at the flush points
+
+    `workers`: number of threads (zlib releases the GIL while inflating)
+    `min_segment_size`: minimum size of the compressed segments
+
+    The segments between the candidate restart points (see `find_flush_points`)
+    are inflated concurrently without any history. A segment which refers to
+    the data before it is inflated again, in order, with the end of the
+    previous segment as dictionary. The result is checked with the adler32 of
+    the stream, and the data is inflated sequentially if no split was possible
+    or if the check fails.
+    """
+    limit = get_memory_limit(memory_limit)
+    if not isinstance(data, bytes):
+        data = bytes(data)
+    header_ok = (
+        len(data) > 6
+        and data[0] & 0x0F == 8
+        and not data[1] & 0x20
+        and (data[0] << 8 | data[1]) % 31 == 0
+    )
+    points = find_flush_points(data, min_segment_size) if header_ok else []
+    if len(points) == 0:
+        return _decompress_limited(data, limit)
+    view = memoryview(data)
+    bounds = [2] + points + [len(data)]
+    segments = [view[start:end] for start, end in zip(bounds, bounds[1:])]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(_try_inflate_segment, segments, repeat(limit)))
+
+    outputs = []
+    total = 0
+    checksum = zlib.adler32(b"")
+    window = b""
+    unused_data = b""
+    for idx, (segment, result) in enumerate(zip(segments, results)):
+        if result is None:
+            try:
+                result = _inflate_segment(segment, limit - total, window)
+            except zlib.error:
+                return _decompress_limited(data, limit)
+        decompressed, eof, unused_data = result
+        if eof != (idx == len(segments) - 1):
+            # the candidate was not a real restart point
+            return _decompress_limited(data, limit)
+        total += len(decompressed)
+        if total > limit:
+            raise ValueError(
+                f"Decompressed data is over the memory limit of {limit} bytes"
+            )
+        checksum = zlib.adler32(decompressed, checksum)
+        if len(decompressed) >= DEFLATE_WINDOW_SIZE:
+            window = decompressed[-DEFLATE_WINDOW_SIZE:]
+        else:
+            window = (window + decompressed)[-DEFLATE_WINDOW_SIZE:]
+        outputs.append(decompressed)
+    if unused_data[:4] != checksum.to_bytes(4, byteorder="big"):
+        return _decompress_limited(data, limit)
+    return b"".join(outputs)
+
+
 def decode_ihdr(data):
     """Decode IHDR chunk data"""
     width = int.from_bytes(data[0:4], byteorder="big")
@@ -428,20 +789,31 @@ def decode_ihdr(data):
     )
 
 
-def calculate_decompressed_length(width, height, bit_depth, color_type):
-    """Calculate the total length of the decompressed image"""
-    if color_type == 2:  # RGB
-        samples_per_pixel = 3
-    elif color_type == 6:  # RGBA
-        samples_per_pixel = 4
-    else:
-        raise ValueError("Unsupported color type")
+def calculate_decompressed_length(
+    width, height, bit_depth, color_type, interlace_method=0
+):
+    """Calculate the total length of the decompressed image
 
-    # Calculate bytes per pixel
-    bytes_per_pixel = (bit_depth * samples_per_pixel) // 8
+    Each scanline is a filter byte and the bits of its pixels rounded up to
+    a byte, so any bit depth is supported
+    """
+    if color_type not in SAMPLES_PER_PIXEL:
+        raise ValueError("Unsupported color type")
+    bits_per_pixel = bit_depth * SAMPLES_PER_PIXEL[color_type]
+
+    if interlace_method == 1:
+        # each pass is a small image with its own scanlines
+        total_length = 0
+        for x_start, y_start, x_step, y_step in ADAM7_PASSES:
+            pass_width = (width - x_start + x_step - 1) // x_step
+            pass_height = (height - y_start + y_step - 1) // y_step
+            if pass_width == 0 or pass_height == 0:
+                continue
+            total_length += ((pass_width * bits_per_pixel + 7) // 8 + 1) * pass_height
+        return total_length
 
     # Calculate bytes per scanline (including filter byte)
-    bytes_per_scanline = (width * bytes_per_pixel) + 1
+    bytes_per_scanline = (width * bits_per_pixel + 7) // 8 + 1
 
     # Calculate total decompressed length
     total_length = bytes_per_scanline * height
@@ -471,65 +843,144 @@ def paeth_predictor(a, b, c):
         return c
 
 
-def unfilter_scanlines(data, width, height, bpp, raise_error=True):
-    """Unfilter the scanlines of a PNG image."""
+@lru_cache(maxsize=16)
+def _lane_masks(length):
+    """Masks used to add `length` bytes packed in an int (see `_add_lanes`)"""
+    full = (1 << (8 * length)) - 1
+    high = int.from_bytes(b"\x80" * length, "little")
+    return full ^ high, high, full
+
+
+def _add_lanes(x, y, masks):
+    """Add each byte of `x` to the byte of `y` at the same position, modulo 256
+
+    The 7 low bits of each byte are added, then the high bits are xored in,
+    so no carry crosses the byte boundary
+    """
+    low, high, _ = masks
+    return ((x & low) + (y & low)) ^ ((x ^ y) & high)
+
+
+def unfilter_row(buffer, start, length, bpp, filter_type, first_row=False):
+    """Unfilter one scanline in place
+
+    `buffer`: bytearray holding the filtered scanline (without the filter byte)
+    at `start`, and the unfiltered previous scanline just before it
+    `first_row`: the previous scanline is not used (zeros)
+
+    Returns False if the filter type is unknown (the scanline is left untouched)
+    """
+    end = start + length
+    prev = start - length
+    if filter_type == 0:  # None
+        return True
+    if filter_type == 1 or (filter_type == 4 and first_row):  # Sub
+        # running sum of the bytes, `bpp` apart, computed on the whole
+        # scanline at once: log2(width) shifted additions
+        view = memoryview(buffer)
+        masks = _lane_masks(length)
+        row = int.from_bytes(view[start:end], "little")
+        shift = 8 * bpp
+        while shift < 8 * length:
+            row = _add_lanes(row, (row << shift) & masks[2], masks)
+            shift <<= 1
+        view[start:end] = row.to_bytes(length, "little")
+        view.release()
+    elif filter_type == 2:  # Up
+        if not first_row:
+            view = memoryview(buffer)
+            row = _add_lanes(
+                int.from_bytes(view[start:end], "little"),
+                int.from_bytes(view[prev:start], "little"),
+                _lane_masks(length),
+            )
+            view[start:end] = row.to_bytes(length, "little")
+            view.release()
+    elif filter_type == 3:  # Average
+        # each channel is unfiltered on its own, the left byte stays in `a`
+        view = memoryview(buffer)
+        for channel in range(min(bpp, length)):
+            if first_row:
+                up_bytes = repeat(0)
+            else:
+                up_bytes = view[prev + channel : start : bpp]
+            lane = []
+            a = 0
+            for x, b in zip(view[start + channel : end : bpp], up_bytes):
+                a = (x + ((a + b) >> 1)) & 0xFF
+                lane.append(a)
+            view[start + channel : end : bpp] = bytes(lane)
+        view.release()
+    elif filter_type == 4:  # Paeth
+        # each channel is unfiltered on its own: the left byte stays in `a`
+        # and the upper left one in `c`, they are zero for the first pixel
+        view = memoryview(buffer)
+        for channel in range(min(bpp, length)):
+            lane = []
+            a = c = 0
+            for x, b in zip(
+                view[start + channel : end : bpp], view[prev + channel : start : bpp]
+            ):
+                # inlined paeth_predictor()
+                pa = b - c
+                pb = a - c
+                pc = pa + pb
+                if pa < 0:
+                    pa = -pa
+                if pb < 0:
+                    pb = -pb
+                if pc < 0:
+                    pc = -pc
+                if pa <= pb and pa <= pc:
+                    a = (x + a) & 0xFF
+                elif pb <= pc:
+                    a = (x + b) & 0xFF
+                else:
+                    a = (x + c) & 0xFF
+                lane.append(a)
+                c = b
+            view[start + channel : end : bpp] = bytes(lane)
+        view.release()
+    else:
+        return False
+    return True
+
+
+def unfilter_scanlines(data, width, height, bpp, raise_error=True, out=None):
+    """Unfilter the scanlines of a PNG image.
+
+    The scanlines are unfiltered in place in a single preallocated buffer
+    (`out` if given)
+    """
     scanline_length = width * bpp
-    result = bytearray()
-    prev_line = bytearray([0] * scanline_length)
+    result = bytearray(scanline_length * height) if out is None else out
+    view = memoryview(result)
     offset = 0
 
-    for _ in range(height):
+    for y in range(height):
         filter_type = data[offset]
         offset += 1
-        scanline = bytearray(data[offset : offset + scanline_length])
+        start = y * scanline_length
+        scanline = data[offset : offset + scanline_length]
         offset += scanline_length
+        view[start : start + len(scanline)] = scanline
 
-        if filter_type == 0:  # None
-            pass
-        elif filter_type == 1:  # Sub
-            for i in range(bpp, len(scanline)):
-                scanline[i] = (scanline[i] + scanline[i - bpp]) % 256
-        elif filter_type == 2:  # Up
-            for i, sc in enumerate(scanline):
-                scanline[i] = (sc + prev_line[i]) % 256
-        elif filter_type == 3:  # Average
-            for i, sc in enumerate(scanline):
-                left = scanline[i - bpp] if i >= bpp else 0
-                up = prev_line[i]
-                scanline[i] = (sc + ((left + up) // 2)) % 256
-        elif filter_type == 4:  # Paeth
-            for i, sc in enumerate(scanline):
-                a = scanline[i - bpp] if i >= bpp else 0
-                b = prev_line[i]
-                c = prev_line[i - bpp] if i >= bpp else 0
-                scanline[i] = (sc + paeth_predictor(a, b, c)) % 256
-        else:
+        if not unfilter_row(
+            result, start, scanline_length, bpp, filter_type, first_row=y == 0
+        ):
             if raise_error:
                 raise ValueError(f"Unknown filter type: {filter_type}")
 
-        result.extend(scanline)
-        prev_line = scanline
-
+    view.release()
     return result
 
 
-def deinterlace_adam7(data, width, height, bpp, raise_error=True):
-    """Deinterlace Adam7 interlaced PNG data."""
-    # Adam7 pattern: (x_start, y_start, x_step, y_step)
-    passes = [
-        (0, 0, 8, 8),  # pass 1
-        (4, 0, 8, 8),  # pass 2
-        (0, 4, 4, 8),  # pass 3
-        (2, 0, 4, 4),  # pass 4
-        (0, 2, 2, 4),  # pass 5
-        (1, 0, 2, 2),  # pass 6
-        (0, 1, 1, 2),  # pass 7
-    ]
-
-    img = bytearray(width * height * bpp)
+def deinterlace_adam7(data, width, height, bpp, raise_error=True, out=None):
+    """Deinterlace Adam7 interlaced PNG data (into `out` if given)."""
+    img = bytearray(width * height * bpp) if out is None else out
     offset = 0
 
-    for x_start, y_start, x_step, y_step in passes:
+    for x_start, y_start, x_step, y_step in ADAM7_PASSES:
         pass_width = (width - x_start + x_step - 1) // x_step
         pass_height = (height - y_start + y_step - 1) // y_step
         if pass_width == 0 or pass_height == 0:
@@ -556,6 +1007,25 @@ def deinterlace_adam7(data, width, height, bpp, raise_error=True):
     return img
 
 
+def get_bytes_per_pixel(bit_depth, color_type):
+    """Get the number of bytes per pixel of the supported formats"""
+    if bit_depth not in (8, 16):
+        raise NotImplementedError(
+            "Only 8-bit and 16-bit depths are supported in this implementation"
+        )
+
+    bytes_per_sample = bit_depth // 8
+    if color_type == 0:  # grayscale
+        return bytes_per_sample
+    if color_type == 2:  # RGB
+        return 3 * bytes_per_sample
+    if color_type == 4:  # grayscale and alpha
+        return 2 * bytes_per_sample
+    if color_type == 6:  # RGBA
+        return 4 * bytes_per_sample
+    raise NotImplementedError(f"Unsupported color type: {color_type}")
+
+
 def parse_idat(
     unzip_idat_data,
     width,
@@ -564,39 +1034,183 @@ def parse_idat(
     color_type,
     interlace_method=0,
     raise_error=True,
+    out=None,
 ):
-    """Parse IDAT data and return pixel values."""
-    if bit_depth != 8:
-        raise NotImplementedError(
-            "Only 8-bit depth is supported in this implementation"
-        )
+    """Parse IDAT data and return pixel values.
 
-    if color_type == 2:  # RGB
-        bpp = 3
-    elif color_type == 6:  # RGBA
-        bpp = 4
-    else:
-        raise NotImplementedError(f"Unsupported color type: {color_type}")
+    `out`: preallocated buffer of the pixel values (see `decode_pixels`)
+    """
+    bpp = get_bytes_per_pixel(bit_depth, color_type)
 
     if interlace_method == 0:
-        raw = unfilter_scanlines(unzip_idat_data, width, height, bpp, raise_error)
+        raw = unfilter_scanlines(unzip_idat_data, width, height, bpp, raise_error, out)
     elif interlace_method == 1:
-        raw = deinterlace_adam7(unzip_idat_data, width, height, bpp, raise_error)
+        raw = deinterlace_adam7(unzip_idat_data, width, height, bpp, raise_error, out)
     else:
         raise NotImplementedError(f"Unsupported interlace method: {interlace_method}")
 
     return raw
 
 
-def acropalypse(chunks: List[Chunk], orig_width, orig_height, bit_depth, color_type):
-    """Acropalypse function
+def iter_inflate(idat_data, chunk_size=INFLATE_CHUNK_SIZE):
+    """Inflate IDAT data lazily
+
+    `idat_data`: compressed data, or an iterable of compressed pieces
+    (like the result of `extract_idat`)
+
+    Yields decompressed pieces of at most `chunk_size` bytes, the input is
+    only consumed as the pieces are requested
+    """
+    if isinstance(idat_data, (bytes, bytearray, memoryview)):
+        idat_data = [idat_data]
+    decompressor = zlib.decompressobj()
+    for piece in idat_data:
+        pending = piece
+        while True:
+            out = decompressor.decompress(pending, chunk_size)
+            if len(out) > 0:
+                yield out
+            if decompressor.eof:
+                return
+            pending = decompressor.unconsumed_tail
+            if len(pending) == 0 and len(out) < chunk_size:
+                break
+
+
+def _iter_rows(idat_data, width, height, bpp, raise_error=True):
+    """Inflate and unfilter IDAT data one scanline at a time
+
+    Yields the index and a memoryview of each unfiltered scanline, the view
+    is only valid until the next scanline is requested
+    """
+    scanline_length = width * bpp
+    # previous scanline, then the current one
+    rows = bytearray(2 * scanline_length)
+    view = memoryview(rows)
+    pending = bytearray()
+    source = iter_inflate(idat_data)
+    for y in range(height):
+        while len(pending) < scanline_length + 1:
+            piece = next(source, None)
+            if piece is None:
+                raise ValueError(f"IDAT data ended after {y} scanlines")
+            pending += piece
+        filter_type = pending[0]
+        view[:scanline_length] = view[scanline_length:]
+        view[scanline_length:] = pending[1 : scanline_length + 1]
+        del pending[: scanline_length + 1]
+        if not unfilter_row(
+            rows, scanline_length, scanline_length, bpp, filter_type, y == 0
+        ):
+            if raise_error:
+                raise ValueError(f"Unknown filter type: {filter_type}")
+        yield y, view[scanline_length:]
+
+
+def iter_scanlines(
+    idat_data,
+    width,
+    height,
+    bit_depth,
+    color_type,
+    interlace_method=0,
+    raise_error=True,
+):
+    """Decode IDAT data scanline by scanline
+
+    `idat_data`: compressed data, or an iterable of compressed pieces
+
+    Yields the pixel values of each scanline. Only the previous scanline is
+    kept and the data is inflated as needed, stopping the iteration stops
+    the inflating. Interlaced images are fully decoded first.
+    """
+    bpp = get_bytes_per_pixel(bit_depth, color_type)
+    scanline_length = width * bpp
+    if interlace_method == 0:
+        for _, row in _iter_rows(idat_data, width, height, bpp, raise_error):
+            yield bytes(row)
+        return
+    if not isinstance(idat_data, (bytes, bytearray, memoryview)):
+        idat_data = b"".join(idat_data)
+    expected_length = calculate_decompressed_length(
+        width, height, bit_depth, color_type, interlace_method
+    )
+    raw = parse_idat(
+        try_decompress(idat_data, expected_length=expected_length),
+        width,
+        height,
+        bit_depth,
+        color_type,
+        interlace_method,
+        raise_error,
+    )
+    for y in range(height):
+        yield bytes(raw[y * scanline_length : (y + 1) * scanline_length])
+
+
+def decode_region(
+    idat_data,
+    width,
+    height,
+    bit_depth,
+    color_type,
+    rows=None,
+    columns=None,
+    interlace_method=0,
+    raise_error=True,
+):
+    """Decode a region of the image
+
+    `idat_data`: compressed data, or an iterable of compressed pieces
+    `rows`: range of rows (y0, y1) to decode, y1 excluded, all rows if None
+    `columns`: range of columns (x0, x1) to decode, x1 excluded, all columns if None
+
+    The data is only inflated up to the row y1, the rows before y0
+    are unfiltered but not kept.
+    """
+    y0, y1 = rows if rows is not None else (0, height)
+    x0, x1 = columns if columns is not None else (0, width)
+    if not 0 <= y0 <= y1 <= height or not 0 <= x0 <= x1 <= width:
+        raise ValueError(f"Region {rows} x {columns} is outside of the image")
+    bpp = get_bytes_per_pixel(bit_depth, color_type)
+    region_length = (x1 - x0) * bpp
+    result = bytearray(region_length * (y1 - y0))
+    if y0 == y1:
+        return result
+    view = memoryview(result)
+    if interlace_method == 0:
+        scanlines = _iter_rows(idat_data, width, height, bpp, raise_error)
+    else:
+        scanlines = enumerate(
+            iter_scanlines(
+                idat_data,
+                width,
+                height,
+                bit_depth,
+                color_type,
+                interlace_method,
+                raise_error,
+            )
+        )
+    for y, row in scanlines:
+        if y < y0:
+            continue
+        start = (y - y0) * region_length
+        view[start : start + region_length] = row[x0 * bpp : x1 * bpp]
+        if y + 1 == y1:
+            break
+    view.release()
+    return result
+
+
+def find_acropalypse_data(chunks: List[Chunk]):
+    """Find the end of the image data hidden in the acropalypse chunks
 
     Args:
         chunks: List of chunks of IDAT
-        orig_width: Original width of the image
-        orig_height: Original height of the image
-        bit_depth: Bit depth of the image
-        color_type: Color type of the image
+
+    Returns the decompressed data of the blocks after the first viable
+    parse (the end of the scanlines of the original image), or None.
 
     Inspired from
     https://gist.github.com/DavidBuchanan314/93de9d07f7fab494bcdf17c2bd6cef02 (MIT License)
@@ -610,53 +1224,65 @@ def acropalypse(chunks: List[Chunk], orig_width, orig_height, bit_depth, color_t
 
     print(f"Extracted {len(data_idat)} bytes of idat!")
 
-    bitstream = []
-    for byte in data_idat:
-        for bit in range(8):
-            bitstream.append((byte >> bit) & 1)
-
-    for _ in range(7):
-        bitstream.append(0)
-
-    byte_offsets = []
-    for i in range(8):
-        shifted_bytestream = []
-        for j in range(i, len(bitstream) - 7, 8):
-            val = 0
-            for k in range(8):
-                val |= bitstream[j + k] << k
-            shifted_bytestream.append(val)
-        byte_offsets.append(bytes(shifted_bytestream))
-
-    # create new compression block
-    prefix = (
-        b"\x00"
-        + (0x8000).to_bytes(2, "little")
-        + (0x8000 ^ 0xFFFF).to_bytes(2, "little")
-        + b"\x00" * 0x8000
-    )
+    # an empty window of 32K, so the back references before the start
+    # of the candidate block resolve to zeros
+    window = zlib.decompressobj(wbits=-15, zdict=bytes(DEFLATE_WINDOW_SIZE))
+    bits = int.from_bytes(data_idat, "little")
     for i in range(len(data_idat)):
-        truncated = byte_offsets[i % 8][i // 8 :]
-
-        # only bother looking if it's (maybe) the start of a non-final adaptive huffman coded block
-        if truncated[0] & 7 != 0b100:
+        # only bother looking if it's the start of a non-final dynamic
+        # huffman coded block with a valid header: checking the header
+        # rejects most of the offsets without inflating anything
+        try:
+            header = read_block_header(BitReader(data_idat, i))
+        except ValueError:
+            continue
+        if header.final or header.block_type != BLOCK_DYNAMIC:
             continue
-        d = zlib.decompressobj(wbits=-15)
+        # the data shifted by i bits, with zero padding bits at the end
+        truncated = (bits >> i).to_bytes(len(data_idat) - i // 8, "little")
+        d = window.copy()
         try:
-            decompressed = d.decompress(prefix + truncated) + d.flush(zlib.Z_FINISH)
+            decompressed = d.decompress(truncated) + d.flush(zlib.Z_FINISH)
             if d.eof and d.unused_data in [
                 b"",
                 b"\x00",
             ]:  # there might be a null byte if we added too many padding bits
                 print(f"Found viable parse at bit offset {i}!")
-                decompressed = decompressed[0x8000:]  # remove leading padding
                 break
         except zlib.error as _e:
             # print(_e)
             continue
     else:
         print("Failed to find viable parse :(")
+        return None
+    return decompressed
+
+
+def acropalypse(chunks: List[Chunk], orig_width, orig_height, bit_depth, color_type):
+    """Acropalypse function
+
+    Args:
+        chunks: List of chunks of IDAT
+        orig_width: Original width of the image
+        orig_height: Original height of the image
+        bit_depth: Bit depth of the image
+        color_type: Color type of the image
+
+    See `find_acropalypse_data`
+    """
+    decompressed = find_acropalypse_data(chunks)
+    if decompressed is None:
         return None, None, None
+    return reconstruct_acropalypse_data(
+        decompressed, orig_width, orig_height, bit_depth, color_type
+    )
+
+
+def reconstruct_acropalypse_data(
+    decompressed, orig_width, orig_height, bit_depth, color_type
+):
+    """Paste the end of the image data found by `find_acropalypse_data` in
+    an image of the original size, and parse it"""
     if color_type == 6:
         reconstructed_idat = bytearray(
             (b"\x00" + b"\xff\x00\xff\xff" * orig_width) * orig_height
@@ -0,0 +1,122 @@
+"""Metadata of PNG files, read without the image data"""
+
+from os import SEEK_END, SEEK_SET
+from typing import List, NamedTuple, Optional, Tuple
+from .cache import ChunkEntry, print_chunk_entries
+from .lib import (
+    PNG_MAGIC,
+    calculate_crc,
+    decode_ihdr,
+    decode_phy,
+    get_memory_limit,
+    new_chunk,
+)
+
+# chunks always read, whatever their size
+TEXT_TYPES = (b"tEXt", b"zTXt", b"iTXt")
+
+# chunks never read
+IMAGE_DATA_TYPES = (b"IDAT", b"fdAT")
+
+# maximum size of the other chunks to read
+MAX_PAYLOAD = 64 * 1024
+
+
+class FileInfo(NamedTuple):
+    """Metadata of a PNG file"""
+
+    size: int
+    ihdr: Optional[Tuple[int, int, int, int, int, int, int]]  # see decode_ihdr()
+    phys: Optional[Tuple[int, int, int]]  # see decode_phy()
+    texts: List[Tuple[bytes, bytes]]  # (chunk type, data) of the text chunks
+    payloads: List[Tuple[bytes, bytes]]  # (chunk type, data) of the other chunks read
+    chunks: List[ChunkEntry]  # crc_ok is None when the data was skipped
+    bytes_read: int
+
+
+def _should_read(chunk_type: bytes, length: int, max_payload: int) -> bool:
+    """Check if the data of a chunk is needed for the metadata"""
+    if chunk_type in IMAGE_DATA_TYPES:
+        return False
+    return chunk_type in TEXT_TYPES or length <= max_payload
+
+
+def inspect_file(file, max_payload=MAX_PAYLOAD, memory_limit=None) -> FileInfo:
+    """Read the metadata of a PNG file without reading the image data
+
+    `file`: path or seekable binary file
+    `max_payload`: maximum size of the chunks to read (text chunks
+    are always read)
+
+    Only the chunk headers and the small chunks are read,
+    the IDAT and fdAT data is skipped with `seek`
+    """
+    if isinstance(file, str):
+        with open(file, "rb") as fp:
+            return inspect_file(fp, max_payload, memory_limit)
+    limit = get_memory_limit(memory_limit)
+    size = file.seek(0, SEEK_END)
+    file.seek(0, SEEK_SET)
+    if file.read(len(PNG_MAGIC)) != PNG_MAGIC:
+        raise ValueError("File is not a PNG")
+    bytes_read = len(PNG_MAGIC)
+    ihdr = None
+    phys = None
+    texts = []
+    payloads = []
+    chunks = []
+    offset = len(PNG_MAGIC)
+    while offset + 8 <= size:
+        header = file.read(8)
+        bytes_read += 8
+        length = int.from_bytes(header[:4], byteorder="big")
+        chunk_type = header[4:]
+        end = offset + 12 + length
+        if end > size:
+            # truncated chunk or wrong length
+            chunks.append(ChunkEntry(offset, length, chunk_type, False))
+            break
+        if not _should_read(chunk_type, length, max_payload):
+            chunks.append(ChunkEntry(offset, length, chunk_type, None))
+            file.seek(end, SEEK_SET)
+            offset = end
+            continue
+        if length > limit:
+            raise ValueError(
+                f"Chunk length {length} is over the memory limit of {limit} bytes"
+            )
+        data = file.read(length)
+        crc = file.read(4)
+        bytes_read += length + 4
+        crc_ok = crc == calculate_crc(chunk_type, data)
+        chunks.append(ChunkEntry(offset, length, chunk_type, crc_ok))
+        if chunk_type == b"IHDR":
+            if ihdr is None and length == 13:
+                ihdr = decode_ihdr(data)
+        elif chunk_type == b"pHYs":
+            if phys is None and length == 9:
+                phys = decode_phy(new_chunk(length, chunk_type, data, crc, []))
+        elif chunk_type in TEXT_TYPES:
+            texts.append((chunk_type, data))
+        else:
+            payloads.append((chunk_type, data))
+        offset = end
+    return FileInfo(size, ihdr, phys, texts, payloads, chunks, bytes_read)
+
+
+def print_file_info(info: FileInfo):
+    """Print the metadata of a file"""
+    print(f"Size: {info.size} bytes ({info.bytes_read} bytes read)")
+    if info.ihdr is not None:
+        width, height, bit_depth, color_type, _, _, interlace_method = info.ihdr
+        print(
+            f"IHDR: {width}x{height}, bit depth {bit_depth},"
+            f" color type {color_type}, interlace {interlace_method}"
+        )
+    if info.phys is not None:
+        x_pixels_per_unit, y_pixels_per_unit, unit_specifier = info.phys
+        print(f"pHYs: {x_pixels_per_unit}x{y_pixels_per_unit} (unit {unit_specifier})")
+    for chunk_type, data in info.texts:
+        data_display = data[:40] + b"..." if len(data) > 40 else data
+        print(f"{chunk_type.decode('latin-1')}: {data_display}")
+    print_chunk_entries(info.chunks)
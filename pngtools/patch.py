@@ -0,0 +1,174 @@
+"""In-place patching of PNG files, writing only the modified bytes"""
+
+from os import SEEK_END
+from typing import List, NamedTuple, Optional
+from .diff import COMPARE_BLOCK_SIZE, read_chunk_headers
+from .lib import (
+    PNG_MAGIC,
+    Chunk,
+    get_binary_chunk,
+    get_crc_of_chunk,
+    get_data_of_chunk,
+    get_length_of_chunk,
+    get_type_of_chunk,
+    write_at,
+    write_png,
+)
+
+
+class PatchWrite(NamedTuple):
+    """Bytes to write at an offset of the file"""
+
+    offset: int
+    data: bytes
+
+
+class Patch(NamedTuple):
+    """Writes turning a file into the edited chunks"""
+
+    in_place: bool  # False when the chunks are rewritten from the first change
+    writes: List[PatchWrite]
+    size: int  # size of the patched file
+
+    @property
+    def bytes_written(self) -> int:
+        """Number of bytes written by the patch"""
+        return sum(len(write.data) for write in self.writes)
+
+
+def get_chunk_offsets(chunks: List[Chunk], offset=len(PNG_MAGIC)) -> List[int]:
+    """Offsets of the chunks in a file written by `write_png`, and the end of
+    the last chunk"""
+    offsets = [offset]
+    for one_chunk in chunks:
+        offset += 12 + len(get_data_of_chunk(one_chunk))
+        offsets.append(offset)
+    return offsets
+
+
+def get_modified_chunks(original: List[Chunk], edited: List[Chunk]) -> List[int]:
+    """Indices of the edited chunks which differ from the original chunks
+
+    The unchanged chunks are the same objects, so they are not compared
+    """
+    return [
+        index
+        for index, one_chunk in enumerate(edited)
+        if index >= len(original)
+        or (one_chunk is not original[index] and one_chunk != original[index])
+    ]
+
+
+def _changed_range(old: bytes, new: bytes):
+    """First and last + 1 offsets of the bytes which differ (same lengths)
+
+    The blocks are compared first, then the bytes of the first and last
+    different blocks
+    """
+    if old is new or old == new:
+        return None
+    start = 0
+    while (
+        old[start : start + COMPARE_BLOCK_SIZE]
+        == new[start : start + COMPARE_BLOCK_SIZE]
+    ):
+        start += COMPARE_BLOCK_SIZE
+    while old[start] == new[start]:
+        start += 1
+    end = len(new)
+    block_start = end - COMPARE_BLOCK_SIZE
+    while block_start > start and old[block_start:end] == new[block_start:end]:
+        end = block_start
+        block_start -= COMPARE_BLOCK_SIZE
+    while old[end - 1] == new[end - 1]:
+        end -= 1
+    return start, end
+
+
+def _chunk_writes(offset, old: Chunk, new: Chunk) -> List[PatchWrite]:
+    """Writes of the modified fields of a chunk which keeps its size"""
+    writes = []
+    header_old = get_length_of_chunk(old).to_bytes(4, "big") + get_type_of_chunk(old)
+    header_new = get_length_of_chunk(new).to_bytes(4, "big") + get_type_of_chunk(new)
+    if header_old != header_new:
+        writes.append(PatchWrite(offset, header_new))
+    changed = _changed_range(get_data_of_chunk(old), get_data_of_chunk(new))
+    if changed is not None:
+        start, end = changed
+        writes.append(PatchWrite(offset + 8 + start, get_data_of_chunk(new)[start:end]))
+    crc = get_crc_of_chunk(new)
+    if crc != get_crc_of_chunk(old):
+        end = offset + 8 + len(get_data_of_chunk(new))
+        writes.append(PatchWrite(end, crc))
+    return writes
+
+
+def plan_patch(original: List[Chunk], edited: List[Chunk]) -> Patch:
+    """Find the writes turning a file written from the original chunks into
+    a file written from the edited chunks
+
+    When the modified chunks keep their size, only their modified fields
+    (and the modified range of their data) are written in place. Otherwise
+    the chunks are rewritten from the first modified one.
+    """
+    offsets = get_chunk_offsets(original)
+    modified = get_modified_chunks(original, edited)
+    same_layout = len(edited) == len(original) and all(
+        len(get_data_of_chunk(edited[i])) == len(get_data_of_chunk(original[i]))
+        for i in modified
+    )
+    if same_layout:
+        writes = []
+        for index in modified:
+            writes.extend(_chunk_writes(offsets[index], original[index], edited[index]))
+        return Patch(True, writes, offsets[-1])
+    first = modified[0] if modified else len(edited)
+    new_offsets = get_chunk_offsets(edited[first:], offsets[first])
+    writes = [
+        PatchWrite(offset, get_binary_chunk(one_chunk))
+        for offset, one_chunk in zip(new_offsets, edited[first:])
+    ]
+    return Patch(False, writes, new_offsets[-1])
+
+
+def _check_layout(fp, original: List[Chunk]) -> bool:
+    """Check that the file is laid out like `write_png(original)`"""
+    size = fp.seek(0, SEEK_END)
+    offsets = get_chunk_offsets(original)
+    if size != offsets[-1]:
+        return False
+    try:
+        headers = read_chunk_headers(fp)
+    except ValueError:
+        return False
+    if len(headers) != len(original):
+        return False
+    return all(
+        header.offset == offset
+        and header.length == get_length_of_chunk(one_chunk)
+        and header.chunk_type == get_type_of_chunk(one_chunk)
+        for header, offset, one_chunk in zip(headers, offsets, original)
+    )
+
+
+def patch_file(
+    filename: str, original: List[Chunk], edited: List[Chunk]
+) -> Optional[Patch]:
+    """Write the edited chunks to the file the original chunks were read from
+
+    Only the chunk headers of the file are read to check its layout, then
+    the writes of `plan_patch` are done with pwrite (or seek and write), so
+    the I/O is proportional to the edit. When the file is not laid out like
+    the original chunks (damaged or trailing data), the whole file is
+    written. Returns the patch, None if the whole file was written.
+    """
+    with open(filename, "r+b") as fp:
+        if _check_layout(fp, original):
+            patch = plan_patch(original, edited)
+            for write in patch.writes:
+                write_at(fp, write.data, write.offset)
+            if not patch.in_place:
+                fp.truncate(patch.size)
+            return patch
+    write_png(edited, filename)
+    return None
@@ -0,0 +1,122 @@
+"""Decoded pixels exposed without copies (buffer protocol, NumPy, Pillow)"""
+
+from .lib import (
+    get_bytes_per_pixel,
+    parse_idat,
+)
+
+# number of samples of each pixel, for each color type
+CHANNELS = {0: 1, 2: 3, 4: 2, 6: 4}
+
+# Pillow modes of the 8-bit formats
+PIL_MODES = {0: "L", 2: "RGB", 4: "LA", 6: "RGBA"}
+
+
+class PixelBuffer(bytearray):
+    """Pixel values of an image, with the geometry of the image
+
+    A bytearray, so it supports the (flat) buffer protocol, with the NumPy
+    array interface: the shape is (height, width, channels) and 16-bit
+    samples are big-endian unsigned integers, like in the PNG data.
+    `numpy.asarray` prefers the buffer protocol, use `as_numpy` to get
+    the shaped array.
+    """
+
+    def __init__(self, source, width, height, bit_depth, color_type):
+        super().__init__(source)
+        if color_type not in CHANNELS or bit_depth not in (8, 16):
+            raise NotImplementedError(
+                f"Unsupported format: bit depth {bit_depth}, color type {color_type}"
+            )
+        self.width = width
+        self.height = height
+        self.bit_depth = bit_depth
+        self.color_type = color_type
+        self.channels = CHANNELS[color_type]
+
+    def _check_size(self):
+        """Check that the length of the buffer matches the geometry"""
+        if len(self) != self.height * self.width * self.channels * self.bit_depth // 8:
+            raise ValueError("The buffer does not match the size of the image")
+
+    @property
+    def shape(self):
+        """Shape of the pixel array: (height, width, channels)"""
+        return (self.height, self.width, self.channels)
+
+    @property
+    def typestr(self):
+        """NumPy type of the samples"""
+        return "|u1" if self.bit_depth == 8 else ">u2"
+
+    @property
+    def __array_interface__(self):
+        self._check_size()
+        return {
+            "version": 3,
+            "shape": self.shape,
+            "typestr": self.typestr,
+            # the array shares the memory of the buffer, which cannot be
+            # resized while the array exists
+            "data": memoryview(self),
+        }
+
+    def as_numpy(self):
+        """Get a NumPy array of the pixels, sharing the memory of the buffer
+
+        16-bit samples stay big-endian, use `.astype("=u2")` to get a
+        native copy
+        """
+        import numpy  # pylint: disable=import-outside-toplevel
+
+        self._check_size()
+        return numpy.frombuffer(self, dtype=self.typestr).reshape(self.shape)
+
+    def as_pil(self):
+        """Get a Pillow image of the pixels (8-bit images only)
+
+        Pillow shares the memory of the buffer for the L and RGBA modes,
+        and copies it for the others
+        """
+        from PIL import Image  # pylint: disable=import-outside-toplevel
+
+        if self.bit_depth != 8:
+            raise NotImplementedError("Only 8-bit images can be shared with Pillow")
+        mode = PIL_MODES[self.color_type]
+        return Image.frombuffer(
+            mode, (self.width, self.height), self, "raw", mode, 0, 1
+        )
+
+    def __repr__(self):
+        return (
+            f"PixelBuffer({self.width}x{self.height}, bit depth {self.bit_depth},"
+            f" color type {self.color_type})"
+        )
+
+
+def decode_pixels(
+    unzip_idat_data,
+    width,
+    height,
+    bit_depth,
+    color_type,
+    interlace_method=0,
+    raise_error=True,
+) -> PixelBuffer:
+    """Parse decompressed IDAT data into a `PixelBuffer`
+
+    Like `parse_idat`, the scanlines are unfiltered directly in the buffer
+    """
+    bpp = get_bytes_per_pixel(bit_depth, color_type)
+    pixels = PixelBuffer(width * height * bpp, width, height, bit_depth, color_type)
+    parse_idat(
+        unzip_idat_data,
+        width,
+        height,
+        bit_depth,
+        color_type,
+        interlace_method,
+        raise_error,
+        pixels,
+    )
+    return pixels
@@ -40,6 +40,42 @@ def convert_rgba_to_rgb(raw_data) -> bytearray:
     )
 
 
+def convert_row_to_rgb(row, bytes_per_pixel, bytes_per_sample=1) -> bytearray:
+    """Convert a row of RGB or RGBA pixels to RGB."""
+    rgb_bytes = 3 * bytes_per_sample
+    if bytes_per_pixel == rgb_bytes:
+        return bytearray(row)
+    width = len(row) // bytes_per_pixel
+    rgb_row = bytearray(width * rgb_bytes)
+    for i in range(rgb_bytes):
+        rgb_row[i::rgb_bytes] = row[i::bytes_per_pixel]
+    return rgb_row
+
+
+def stream_ppm(filename, width, height, color_type, scanlines, bit_depth=8):
+    """Create a binary PPM file from RGB or RGBA scanlines, one row at a time.
+
+    `scanlines`: iterable of the pixel values of each row, top to bottom
+    (like `iter_scanlines`)
+
+    Each row is written as soon as it is decoded, so only one row is in memory.
+    16-bit samples are big-endian in both formats.
+    """
+    if color_type not in (2, 6) or bit_depth not in (8, 16):
+        raise NotImplementedError("Only RGB and RGBA images can be converted to PPM")
+    bytes_per_sample = bit_depth // 8
+    bytes_per_pixel = (4 if color_type == 6 else 3) * bytes_per_sample
+    with open(filename, "wb") as f:
+        # Write the PPM header
+        f.write(b"P6\n")
+        f.write(f"{width} {height}\n".encode("utf-8"))
+        f.write(f"{(1 << bit_depth) - 1}\n".encode("utf-8"))  # Max color value
+        for y, row in enumerate(scanlines):
+            if y >= height:
+                break
+            f.write(convert_row_to_rgb(row, bytes_per_pixel, bytes_per_sample))
+
+
 def create_ppm(filename, width, height, raw_data, binary=False):
     """Create a PPM file.
 
@@ -0,0 +1,178 @@
+"""Low resolution previews of PNG images"""
+
+from operator import add
+from .lib import (
+    ADAM7_PASSES,
+    get_bytes_per_pixel,
+    iter_scanlines,
+    try_decompress,
+    unfilter_scanlines,
+)
+
+# grid of the pixels known after each Adam7 pass: (x_step, y_step)
+ADAM7_GRIDS = [
+    (8, 8),  # after pass 1
+    (4, 8),  # after pass 2
+    (4, 4),  # after pass 3
+    (2, 4),  # after pass 4
+    (2, 2),  # after pass 5
+    (1, 2),  # after pass 6
+    (1, 1),  # after pass 7
+]
+
+
+def decode_adam7_passes(
+    idat_data, width, height, bit_depth, color_type, passes=1, raise_error=True
+):
+    """Decode the first passes of an interlaced image
+
+    `idat_data`: compressed data, or an iterable of compressed pieces
+    `passes`: number of passes to decode (1 to 7)
+
+    Only the data of these passes is inflated. Returns the width, the height
+    and the pixel values of the image made of the pixels known after these
+    passes (1/8 of the size for the first pass, 1/4 after the third one...)
+    """
+    if not 1 <= passes <= len(ADAM7_PASSES):
+        raise ValueError(f"Invalid number of passes: {passes}")
+    bpp = get_bytes_per_pixel(bit_depth, color_type)
+    grid_x, grid_y = ADAM7_GRIDS[passes - 1]
+    preview_width = (width + grid_x - 1) // grid_x
+    preview_height = (height + grid_y - 1) // grid_y
+
+    sizes = []
+    for x_start, y_start, x_step, y_step in ADAM7_PASSES[:passes]:
+        pass_width = (width - x_start + x_step - 1) // x_step
+        pass_height = (height - y_start + y_step - 1) // y_step
+        if pass_width == 0 or pass_height == 0:
+            pass_width = pass_height = 0
+        sizes.append((pass_width, pass_height))
+    needed = sum((w * bpp + 1) * h for w, h in sizes if w > 0)
+
+    if not isinstance(idat_data, (bytes, bytearray, memoryview)):
+        idat_data = b"".join(idat_data)
+    data = try_decompress(idat_data, expected_length=needed)
+    if data is None or len(data) < needed:
+        raise ValueError(f"Not enough IDAT data for {passes} passes")
+
+    preview = bytearray(preview_width * preview_height * bpp)
+    offset = 0
+    for (x_start, y_start, x_step, y_step), (pass_width, pass_height) in zip(
+        ADAM7_PASSES, sizes
+    ):
+        if pass_width == 0:
+            continue
+        pass_length = (pass_width * bpp + 1) * pass_height
+        unfiltered = unfilter_scanlines(
+            data[offset : offset + pass_length],
+            pass_width,
+            pass_height,
+            bpp,
+            raise_error,
+        )
+        offset += pass_length
+        # the pixels of the pass are regularly spaced in the preview
+        step = (x_step // grid_x) * bpp
+        row_length = pass_width * bpp
+        for y in range(pass_height):
+            preview_y = (y_start + y * y_step) // grid_y
+            start = (preview_y * preview_width + x_start // grid_x) * bpp
+            row = unfiltered[y * row_length : (y + 1) * row_length]
+            for channel in range(bpp):
+                preview[
+                    start + channel : start + channel + step * pass_width : step
+                ] = row[channel::bpp]
+    return preview_width, preview_height, preview
+
+
+def downscale_scanlines(scanlines, width, height, bpp, scale, bytes_per_sample=1):
+    """Downscale scanlines with a box filter, one scanline at a time
+
+    `scanlines`: iterable of the scanlines (like `iter_scanlines`)
+    `bytes_per_sample`: 2 for 16-bit images, whose big-endian samples are
+    averaged as a whole
+
+    Each output pixel is the average of a box of `scale` x `scale` pixels
+    (smaller on the right and bottom edges). Returns the width, the height
+    and the pixel values of the downscaled image.
+    """
+    if scale < 1:
+        raise ValueError(f"Invalid scale: {scale}")
+    if bytes_per_sample not in (1, 2):
+        raise NotImplementedError(f"Unsupported sample size: {bytes_per_sample} bytes")
+    channels = bpp // bytes_per_sample
+    out_width = (width + scale - 1) // scale
+    out_height = (height + scale - 1) // scale
+    padding = bytes((out_width * scale - width) * bpp)
+    # number of pixels of each column of boxes
+    columns = [min(scale, width - x * scale) for x in range(out_width)]
+    sums = [[0] * out_width for _ in range(channels)]
+    result = bytearray()
+    rows_in_box = 0
+    for y, scanline in enumerate(scanlines):
+        if y >= height:
+            break
+        row = bytes(scanline) + padding
+        if bytes_per_sample == 2:
+            row = [high << 8 | low for high, low in zip(row[0::2], row[1::2])]
+        for channel in range(channels):
+            channel_sums = sums[channel]
+            for x in range(scale):
+                pixels = row[x * channels + channel :: scale * channels]
+                channel_sums = list(map(add, channel_sums, pixels))
+            sums[channel] = channel_sums
+        rows_in_box += 1
+        if rows_in_box == scale or y == height - 1:
+            for x, column in enumerate(columns):
+                count = column * rows_in_box
+                for channel in range(channels):
+                    value = (sums[channel][x] + count // 2) // count
+                    result += value.to_bytes(bytes_per_sample, "big")
+            sums = [[0] * out_width for _ in range(channels)]
+            rows_in_box = 0
+    return out_width, out_height, result
+
+
+def decode_preview(
+    idat_data,
+    width,
+    height,
+    bit_depth,
+    color_type,
+    interlace_method=0,
+    scale=8,
+    raise_error=True,
+):
+    """Decode a low resolution version of the image
+
+    `idat_data`: compressed data, or an iterable of compressed pieces
+    `scale`: how many times smaller the preview should be
+
+    Interlaced images only inflate the first Adam7 passes: pass 1 for a scale
+    of 8, passes 1 to 3 for 4, passes 1 to 5 for 2 (the pixels are sampled).
+    Other images are downscaled with a box filter while they are decoded.
+    Returns the width, the height and the pixel values of the preview.
+    """
+    if interlace_method == 1:
+        if scale >= 8:
+            passes = 1
+        elif scale >= 4:
+            passes = 3
+        elif scale >= 2:
+            passes = 5
+        else:
+            passes = 7
+        return decode_adam7_passes(
+            idat_data, width, height, bit_depth, color_type, passes, raise_error
+        )
+    bpp = get_bytes_per_pixel(bit_depth, color_type)
+    scanlines = iter_scanlines(
+        idat_data,
+        width,
+        height,
+        bit_depth,
+        color_type,
+        interlace_method,
+        raise_error,
+    )
+    return downscale_scanlines(scanlines, width, height, bpp, scale, bit_depth // 8)
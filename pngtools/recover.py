@@ -0,0 +1,271 @@
+"""Recovery of the IHDR fields from the CRC of the chunk"""
+
+import math
+import struct
+import zlib
+from typing import List, Optional, Tuple
+from .lib import (
+    SAMPLES_PER_PIXEL,
+    Chunk,
+    calculate_crc,
+    calculate_decompressed_length,
+    extract_idat,
+    find_acropalypse_data,
+    get_crc_of_chunk,
+    get_data_of_chunk,
+    get_type_of_chunk,
+    new_chunk,
+    reconstruct_acropalypse_data,
+    try_decompress,
+)
+
+# valid bit depths of each color type
+BIT_DEPTHS = {
+    0: (1, 2, 4, 8, 16),  # grayscale
+    2: (8, 16),  # RGB
+    3: (1, 2, 4, 8),  # palette
+    4: (8, 16),  # grayscale and alpha
+    6: (8, 16),  # RGBA
+}
+
+
+# the largest dimensions searched by default
+MAX_DIMENSION = 65535
+
+# the largest width searched when inferring the dimensions of an image
+MAX_INFERRED_WIDTH = 8192
+
+_IHDR_FORMAT = ">IIBBBBB"
+
+# the filter types, the only valid values of the first byte of a scanline
+_FILTER_TYPES = bytes(range(5))
+
+
+def _field_crc_table(length, offset, count) -> List[int]:
+    """CRC differences of the values 0 to `count - 1` of a 4 bytes field
+
+    The CRC is affine: for messages of the same length,
+    crc(a ^ b ^ c) = crc(a) ^ crc(b) ^ crc(c). So the CRC of a message is
+    the CRC of the message with a zero field, xor the difference of the field
+    value, which only depends on the length of the message and the offset of
+    the field. The differences of the single bits are combined.
+    """
+    zero = bytearray(length)
+    zero_crc = zlib.crc32(zero)
+    basis = []
+    for bit in range(max(1, (count - 1).bit_length())):
+        message = bytearray(length)
+        message[offset : offset + 4] = (1 << bit).to_bytes(4, byteorder="big")
+        basis.append(zlib.crc32(message) ^ zero_crc)
+    table = [0] * count
+    for value in range(1, count):
+        low_bit = value & -value
+        table[value] = table[value ^ low_bit] ^ basis[low_bit.bit_length() - 1]
+    return table
+
+
+def recover_ihdr(
+    data,
+    crc,
+    max_width=MAX_DIMENSION,
+    max_height=MAX_DIMENSION,
+    search_fields=False,
+    decompressed_length=None,
+) -> List[Tuple[int, int, int, int, int, int, int]]:
+    """Find the width and height matching the CRC of an IHDR chunk
+
+    `data`: damaged IHDR data, its last 5 bytes (bit depth, color type...)
+    are kept unless `search_fields` is set
+    `crc`: CRC stored in the chunk
+    `search_fields`: also search all the valid bit depths, color types and
+    interlace methods
+    `decompressed_length`: length of the decompressed IDAT data if known,
+    to only keep the candidates with this length
+
+    Thanks to the linearity of the CRC, the width and the height are found
+    with a lookup table of the heights: the time is in O(max_width + max_height)
+    instead of O(max_width * max_height). With 65535x65535 there are about
+    2^32 pairs for a 32 bits CRC, so a wrong pair can match too. Returns the
+    candidates like `decode_ihdr`.
+    """
+    target = int.from_bytes(crc, byteorder="big")
+    message_length = 4 + struct.calcsize(_IHDR_FORMAT)
+    width_table = _field_crc_table(message_length, 4, max_width + 1)
+    height_table = _field_crc_table(message_length, 8, max_height + 1)
+    heights = {difference: height for height, difference in enumerate(height_table)}
+    del heights[0]
+
+    if search_fields:
+        fields = [
+            (bit_depth, color_type, 0, 0, interlace_method)
+            for color_type, bit_depths in BIT_DEPTHS.items()
+            for bit_depth in bit_depths
+            for interlace_method in (0, 1)
+        ]
+    else:
+        fields = [tuple(data[8:13])]
+
+    candidates = []
+    for bit_depth, color_type, compression, filter_method, interlace in fields:
+        base = zlib.crc32(
+            b"IHDR"
+            + struct.pack(
+                _IHDR_FORMAT,
+                0,
+                0,
+                bit_depth,
+                color_type,
+                compression,
+                filter_method,
+                interlace,
+            )
+        )
+        wanted = target ^ base
+        for width in range(1, max_width + 1):
+            height = heights.get(wanted ^ width_table[width])
+            if height is None:
+                continue
+            ihdr = (
+                width,
+                height,
+                bit_depth,
+                color_type,
+                compression,
+                filter_method,
+                interlace,
+            )
+            if decompressed_length is not None:
+                if color_type not in SAMPLES_PER_PIXEL or (
+                    calculate_decompressed_length(
+                        width, height, bit_depth, color_type, interlace
+                    )
+                    != decompressed_length
+                ):
+                    continue
+            candidates.append(ihdr)
+    return candidates
+
+
+def create_ihdr_from_fields(ihdr) -> Chunk:
+    """Create an IHDR chunk from its fields (like the result of `decode_ihdr`)"""
+    chunk_type = b"IHDR"
+    data = struct.pack(_IHDR_FORMAT, *ihdr)
+    crc = calculate_crc(chunk_type, data)
+    return new_chunk(len(data), chunk_type, data, crc, [])
+
+
+def recover_ihdr_of_chunks(
+    chunks: List[Chunk],
+    max_width=MAX_DIMENSION,
+    max_height=MAX_DIMENSION,
+    search_fields=False,
+    use_idat=True,
+) -> Tuple[Optional[int], List[Tuple[int, int, int, int, int, int, int]]]:
+    """Find the IHDR fields of chunks from the CRC of the IHDR chunk
+
+    `use_idat`: only keep the candidates matching the length of the
+    decompressed IDAT data
+
+    Returns the index of the IHDR chunk and the candidates, see `recover_ihdr`
+    """
+    for index, one_chunk in enumerate(chunks):
+        if get_type_of_chunk(one_chunk) == b"IHDR":
+            break
+    else:
+        return None, []
+    decompressed_length = None
+    if use_idat:
+        decompressed = try_decompress(b"".join(extract_idat(chunks)))
+        if decompressed is not None:
+            decompressed_length = len(decompressed)
+    data = get_data_of_chunk(chunks[index])
+    if len(data) != 13:
+        data = bytes(13)
+    candidates = recover_ihdr(
+        data,
+        get_crc_of_chunk(chunks[index]),
+        max_width,
+        max_height,
+        search_fields,
+        decompressed_length,
+    )
+    return index, candidates
+
+
+def infer_dimensions(
+    scanlines, bit_depth, color_type, max_width=MAX_INFERRED_WIDTH
+) -> Optional[Tuple[int, int]]:
+    """Infer the width and the height of an image from the end of its
+    scanlines (like the data found by `find_acropalypse_data`)
+
+    For each width, the bytes at the start of the scanlines (counted from
+    the end of the data) must be filter types. Among the widths where all of
+    them are, the best one is the least likely to be a coincidence, given
+    the frequencies of the bytes of the data: images have many zeros, so a
+    filter type 0 is weak evidence while the filter types 1 to 4 are strong
+    evidence. Each width is checked with a slice of the data, so all the
+    widths cost about O(n log(max_width)). The height is the smallest one
+    holding all the scanlines. With bit depths under 8, the smallest width
+    of each scanline length is returned. Returns None if no width matches.
+    """
+    size = len(scanlines)
+    if size == 0:
+        return None
+    reversed_scanlines = bytes(scanlines[::-1])
+    weights = []
+    for value in _FILTER_TYPES:
+        # information of each byte: -log of its frequency
+        count = reversed_scanlines.count(bytes([value]))
+        weights.append(math.log(size / count) if count else 0.0)
+    bits_per_pixel = bit_depth * SAMPLES_PER_PIXEL[color_type]
+    best = None
+    previous_length = None
+    for width in range(1, max_width + 1):
+        length = (width * bits_per_pixel + 7) // 8 + 1
+        if length == previous_length:
+            continue
+        previous_length = length
+        if length > size:
+            break
+        filter_bytes = reversed_scanlines[length - 1 :: length]
+        if len(filter_bytes.translate(None, _FILTER_TYPES)) != 0:
+            continue
+        score = sum(
+            filter_bytes.count(bytes([value])) * weights[value]
+            for value in _FILTER_TYPES
+        )
+        if best is None or score > best[0]:
+            best = (score, width, length)
+    if best is None:
+        return None
+    _, width, length = best
+    return width, (size + length - 1) // length
+
+
+def recover_acropalypse(
+    chunks: List[Chunk], bit_depth, color_type, orig_width=None, orig_height=None
+):
+    """Recover the original image of the acropalypse chunks
+
+    The dimensions which are not given are inferred from the recovered
+    data with `infer_dimensions`, so a single search is needed.
+    Returns (width, height, pixels), or (None, None, None).
+    """
+    decompressed = find_acropalypse_data(chunks)
+    if decompressed is None:
+        return None, None, None
+    if orig_width is None or orig_height is None:
+        dimensions = infer_dimensions(decompressed, bit_depth, color_type)
+        if dimensions is None:
+            print("Failed to infer the dimensions :(")
+            return None, None, None
+        if orig_width is None:
+            orig_width = dimensions[0]
+        if orig_height is None:
+            length = calculate_decompressed_length(orig_width, 1, bit_depth, color_type)
+            orig_height = (len(decompressed) + length - 1) // length
+        print(f"Inferred dimensions: {orig_width}x{orig_height}")
+    data = reconstruct_acropalypse_data(
+        decompressed, orig_width, orig_height, bit_depth, color_type
+    )
+    return orig_width, orig_height, data
@@ -0,0 +1,239 @@
+"""Repair of corrupted chunk streams"""
+
+import re
+import zlib
+from typing import List, NamedTuple, Optional, Tuple
+from .lib import (
+    CHUNKS_TYPES,
+    ERROR_CODE,
+    PNG_MAGIC,
+    Chunk,
+    calculate_crc,
+    get_memory_limit,
+    get_type_of_chunk,
+    new_chunk,
+)
+
+# any known chunk type, searched in a single pass
+_TYPES_PATTERN = re.compile(b"|".join(re.escape(t) for t in sorted(CHUNKS_TYPES)))
+
+
+class Repair(NamedTuple):
+    """A damaged region of the stream"""
+
+    offset: int  # offset of the region in the data
+    length: int  # length of the region (up to the next valid chunk)
+    chunk_type: Optional[bytes]  # type of the rebuilt chunk, None if dropped
+    crc_ok: bool  # True if the stored CRC matches the rebuilt chunk
+
+
+def _crc_matches(view, start, length) -> bool:
+    """Check the CRC of the chunk starting at `start` (its length field)"""
+    end = start + 8 + length
+    crc = zlib.crc32(view[start + 4 : end]) & 0xFFFFFFFF
+    return view[end : end + 4] == crc.to_bytes(4, byteorder="big")
+
+
+def _valid_chunk_at(view, start, size) -> Optional[int]:
+    """Get the length of the chunk at `start` if it has a known type and a
+    valid CRC"""
+    if start + 12 > size or bytes(view[start + 4 : start + 8]) not in CHUNKS_TYPES:
+        return None
+    length = int.from_bytes(view[start : start + 4], byteorder="big")
+    if start + 12 + length > size or not _crc_matches(view, start, length):
+        return None
+    return length
+
+
+def _find_next_chunk(data, view, start, size) -> Tuple[int, int]:
+    """Find the next chunk with a known type and a valid CRC after `start`
+
+    Returns its offset and its length, or the size and -1 if there is none.
+    A candidate ending before the next known type is always checked: the
+    data of these candidates do not overlap. A candidate going over the next
+    known type is only checked if a known type (or the end of the data)
+    follows it, and these checks cover at most `size` bytes in total, so
+    garbage with many fake types and lengths is searched in linear time.
+    """
+    budget = size
+    matches = _TYPES_PATTERN.finditer(data, start + 5)
+    match = next(matches, None)
+    while match is not None:
+        following = next(matches, None)
+        chunk_start = match.start() - 4
+        length = int.from_bytes(data[chunk_start : match.start()], byteorder="big")
+        end = chunk_start + 12 + length
+        if end <= size:
+            if following is None or end <= following.start() - 4:
+                if _crc_matches(view, chunk_start, length):
+                    return chunk_start, length
+            elif length <= budget and (
+                end == size or bytes(view[end + 4 : end + 8]) in CHUNKS_TYPES
+            ):
+                budget -= length
+                if _crc_matches(view, chunk_start, length):
+                    return chunk_start, length
+        match = following
+    return size, -1
+
+
+def _gf2_times(matrix, vector) -> int:
+    """Multiply a 32x32 matrix over GF(2) (a list of columns) by a vector"""
+    result = 0
+    i = 0
+    while vector:
+        if vector & 1:
+            result ^= matrix[i]
+        vector >>= 1
+        i += 1
+    return result
+
+
+def _crc_shift_operator(length) -> List[int]:
+    """Matrix turning the CRC of some bytes into the CRC of these bytes
+    followed by `length` zero bytes (like zlib's crc32_combine)"""
+    # one zero bit: the CRC polynomial, then shifts
+    operator = [0xEDB88320] + [1 << n for n in range(31)]
+    for _ in range(3):
+        operator = [_gf2_times(operator, column) for column in operator]
+    result = [1 << n for n in range(32)]
+    while length:
+        if length & 1:
+            result = [_gf2_times(operator, column) for column in result]
+        length >>= 1
+        if length:
+            operator = [_gf2_times(operator, column) for column in operator]
+    return result
+
+
+def _find_type_of_crc(data, stored_crc) -> Optional[bytes]:
+    """Find the known type whose chunk with `data` has the stored CRC
+
+    The CRC of the data is computed once and combined with the CRC of each
+    type, so the data is read once whatever the number of types.
+    """
+    data_crc = zlib.crc32(data)
+    operator = _crc_shift_operator(len(data))
+    expected = int.from_bytes(stored_crc, byteorder="big")
+    for chunk_type in CHUNKS_TYPES:
+        # crc(type + data) = shift(crc(type), len(data)) ^ crc(data)
+        if _gf2_times(operator, zlib.crc32(chunk_type)) ^ data_crc == expected:
+            return chunk_type
+    return None
+
+
+def _rebuild_chunk(region, previous_type, next_type) -> Tuple[Optional[Chunk], bool]:
+    """Rebuild a chunk from a damaged region
+
+    The type of the region is kept if it is known. Otherwise it is the known
+    type matching the stored CRC, or IDAT (like `fix_chunk`) if the region
+    is in the middle of the IDAT chunks. Returns the chunk (None if the
+    region is dropped) and if the stored CRC matches it.
+    """
+    if len(region) < 12:
+        return None, False
+    chunk_type = bytes(region[4:8])
+    data = bytes(region[8:-4])
+    stored_crc = bytes(region[-4:])
+    if chunk_type not in CHUNKS_TYPES:
+        chunk_type = _find_type_of_crc(data, stored_crc)
+        if chunk_type is None:
+            if previous_type != b"IDAT" or next_type not in (b"IDAT", b"IEND"):
+                return None, False
+            chunk_type = b"IDAT"
+    crc = calculate_crc(chunk_type, data)
+    return new_chunk(len(data), chunk_type, data, crc, []), crc == stored_crc
+
+
+def repair_chunks(data, memory_limit=None) -> Tuple[List[Chunk], List[Repair]]:
+    """Split the chunks of damaged PNG data
+
+    `data`: content of the file (with or without the PNG signature)
+    `memory_limit`: maximum length of a chunk, defaults to `MEMORY_LIMIT`
+
+    After a chunk with a wrong length or type, the data is searched for the
+    next chunk with a known type and a valid CRC (all the types are searched
+    in a single pass). The damaged region before it is rebuilt as a chunk
+    with a valid CRC or dropped, see `_rebuild_chunk`. The search and the
+    rebuild read each byte a bounded number of times (see
+    `_find_next_chunk`), so the time is linear in the size of the data,
+    even for garbage made of fake chunk headers. A chunk with a
+    valid structure but a wrong CRC is kept as is, with the error.
+    Stops after IEND. Returns the chunks and the repaired regions.
+    """
+    limit = get_memory_limit(memory_limit)
+    if not isinstance(data, bytes):
+        data = bytes(data)
+    view = memoryview(data)
+    size = len(data)
+    position = 0
+    if data[: len(PNG_MAGIC)] == PNG_MAGIC:
+        position = len(PNG_MAGIC)
+    chunks: List[Chunk] = []
+    repairs = []
+    while position + 12 <= size:
+        length = _valid_chunk_at(view, position, size)
+        if length is None:
+            length = int.from_bytes(data[position : position + 4], byteorder="big")
+            chunk_type = data[position + 4 : position + 8]
+            end = position + 12 + length
+            if (
+                chunk_type in CHUNKS_TYPES
+                and end <= size
+                and (end == size or _valid_chunk_at(view, end, size) is not None)
+            ):
+                # the structure is fine, only the data or the CRC is damaged
+                errors = [ERROR_CODE["WRONG_CRC"]]
+            else:
+                next_start, next_length = _find_next_chunk(data, view, position, size)
+                next_type = None
+                if next_length >= 0:
+                    next_type = data[next_start + 4 : next_start + 8]
+                previous_type = None
+                if len(chunks) > 0:
+                    previous_type = get_type_of_chunk(chunks[-1])
+                region = view[position:next_start]
+                if len(region) - 12 > limit:
+                    raise ValueError(
+                        f"Chunk length {len(region) - 12} is over the memory limit"
+                        f" of {limit} bytes"
+                    )
+                chunk, crc_ok = _rebuild_chunk(region, previous_type, next_type)
+                chunk_type = None if chunk is None else get_type_of_chunk(chunk)
+                repairs.append(Repair(position, len(region), chunk_type, crc_ok))
+                if chunk is not None:
+                    chunks.append(chunk)
+                position = next_start
+                continue
+        else:
+            errors = []
+            chunk_type = data[position + 4 : position + 8]
+        if length > limit:
+            raise ValueError(
+                f"Chunk length {length} is over the memory limit of {limit} bytes"
+            )
+        chunk_data = data[position + 8 : position + 8 + length]
+        crc = data[position + 8 + length : position + 12 + length]
+        chunks.append(new_chunk(length, chunk_type, chunk_data, crc, errors))
+        position += 12 + length
+        if chunk_type == b"IEND":
+            break
+    return chunks, repairs
+
+
+def repair_file(filename: str, memory_limit=None) -> Tuple[List[Chunk], List[Repair]]:
+    """Read and repair the chunks of a damaged PNG file, see `repair_chunks`"""
+    with open(filename, "rb") as fp:
+        return repair_chunks(fp.read(), memory_limit)
+
+
+def print_repairs(repairs: List[Repair]):
+    """Print the repaired regions"""
+    for repair in repairs:
+        if repair.chunk_type is None:
+            action = "dropped"
+        else:
+            action = f"rebuilt as {repair.chunk_type.decode('latin-1')}"
+            if repair.crc_ok:
+                action += " (CRC confirmed)"
+        print(f"Damaged region at {repair.offset} ({repair.length} bytes): {action}")
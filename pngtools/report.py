@@ -0,0 +1,180 @@
+"""Machine-readable reports, one JSON record per line (NDJSON)"""
+
+import json
+from typing import Iterable, Iterator, List, Optional
+from .cache import ChunkEntry, scan_chunk_table
+from .lib import (
+    Chunk,
+    calculate_crc,
+    decode_phy,
+    get_crc_of_chunk,
+    get_data_of_chunk,
+    get_errors_of_chunk,
+    get_length_of_chunk,
+    get_type_of_chunk,
+    new_chunk,
+)
+from .metadata import TEXT_TYPES
+from .scan import _check_trailing_data, iter_png_files
+
+IHDR_FIELDS = (
+    "width",
+    "height",
+    "bit_depth",
+    "color_type",
+    "compression_method",
+    "filter_method",
+    "interlace_method",
+)
+
+PHYS_FIELDS = ("x_pixels_per_unit", "y_pixels_per_unit", "unit_specifier")
+
+
+def ihdr_record(ihdr) -> Optional[dict]:
+    """Fields of a decoded IHDR chunk (see decode_ihdr)"""
+    if ihdr is None:
+        return None
+    return dict(zip(IHDR_FIELDS, ihdr))
+
+
+def phys_record(phys) -> Optional[dict]:
+    """Fields of a decoded pHYs chunk (see decode_phy)"""
+    if phys is None:
+        return None
+    return dict(zip(PHYS_FIELDS, phys))
+
+
+def chunk_record(one_chunk: Chunk, index: int, filename=None) -> dict:
+    """Record of a chunk read in memory, with its errors"""
+    chunk_type = get_type_of_chunk(one_chunk)
+    crc = get_crc_of_chunk(one_chunk)
+    return {
+        "record": "chunk",
+        "file": filename,
+        "index": index,
+        "type": chunk_type.decode("latin-1"),
+        "length": get_length_of_chunk(one_chunk),
+        "crc": crc.hex(),
+        "crc_ok": crc == calculate_crc(chunk_type, get_data_of_chunk(one_chunk)),
+        "errors": list(get_errors_of_chunk(one_chunk)),
+    }
+
+
+def chunk_entry_record(entry: ChunkEntry, index: int, filename=None) -> dict:
+    """Record of a chunk of a chunk table, its data was not kept"""
+    return {
+        "record": "chunk",
+        "file": filename,
+        "index": index,
+        "offset": entry.offset,
+        "type": entry.chunk_type.decode("latin-1"),
+        "length": entry.length,
+        "crc_ok": entry.crc_ok,
+    }
+
+
+def iter_chunk_records(chunks: List[Chunk], filename=None) -> Iterator[dict]:
+    """Records of chunks read in memory (like the result of `read_file`)"""
+    for index, one_chunk in enumerate(chunks):
+        yield chunk_record(one_chunk, index, filename)
+
+
+def iter_file_records(filename: str) -> Iterator[dict]:
+    """Records of a file: a file record, then a record for each chunk
+
+    The file is read once to build the chunk table (the data is streamed to
+    check the CRC, never kept). The texts are counted and the IEND chunk is
+    found in the table, then only the pHYs chunk and at most
+    `TAIL_READ_SIZE` bytes at the start and at the end of the data after
+    IEND (for the acropalypse check) are read again.
+
+    The chunk table ends at the first IEND chunk: the data after it is
+    reported under "acropalypse", not as chunks.
+    """
+    table = scan_chunk_table(filename)
+    entries = table.chunks
+    iend_index = next(
+        (i for i, entry in enumerate(entries) if entry.chunk_type == b"IEND"), None
+    )
+    if iend_index is not None:
+        entries = entries[: iend_index + 1]
+    record = {
+        "record": "file",
+        "file": filename,
+        "size": table.size,
+        "signatures": table.signatures,
+        "ihdr": ihdr_record(table.ihdr),
+        "phys": None,
+        "texts": 0,
+        "chunks": len(entries),
+        "errors": sum(1 for entry in entries if not entry.crc_ok),
+        "acropalypse": None,
+    }
+    if table.signatures[:1] != [0]:
+        record["error"] = "File is not a PNG"
+        yield record
+        return
+    # complete chunks only, a truncated chunk ends the table
+    complete = [
+        entry for entry in entries if entry.offset + 12 + entry.length <= table.size
+    ]
+    record["texts"] = sum(1 for entry in complete if entry.chunk_type in TEXT_TYPES)
+    phys = next(
+        (
+            entry
+            for entry in complete
+            if entry.chunk_type == b"pHYs" and entry.length == 9
+        ),
+        None,
+    )
+    iend = next((entry for entry in complete if entry.chunk_type == b"IEND"), None)
+    if phys is not None or iend is not None:
+        with open(filename, "rb") as fp:
+            if phys is not None:
+                fp.seek(phys.offset + 8)
+                data = fp.read(9)
+                record["phys"] = phys_record(
+                    decode_phy(new_chunk(9, b"pHYs", data, b"", []))
+                )
+            if iend is not None:
+                check = _check_trailing_data(
+                    fp, filename, table.size, iend.offset + 12, 0
+                )
+                record["acropalypse"] = {
+                    "flagged": check.flagged,
+                    "iend_end": check.iend_end,
+                    "trailing": check.trailing,
+                    "idat_markers": check.idat_markers,
+                    "ends_with_iend": check.ends_with_iend,
+                    "appended_png": check.appended_png,
+                }
+    yield record
+    for index, entry in enumerate(entries):
+        yield chunk_entry_record(entry, index, filename)
+
+
+def iter_records(paths: List[str]) -> Iterator[dict]:
+    """Records of many files (and the PNG files of directories), one file
+    at a time"""
+    for filename in iter_png_files(paths):
+        try:
+            yield from iter_file_records(filename)
+        except OSError as e:
+            yield {"record": "file", "file": filename, "error": str(e)}
+
+
+def write_records(records: Iterable[dict], fp) -> int:
+    """Write records as NDJSON, as they come
+
+    Each record is written on its own line, and the output is flushed
+    before each file record, so it can be piped while the records are
+    produced. Returns the number of records.
+    """
+    count = 0
+    for record in records:
+        if record["record"] == "file":
+            fp.flush()
+        fp.write(json.dumps(record, separators=(",", ":")) + "\n")
+        count += 1
+    fp.flush()
+    return count
@@ -0,0 +1,251 @@
+"""Scan of many files for acropalypse (data left after the end of the image)
+and for duplicates"""
+
+from concurrent.futures import ProcessPoolExecutor
+from os import SEEK_END, SEEK_SET, walk
+from os.path import isdir, join
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+from .diff import read_chunk_headers
+from .hashing import ImageHashes, hash_file
+from .recover import recover_acropalypse
+from .lib import (
+    PNG_MAGIC,
+    Chunk,
+    decode_ihdr,
+    new_chunk,
+)
+
+# maximum number of bytes read at the end of a file
+TAIL_READ_SIZE = 64 * 1024
+
+# extensions of the files scanned in directories
+PNG_EXTENSIONS = (".png", ".PNG")
+
+_IEND_CHUNK = b"\x00\x00\x00\x00IEND\xaeB`\x82"
+
+
+class AcropalypseCheck(NamedTuple):
+    """Result of the check of a file"""
+
+    filename: str
+    size: int
+    iend_end: Optional[int]  # end of the first IEND chunk, None if there is none
+    trailing: int  # number of bytes after the first IEND chunk
+    idat_markers: int  # IDAT chunk types found in the bytes read after IEND
+    ends_with_iend: bool  # the file ends with a second IEND chunk
+    appended_png: bool  # the trailing data is a whole PNG file
+    bytes_read: int
+    error: Optional[str] = None  # the file cannot be read
+
+    @property
+    def flagged(self) -> bool:
+        """The trailing data looks like the end of a bigger PNG image"""
+        if self.trailing == 0 or self.appended_png:
+            return False
+        return self.idat_markers > 0 or self.ends_with_iend
+
+
+def check_acropalypse(filename: str, tail_read_size=TAIL_READ_SIZE):
+    """Check if a file has PNG data after its IEND chunk
+
+    Only the chunk headers are read to find the first IEND chunk (the data
+    is skipped with seek), then at most `tail_read_size` bytes at the start
+    and at the end of the trailing data. A file which cannot be read is not
+    flagged, the error is returned.
+    """
+    try:
+        with open(filename, "rb") as fp:
+            return _check_file(fp, filename, tail_read_size)
+    except OSError as e:
+        return AcropalypseCheck(filename, 0, None, 0, 0, False, False, 0, str(e))
+
+
+def _check_file(fp, filename: str, tail_read_size) -> AcropalypseCheck:
+    """Check an open file, see `check_acropalypse`"""
+    size = fp.seek(0, SEEK_END)
+    try:
+        headers = read_chunk_headers(fp, stop_at=b"IEND")
+    except ValueError:
+        return AcropalypseCheck(filename, size, None, 0, 0, False, False, 0)
+    # signature, then the header and CRC of each chunk
+    bytes_read = 8 + 12 * len(headers)
+    if len(headers) == 0 or headers[-1].chunk_type != b"IEND":
+        return AcropalypseCheck(filename, size, None, 0, 0, False, False, bytes_read)
+    iend_end = headers[-1].offset + 12
+    return _check_trailing_data(
+        fp, filename, size, iend_end, bytes_read, tail_read_size
+    )
+
+
+def _check_trailing_data(
+    fp, filename: str, size, iend_end, bytes_read, tail_read_size=TAIL_READ_SIZE
+) -> AcropalypseCheck:
+    """Check the data after the IEND chunk ending at `iend_end`, reading at
+    most `tail_read_size` bytes at its start and at its end"""
+    trailing = size - iend_end
+    if trailing <= 0:
+        return AcropalypseCheck(
+            filename, size, iend_end, 0, 0, False, False, bytes_read
+        )
+    fp.seek(iend_end, SEEK_SET)
+    head = fp.read(min(trailing, tail_read_size))
+    tail = b""
+    if trailing > len(head):
+        tail_start = max(iend_end + len(head), size - tail_read_size)
+        fp.seek(tail_start, SEEK_SET)
+        tail = fp.read()
+    bytes_read += len(head) + len(tail)
+    idat_markers = head.count(b"IDAT") + tail.count(b"IDAT")
+    ends_with_iend = (head + tail).endswith(_IEND_CHUNK)
+    return AcropalypseCheck(
+        filename,
+        size,
+        iend_end,
+        trailing,
+        idat_markers,
+        ends_with_iend,
+        head.startswith(PNG_MAGIC),
+        bytes_read,
+    )
+
+
+def iter_png_files(paths: List[str]) -> Iterator[str]:
+    """Find the PNG files of a list of files and directories"""
+    for path in paths:
+        if not isdir(path):
+            yield path
+            continue
+        for root, _, filenames in walk(path):
+            for filename in sorted(filenames):
+                if filename.endswith(PNG_EXTENSIONS):
+                    yield join(root, filename)
+
+
+def scan_acropalypse(
+    paths: List[str], workers=None, tail_read_size=TAIL_READ_SIZE
+) -> List[AcropalypseCheck]:
+    """Check many files (and the PNG files of directories) in parallel"""
+    filenames = list(iter_png_files(paths))
+    if len(filenames) == 0:
+        return []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(
+            executor.map(
+                check_acropalypse,
+                filenames,
+                [tail_read_size] * len(filenames),
+                chunksize=16,
+            )
+        )
+
+
+def get_trailing_chunks(trailing: bytes) -> List[Chunk]:
+    """Split the data after IEND into the IDAT pieces of the original image
+
+    The first piece is the end of the data of a truncated IDAT chunk,
+    without its CRC. The IDAT chunks after it are complete.
+    """
+    markers = []
+    idx = trailing.find(b"IDAT", 4)
+    while idx != -1:
+        markers.append(idx)
+        idx = trailing.find(b"IDAT", idx + 4)
+    end_first = markers[0] - 8 if len(markers) > 0 else len(trailing) - 16
+    chunks = [new_chunk(end_first, b"IDAT", trailing[:end_first], b"", [])]
+    for idx in markers:
+        length = int.from_bytes(trailing[idx - 4 : idx], byteorder="big")
+        data = trailing[idx + 4 : idx + 4 + length]
+        crc = trailing[idx + 4 + length : idx + 8 + length]
+        chunks.append(new_chunk(length, b"IDAT", data, crc, []))
+    return chunks
+
+
+def reconstruct_acropalypse(
+    filename: str,
+    orig_width=None,
+    orig_height=None,
+    check: Optional[AcropalypseCheck] = None,
+):
+    """Recover the pixels of the data after the IEND chunk of a file
+
+    Only the IHDR chunk and the trailing data are read. The dimensions which
+    are not given are inferred, see `recover_acropalypse`. Returns the width,
+    the height and the pixel values of the original image (the unknown part
+    is filled), or (None, None, None) if nothing was found.
+    """
+    if check is None:
+        check = check_acropalypse(filename)
+    if not check.flagged:
+        return None, None, None
+    with open(filename, "rb") as fp:
+        fp.seek(16, SEEK_SET)
+        ihdr = decode_ihdr(fp.read(13))
+        fp.seek(check.iend_end, SEEK_SET)
+        trailing = fp.read()
+    _, _, bit_depth, color_type, _, _, _ = ihdr
+    chunks = get_trailing_chunks(trailing)
+    return recover_acropalypse(chunks, bit_depth, color_type, orig_width, orig_height)
+
+
+def print_checks(checks: List[AcropalypseCheck]):
+    """Print the flagged files (and the unreadable files) of a scan"""
+    flagged = 0
+    for check in checks:
+        if check.error is not None:
+            print(f"{check.filename}: error: {check.error}")
+            continue
+        if not check.flagged:
+            continue
+        flagged += 1
+        iend = " and a second IEND" if check.ends_with_iend else ""
+        print(
+            f"{check.filename}: {check.trailing} bytes after IEND,"
+            f" {check.idat_markers} IDAT{iend}"
+        )
+    print(f"{flagged} of {len(checks)} files flagged")
+
+
+def _hash_file(filename: str) -> Optional[ImageHashes]:
+    """Hash a file (runs in a worker process), None if it cannot be read"""
+    try:
+        return hash_file(filename)
+    except (OSError, ValueError):
+        return None
+
+
+def scan_hashes(
+    paths: List[str], workers=None
+) -> List[Tuple[str, Optional[ImageHashes]]]:
+    """Hash many files (and the PNG files of directories) in parallel, see
+    `hash_stream`"""
+    filenames = list(iter_png_files(paths))
+    if len(filenames) == 0:
+        return []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(zip(filenames, executor.map(_hash_file, filenames, chunksize=16)))
+
+
+def find_duplicates(
+    hashes: List[Tuple[str, Optional[ImageHashes]]], field="pixels"
+) -> List[List[str]]:
+    """Group the files with the same hash (`pixels`, `structure`, `ahash`
+    or `dhash`), only the groups of several files are returned"""
+    groups: Dict[str, List[str]] = {}
+    for filename, file_hashes in hashes:
+        if file_hashes is None or getattr(file_hashes, field) is None:
+            continue
+        groups.setdefault(getattr(file_hashes, field), []).append(filename)
+    return [group for group in groups.values() if len(group) > 1]
+
+
+def print_hashes(hashes: List[Tuple[str, Optional[ImageHashes]]]):
+    """Print the hashes of the files"""
+    for filename, file_hashes in hashes:
+        if file_hashes is None:
+            print(f"{filename}: not a PNG file")
+            continue
+        print(
+            f"{filename}: structure={file_hashes.structure}"
+            f" pixels={file_hashes.pixels}"
+            f" ahash={file_hashes.ahash} dhash={file_hashes.dhash}"
+        )
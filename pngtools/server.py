@@ -0,0 +1,361 @@
+"""Local HTTP analysis service
+
+POST a PNG file to /analyze (optionally ?decode=ppm or ?decode=bmp) to get a
+JSON analysis, GET /metrics for the latency and the throughput.
+"""
+
+import base64
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+from os import cpu_count
+import threading
+import time
+from typing import Optional
+from urllib.parse import parse_qs, urlsplit
+import zlib
+from .bmp import bmp_headers, get_planes, png_to_bmp_data
+from .lib import (
+    calculate_decompressed_length,
+    decode_ihdr,
+    decode_phy,
+    get_data_of_chunk,
+    get_errors_of_chunk,
+    get_type_of_chunk,
+    iter_chunks,
+    parse_idat,
+    try_decompress,
+)
+from .ppm import convert_row_to_rgb
+from .report import chunk_record, ihdr_record, phys_record
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8000
+
+# largest request body accepted
+MAX_BODY_SIZE = 64 * 1024 * 1024
+
+# largest decompressed image data, in bytes
+MAX_DECODED_SIZE = 256 * 1024 * 1024
+
+# deflate expands data at most 1032 times, a larger expected length cannot
+# come from the body
+MAX_DEFLATE_RATIO = 1032
+
+# number of latencies kept for the percentiles
+LATENCY_WINDOW = 1024
+
+DECODE_FORMATS = ("ppm", "bmp")
+
+
+class Metrics:
+    """Request counters and latencies, shared by the handler threads"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.start = time.monotonic()
+        self.requests = 0
+        self.errors = 0
+        self.bytes_received = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+
+    def record(self, status: int, latency: float, size: int):
+        """Record a request"""
+        with self._lock:
+            self.requests += 1
+            if status >= 400:
+                self.errors += 1
+            self.bytes_received += size
+            self.latencies.append(latency)
+
+    def snapshot(self) -> dict:
+        """Get the metrics, latencies in milliseconds"""
+        with self._lock:
+            latencies = sorted(self.latencies)
+            uptime = time.monotonic() - self.start
+            snapshot = {
+                "uptime": uptime,
+                "requests": self.requests,
+                "errors": self.errors,
+                "bytes_received": self.bytes_received,
+                "requests_per_second": self.requests / uptime if uptime > 0 else 0.0,
+            }
+        for name, fraction in (("p50", 0.5), ("p95", 0.95), ("max", 1.0)):
+            value = None
+            if latencies:
+                index = min(len(latencies) - 1, int(fraction * len(latencies)))
+                value = latencies[index] * 1000
+            snapshot[f"latency_{name}_ms"] = value
+        return snapshot
+
+
+class _BodyReader:
+    """Read at most `size` bytes of a request body"""
+
+    def __init__(self, stream, size):
+        self.stream = stream
+        self.remaining = size
+
+    def read(self, size=-1) -> bytes:
+        """Read up to `size` bytes, without going over the body"""
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.stream.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def drain(self):
+        """Read the rest of the body, to keep the connection usable"""
+        while self.remaining > 0 and len(self.read(64 * 1024)) > 0:
+            pass
+
+
+def analyze_stream(stream, memory_limit=None):
+    """Read the chunks of a PNG stream, as they come
+
+    Returns the analysis, the IHDR fields and the compressed IDAT data.
+    Only the IDAT data is kept, to be decoded by `decode_image`.
+    """
+    chunks = []
+    ihdr = None
+    phys = None
+    texts = 0
+    errors = 0
+    idat = []
+    for index, one_chunk in enumerate(iter_chunks(stream, memory_limit=memory_limit)):
+        chunk_type = get_type_of_chunk(one_chunk)
+        data = get_data_of_chunk(one_chunk)
+        chunks.append(chunk_record(one_chunk, index))
+        if get_errors_of_chunk(one_chunk):
+            errors += 1
+        if chunk_type == b"IHDR" and ihdr is None and len(data) == 13:
+            ihdr = decode_ihdr(data)
+        elif chunk_type == b"pHYs" and phys is None and len(data) == 9:
+            phys = decode_phy(one_chunk)
+        elif chunk_type in (b"tEXt", b"zTXt", b"iTXt"):
+            texts += 1
+        elif chunk_type == b"IDAT":
+            idat.append(data)
+    analysis = {
+        "ihdr": ihdr_record(ihdr),
+        "phys": phys_record(phys),
+        "texts": texts,
+        "errors": errors,
+        "chunks": chunks,
+    }
+    return analysis, ihdr, b"".join(idat)
+
+
+def _ppm_data(width, height, bit_depth, color_type, pixels) -> bytes:
+    """Binary PPM file of RGB or RGBA pixels"""
+    if color_type not in (2, 6) or bit_depth not in (8, 16):
+        raise NotImplementedError("Only RGB and RGBA images can be converted to PPM")
+    bytes_per_sample = bit_depth // 8
+    bytes_per_pixel = (4 if color_type == 6 else 3) * bytes_per_sample
+    header = f"P6\n{width} {height}\n{(1 << bit_depth) - 1}\n".encode("utf-8")
+    return header + convert_row_to_rgb(pixels, bytes_per_pixel, bytes_per_sample)
+
+
+def _bmp_data(width, height, bit_depth, color_type, pixels) -> bytes:
+    """BMP file of 8-bit pixels"""
+    if bit_depth != 8:
+        raise NotImplementedError("Only 8-bit images can be converted to BMP")
+    planes = sum(get_planes(color_type))
+    pixel_data = png_to_bmp_data(width, height, bit_depth, color_type, pixels)
+    return bmp_headers(width, height, bit_depth, planes, len(pixel_data)) + pixel_data
+
+
+def decode_image(ihdr, idat_data, decode=None, memory_limit=MAX_DECODED_SIZE):
+    """Decompress (and optionally decode) the image data (runs in a worker
+    process)
+
+    Returns the analysis of the image data and the decoded file (or None).
+    Raises ValueError when the image data needs more than `memory_limit`
+    bytes, or more than the compressed data can produce, so nothing is
+    allocated for an IHDR of huge dimensions in a small body.
+    """
+    width, height, bit_depth, color_type, _, _, interlace_method = ihdr
+    analysis = {"compressed_length": len(idat_data)}
+    try:
+        expected_length = calculate_decompressed_length(
+            width, height, bit_depth, color_type, interlace_method
+        )
+    except ValueError as e:
+        analysis["error"] = str(e)
+        return analysis, None
+    analysis["expected_length"] = expected_length
+    memory_limit = min(memory_limit, MAX_DEFLATE_RATIO * len(idat_data))
+    decompressed = try_decompress(
+        idat_data, expected_length=expected_length, memory_limit=memory_limit
+    )
+    if decompressed is None:
+        analysis["error"] = "The image data cannot be decompressed"
+        return analysis, None
+    analysis["decompressed_length"] = len(decompressed)
+    if decode is None:
+        return analysis, None
+    try:
+        pixels = parse_idat(
+            decompressed,
+            width,
+            height,
+            bit_depth,
+            color_type,
+            interlace_method,
+            raise_error=False,
+        )
+        if decode == "ppm":
+            return analysis, _ppm_data(width, height, bit_depth, color_type, pixels)
+        return analysis, _bmp_data(width, height, bit_depth, color_type, pixels)
+    except (NotImplementedError, ValueError) as e:
+        analysis["error"] = str(e)
+        return analysis, None
+
+
+def _warm_up():
+    """Task run once by each worker when the server starts"""
+    return zlib.crc32(b"")
+
+
+class AnalysisHandler(BaseHTTPRequestHandler):
+    """Handler of the analysis requests, the connections are kept alive"""
+
+    protocol_version = "HTTP/1.1"
+    server: "AnalysisServer"
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _send_json(self, status: int, content: dict):
+        """Send a JSON response"""
+        body = json.dumps(content).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if self.close_connection:
+            self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        """Get the metrics"""
+        start = time.monotonic()
+        if urlsplit(self.path).path == "/metrics":
+            status = 200
+            self._send_json(status, self.server.metrics.snapshot())
+        else:
+            status = 404
+            self._send_json(status, {"error": "Not found"})
+        self.server.metrics.record(status, time.monotonic() - start, 0)
+
+    def do_POST(self):
+        """Analyze a PNG file"""
+        start = time.monotonic()
+        status, content, size = self._analyze()
+        self._send_json(status, content)
+        self.server.metrics.record(status, time.monotonic() - start, size)
+
+    def _analyze(self):
+        """Read and analyze the request body, returns (status, content, size)"""
+        url = urlsplit(self.path)
+        if url.path != "/analyze":
+            self.close_connection = True
+            return 404, {"error": "Not found"}, 0
+        decode = parse_qs(url.query).get("decode", [None])[0]
+        if decode is not None and decode not in DECODE_FORMATS:
+            self.close_connection = True
+            return 400, {"error": f"Unknown decode format: {decode}"}, 0
+        length = self.headers.get("Content-Length")
+        if length is None:
+            self.close_connection = True
+            return 411, {"error": "Content-Length is required"}, 0
+        if not length.strip().isdigit():
+            self.close_connection = True
+            return 400, {"error": f"Invalid Content-Length: {length}"}, 0
+        size = int(length)
+        if size > self.server.max_body_size:
+            # the body is not read
+            self.close_connection = True
+            return 413, {"error": f"Body over {self.server.max_body_size} bytes"}, 0
+        body = _BodyReader(self.rfile, size)
+        try:
+            analysis, ihdr, idat_data = analyze_stream(body, self.server.max_body_size)
+        except ValueError as e:
+            body.drain()
+            return 400, {"error": str(e)}, size
+        body.drain()
+        if ihdr is not None and len(idat_data) > 0:
+            try:
+                image, decoded = self.server.run(
+                    decode_image, ihdr, idat_data, decode, self.server.memory_limit
+                )
+            except ValueError as e:
+                return 413, {"error": str(e)}, size
+            analysis["image"] = image
+            if decoded is not None:
+                analysis["decoded"] = {
+                    "format": decode,
+                    "data": base64.b64encode(decoded).decode("ascii"),
+                }
+        return 200, analysis, size
+
+
+class AnalysisServer(ThreadingHTTPServer):
+    """Threaded HTTP server, the image data is decoded in a process pool
+    started with the server (`workers=0` to decode in the handler threads)
+
+    `memory_limit`: largest decompressed image data of a request
+    """
+
+    def __init__(
+        self,
+        address=(DEFAULT_HOST, DEFAULT_PORT),
+        workers: Optional[int] = None,
+        max_body_size=MAX_BODY_SIZE,
+        verbose=False,
+        memory_limit=MAX_DECODED_SIZE,
+    ):
+        super().__init__(address, AnalysisHandler)
+        self.max_body_size = max_body_size
+        self.memory_limit = memory_limit
+        self.verbose = verbose
+        self.metrics = Metrics()
+        self.executor = None
+        if workers != 0:
+            workers = workers or cpu_count() or 1
+            self.executor = ProcessPoolExecutor(max_workers=workers)
+            # start the worker processes now, not on the first request
+            warm_up = [self.executor.submit(_warm_up) for _ in range(workers)]
+            for future in warm_up:
+                future.result()
+
+    def run(self, function, *args):
+        """Run a function in the process pool (in this thread without workers)"""
+        if self.executor is None:
+            return function(*args)
+        return self.executor.submit(function, *args).result()
+
+    def server_close(self):
+        super().server_close()
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
+def serve(
+    host=DEFAULT_HOST,
+    port=DEFAULT_PORT,
+    workers: Optional[int] = None,
+    max_body_size=MAX_BODY_SIZE,
+    memory_limit=MAX_DECODED_SIZE,
+):
+    """Run the analysis server until interrupted"""
+    with AnalysisServer(
+        (host, port), workers, max_body_size, True, memory_limit
+    ) as server:
+        print(f"Serving on http://{host}:{server.server_address[1]}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print("Stopped")
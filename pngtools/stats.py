@@ -0,0 +1,178 @@
+"""Image statistics accumulated during the streaming decode"""
+
+from collections import Counter
+from typing import List, NamedTuple, Optional, Set
+from .lib import (
+    decode_ihdr,
+    get_bytes_per_pixel,
+    get_data_of_chunk,
+    get_type_of_chunk,
+    iter_chunks,
+    iter_scanlines,
+)
+
+# the unique colors are not counted over this number
+MAX_UNIQUE_COLORS = 256
+
+# samples of each pixel, and if the last one is alpha
+_CHANNELS = {0: (1, False), 2: (3, False), 4: (2, True), 6: (4, True)}
+
+# array types of the pixel sizes which are a machine integer
+_CAST_FORMATS = {1: "B", 2: "H", 4: "I", 8: "Q"}
+
+
+class ImageStats(NamedTuple):
+    """Statistics of the pixels of an image"""
+
+    width: int
+    height: int
+    bit_depth: int
+    color_type: int
+    # histogram of each channel (of the most significant byte of 16-bit samples)
+    histograms: List[List[int]]
+    unique_colors: Optional[int]  # None when over the maximum
+    opaque: Optional[bool]  # all alpha values are the maximum, None without alpha
+    binary_alpha: Optional[bool]  # all alpha values are 0 or the maximum
+    gray: Optional[bool]  # R == G == B for all the pixels, None for gray images
+
+
+class StatsAccumulator:
+    """Accumulate the statistics of an image one scanline at a time
+
+    Every statistic is computed on whole channels of the row (slices,
+    `Counter` and set updates run in C), never with a loop on the pixels.
+    The unique colors are tracked in a set which is dropped as soon as it
+    has more than `max_colors` colors, so the memory is bounded.
+    """
+
+    def __init__(
+        self, width, height, bit_depth, color_type, max_colors=MAX_UNIQUE_COLORS
+    ):
+        self.width = width
+        self.height = height
+        self.bit_depth = bit_depth
+        self.color_type = color_type
+        self.max_colors = max_colors
+        self.bpp = get_bytes_per_pixel(bit_depth, color_type)
+        self.bytes_per_sample = bit_depth // 8
+        self.channels, self.has_alpha = _CHANNELS[color_type]
+        self.counters = [Counter() for _ in range(self.channels)]
+        self.colors: Optional[Set] = set()
+        self.opaque = self.has_alpha
+        self.binary_alpha = self.has_alpha
+        self.gray = self.channels >= 3
+
+    def add_row(self, row):
+        """Add the pixels of a scanline"""
+        bpp = self.bpp
+        size = self.bytes_per_sample
+        for channel, counter in enumerate(self.counters):
+            counter.update(row[channel * size :: bpp])
+        if self.colors is not None:
+            cast_format = _CAST_FORMATS.get(bpp)
+            if cast_format is not None:
+                self.colors.update(memoryview(row).cast(cast_format))
+            else:
+                self.colors.update(zip(*(row[i::bpp] for i in range(bpp))))
+            if len(self.colors) > self.max_colors:
+                self.colors = None
+        if self.binary_alpha:
+            start = (self.channels - 1) * size
+            # alpha values as tuples of bytes (a single byte for 8-bit)
+            values = set(zip(*(row[start + i :: bpp] for i in range(size))))
+            values.discard((255,) * size)
+            if values:
+                self.opaque = False
+                values.discard((0,) * size)
+                if values:
+                    self.binary_alpha = False
+        if self.gray:
+            self.gray = all(
+                row[i::bpp] == row[size + i :: bpp] == row[2 * size + i :: bpp]
+                for i in range(size)
+            )
+
+    def result(self) -> ImageStats:
+        """Get the statistics of the rows added"""
+        histograms = [
+            [counter.get(value, 0) for value in range(256)] for counter in self.counters
+        ]
+        return ImageStats(
+            self.width,
+            self.height,
+            self.bit_depth,
+            self.color_type,
+            histograms,
+            None if self.colors is None else len(self.colors),
+            self.opaque if self.has_alpha else None,
+            self.binary_alpha if self.has_alpha else None,
+            self.gray if self.channels >= 3 else None,
+        )
+
+
+def compute_stats(idat_data, ihdr, max_colors=MAX_UNIQUE_COLORS) -> ImageStats:
+    """Compute the statistics of an image, decoding one scanline at a time
+
+    `idat_data`: compressed data, or an iterable of compressed pieces
+    `ihdr`: fields of the IHDR chunk (see decode_ihdr)
+    """
+    width, height, bit_depth, color_type, _, _, interlace_method = ihdr
+    accumulator = StatsAccumulator(width, height, bit_depth, color_type, max_colors)
+    for row in iter_scanlines(
+        idat_data, width, height, bit_depth, color_type, interlace_method
+    ):
+        accumulator.add_row(row)
+    return accumulator.result()
+
+
+def stats_file(filename: str, max_colors=MAX_UNIQUE_COLORS) -> ImageStats:
+    """Compute the statistics of a PNG file, the IDAT chunks are read as the
+    scanlines are decoded"""
+    with open(filename, "rb") as fp:
+        chunks = iter_chunks(fp, stop_at=b"IEND")
+        ihdr = None
+        first_idat = None
+        for one_chunk in chunks:
+            chunk_type = get_type_of_chunk(one_chunk)
+            if (
+                chunk_type == b"IHDR"
+                and ihdr is None
+                and len(get_data_of_chunk(one_chunk)) == 13
+            ):
+                ihdr = decode_ihdr(get_data_of_chunk(one_chunk))
+            elif chunk_type == b"IDAT":
+                first_idat = get_data_of_chunk(one_chunk)
+                break
+        if ihdr is None or first_idat is None:
+            raise ValueError("No image data")
+
+        def iter_idat():
+            yield first_idat
+            for one_chunk in chunks:
+                if get_type_of_chunk(one_chunk) != b"IDAT":
+                    return
+                yield get_data_of_chunk(one_chunk)
+
+        return compute_stats(iter_idat(), ihdr, max_colors)
+
+
+def print_stats(stats: ImageStats):
+    """Print the statistics and the possible conversions"""
+    names = {0: "YA", 2: "RGB", 4: "YA", 6: "RGBA"}[stats.color_type]
+    for name, histogram in zip(names, stats.histograms):
+        used = sum(1 for count in histogram if count > 0)
+        low = next(i for i, count in enumerate(histogram) if count > 0)
+        high = max(i for i, count in enumerate(histogram) if count > 0)
+        print(f"Channel {name}: {used} values used, from {low} to {high}")
+    if stats.unique_colors is None:
+        print(f"Unique colors: more than {MAX_UNIQUE_COLORS}")
+    else:
+        print(f"Unique colors: {stats.unique_colors}")
+        if stats.bit_depth == 8:
+            print("The image can be converted to a palette")
+    if stats.opaque:
+        print("The alpha channel is fully opaque, it can be removed")
+    elif stats.binary_alpha:
+        print("The alpha values are only 0 and the maximum (tRNS is enough)")
+    if stats.gray:
+        print("All the pixels are gray, the image can be converted to grayscale")
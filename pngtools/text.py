@@ -0,0 +1,202 @@
+"""Text chunks (tEXt, zTXt and iTXt) and a text index of many files"""
+
+from concurrent.futures import ProcessPoolExecutor
+from os import replace, stat
+from os.path import abspath
+import json
+from typing import Dict, List, Optional, Tuple
+from .lib import (
+    Chunk,
+    get_data_of_chunk,
+    get_type_of_chunk,
+    try_decompress,
+)
+from .metadata import TEXT_TYPES, inspect_file
+
+
+class TextChunk:
+    """Text chunk, the keyword is parsed but the value is only decoded
+    (and inflated for compressed chunks) when it is read"""
+
+    def __init__(self, chunk_type: bytes, data: bytes):
+        if chunk_type not in TEXT_TYPES:
+            raise ValueError(f"Not a text chunk: {chunk_type}")
+        self.chunk_type = chunk_type
+        self.language = ""
+        self.translated_keyword = ""
+        self.compressed = False
+        separator = data.find(b"\x00")
+        if separator == -1:
+            raise ValueError("Text chunk without keyword separator")
+        self.keyword = data[:separator].decode("latin-1")
+        rest = data[separator + 1 :]
+        if chunk_type == b"zTXt":
+            # compression method, then the compressed text
+            self.compressed = True
+            rest = rest[1:]
+        elif chunk_type == b"iTXt":
+            # compression flag, compression method, language tag,
+            # translated keyword, then the text
+            self.compressed = rest[0:1] == b"\x01"
+            language, translated_keyword, rest = rest[2:].split(b"\x00", 2)
+            self.language = language.decode("latin-1")
+            self.translated_keyword = translated_keyword.decode("utf-8", "replace")
+        self._raw_value = rest
+        self._value = None
+
+    @property
+    def value(self) -> str:
+        """Text of the chunk, inflated on the first access"""
+        if self._value is None:
+            raw_value = self._raw_value
+            if self.compressed:
+                raw_value = try_decompress(raw_value)
+                if raw_value is None:
+                    raise ValueError(f"Invalid compressed text for {self.keyword}")
+            encoding = "utf-8" if self.chunk_type == b"iTXt" else "latin-1"
+            self._value = bytes(raw_value).decode(encoding, "replace")
+        return self._value
+
+    def __repr__(self):
+        return f"TextChunk({self.chunk_type!r}, {self.keyword!r})"
+
+
+def decode_text_chunk(chunk: Chunk) -> TextChunk:
+    """Decode a text chunk (tEXt, zTXt or iTXt)"""
+    return TextChunk(get_type_of_chunk(chunk), get_data_of_chunk(chunk))
+
+
+def get_text_chunks(chunks: List[Chunk]) -> List[TextChunk]:
+    """Decode the valid text chunks of a list of chunks"""
+    texts = []
+    for one_chunk in chunks:
+        if get_type_of_chunk(one_chunk) in TEXT_TYPES:
+            try:
+                texts.append(decode_text_chunk(one_chunk))
+            except ValueError as e:
+                print(e)
+    return texts
+
+
+def read_texts(filename: str) -> List[Tuple[str, str]]:
+    """Read the (keyword, value) of the text chunks of a file
+
+    Only the metadata of the file is read, see `inspect_file`
+    """
+    texts = []
+    for chunk_type, data in inspect_file(filename).texts:
+        try:
+            text = TextChunk(chunk_type, data)
+            texts.append((text.keyword, text.value))
+        except ValueError:
+            continue
+    return texts
+
+
+def _index_file(filename: str):
+    """Read the texts of a file for the index (runs in a worker process)"""
+    try:
+        file_stat = stat(filename)
+        texts = read_texts(filename)
+    except (OSError, ValueError):
+        return filename, None, []
+    return filename, [file_stat.st_size, file_stat.st_mtime_ns], texts
+
+
+class TextIndex:
+    """Index of the texts of many files, can be saved to a JSON file
+
+    Files already indexed are only read again if their size or modification
+    time changed
+    """
+
+    def __init__(self):
+        # path -> {"stat": [size, mtime_ns], "texts": [[keyword, value], ...]}
+        self.files: Dict[str, dict] = {}
+
+    def add_files(self, filenames: List[str], workers: Optional[int] = None):
+        """Index the texts of files in parallel, returns the number of files read"""
+        to_read = []
+        for filename in filenames:
+            filename = abspath(filename)
+            entry = self.files.get(filename)
+            try:
+                file_stat = stat(filename)
+            except OSError:
+                self.files.pop(filename, None)
+                continue
+            if entry is None or entry["stat"] != [
+                file_stat.st_size,
+                file_stat.st_mtime_ns,
+            ]:
+                to_read.append(filename)
+        if len(to_read) == 0:
+            return 0
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for filename, file_stat, texts in executor.map(
+                _index_file, to_read, chunksize=16
+            ):
+                if file_stat is None:
+                    self.files.pop(filename, None)
+                    continue
+                self.files[filename] = {
+                    "stat": file_stat,
+                    "texts": [list(text) for text in texts],
+                }
+        return len(to_read)
+
+    def search(
+        self, keyword: Optional[str] = None, contains: Optional[str] = None
+    ) -> List[Tuple[str, str, str]]:
+        """Search the texts with a given keyword and/or containing a string
+
+        Returns a list of (path, keyword, value)
+        """
+        results = []
+        for filename, entry in self.files.items():
+            for text_keyword, value in entry["texts"]:
+                if keyword is not None and text_keyword != keyword:
+                    continue
+                if contains is not None and contains not in value:
+                    continue
+                results.append((filename, text_keyword, value))
+        return results
+
+    def keywords(self) -> Dict[str, int]:
+        """Count the files using each keyword"""
+        counts: Dict[str, int] = {}
+        for entry in self.files.values():
+            for text_keyword in {text_keyword for text_keyword, _ in entry["texts"]}:
+                counts[text_keyword] = counts.get(text_keyword, 0) + 1
+        return counts
+
+    def save(self, filename: str):
+        """Save the index to a JSON file"""
+        tmp_filename = filename + ".tmp"
+        with open(tmp_filename, "w", encoding="utf-8") as f:
+            json.dump(self.files, f)
+        replace(tmp_filename, filename)
+
+    @classmethod
+    def load(cls, filename: str) -> "TextIndex":
+        """Load an index saved with `save`"""
+        index = cls()
+        with open(filename, "r", encoding="utf-8") as f:
+            index.files = json.load(f)
+        return index
+
+
+def build_text_index(
+    filenames: List[str], index_file: Optional[str] = None, workers=None
+) -> TextIndex:
+    """Build the text index of files, reusing and updating `index_file` if given"""
+    index = TextIndex()
+    if index_file is not None:
+        try:
+            index = TextIndex.load(index_file)
+        except (OSError, ValueError):
+            pass
+    index.add_files(filenames, workers)
+    if index_file is not None:
+        index.save(index_file)
+    return index
@@ -0,0 +1,212 @@
+"""Incremental processing of the PNG files of a directory tree"""
+
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
+from os import makedirs, scandir
+from os.path import abspath, dirname, join
+import sqlite3
+import time
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+from .cache import DEFAULT_CACHE_DIR
+from .report import iter_file_records
+from .scan import PNG_EXTENSIONS
+
+# seconds between two scans of the directory tree
+DEFAULT_INTERVAL = 2.0
+
+
+class FileState(NamedTuple):
+    """State of a file, as indexed"""
+
+    path: str
+    size: int
+    mtime_ns: int
+
+
+class WatchUpdate(NamedTuple):
+    """Result of a scan of the directory tree"""
+
+    analyzed: List[Tuple[FileState, dict]]  # new or changed files
+    removed: List[str]
+    unchanged: int
+
+
+def get_index_path(root: str) -> str:
+    """Default path of the index of a directory, in the cache directory"""
+    name = hashlib.sha1(abspath(root).encode("utf-8", "surrogateescape")).hexdigest()
+    return join(DEFAULT_CACHE_DIR, f"watch-{name[:16]}.sqlite")
+
+
+class WatchIndex:
+    """Persistent index of the analyzed files: (path, size, mtime, result)"""
+
+    def __init__(self, path: str):
+        if dirname(path):
+            makedirs(dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, result TEXT)"
+        )
+        self.connection.commit()
+
+    def get_states(self) -> Dict[str, FileState]:
+        """Get the states of the indexed files"""
+        return {
+            path: FileState(path, size, mtime_ns)
+            for path, size, mtime_ns in self.connection.execute(
+                "SELECT path, size, mtime_ns FROM files"
+            )
+        }
+
+    def get_result(self, path: str) -> Optional[dict]:
+        """Get the stored result of a file"""
+        row = self.connection.execute(
+            "SELECT result FROM files WHERE path = ?", (path,)
+        ).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def update(self, update: WatchUpdate):
+        """Store the results of a scan, in a single transaction
+
+        The files which could not be read are not indexed, so they are
+        analyzed again by the next scan. The errors of the content (like a
+        file which is not a PNG) are indexed like any other result.
+        """
+        failed = [
+            state.path for state, result in update.analyzed if result.get("transient")
+        ]
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                [
+                    (
+                        state.path,
+                        state.size,
+                        state.mtime_ns,
+                        json.dumps(result, separators=(",", ":")),
+                    )
+                    for state, result in update.analyzed
+                    if not result.get("transient")
+                ],
+            )
+            self.connection.executemany(
+                "DELETE FROM files WHERE path = ?",
+                [(path,) for path in update.removed + failed],
+            )
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def close(self):
+        """Close the index"""
+        self.connection.close()
+
+
+def iter_file_states(root: str) -> Iterator[FileState]:
+    """Find the PNG files of a directory tree, with their size and mtime
+
+    Only the directory entries are read (scandir), not the files. The
+    entries removed while they are read are skipped.
+    """
+    directories = [root]
+    while directories:
+        directory = directories.pop()
+        try:
+            entries = list(scandir(directory))
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+                    continue
+                if not (entry.name.endswith(PNG_EXTENSIONS) and entry.is_file()):
+                    continue
+                entry_stat = entry.stat()
+            except OSError:
+                continue
+            yield FileState(entry.path, entry_stat.st_size, entry_stat.st_mtime_ns)
+
+
+def analyze_file(filename: str) -> dict:
+    """Analyze a file (runs in a worker process), see `iter_file_records`
+
+    The result of a file which could not be read is marked as transient
+    """
+    try:
+        return next(iter_file_records(filename))
+    except OSError as e:
+        return {"record": "file", "file": filename, "error": str(e), "transient": True}
+
+
+def scan_changes(root: str, index: WatchIndex, executor=None) -> WatchUpdate:
+    """Analyze the new and changed files of a directory tree and update the
+    index
+
+    A file is analyzed again only if its size or its mtime changed, so the
+    content of the unchanged files is never read.
+    """
+    indexed = index.get_states()
+    changed = []
+    unchanged = 0
+    for state in iter_file_states(root):
+        if indexed.pop(state.path, None) == state:
+            unchanged += 1
+        else:
+            changed.append(state)
+    filenames = [state.path for state in changed]
+    if executor is None or len(filenames) <= 1:
+        results = [analyze_file(filename) for filename in filenames]
+    else:
+        results = list(executor.map(analyze_file, filenames, chunksize=16))
+    # the files still in `indexed` were not found
+    update = WatchUpdate(list(zip(changed, results)), sorted(indexed), unchanged)
+    index.update(update)
+    return update
+
+
+def print_update(update: WatchUpdate):
+    """Print the analyzed and the removed files of a scan"""
+    for state, result in update.analyzed:
+        if "error" in result:
+            status = f"error: {result['error']}"
+        else:
+            status = f"{result['chunks']} chunks, {result['errors']} errors"
+            acropalypse = result.get("acropalypse")
+            if acropalypse is not None and acropalypse["flagged"]:
+                status += ", acropalypse"
+        print(f"{state.path}: {status}")
+    for path in update.removed:
+        print(f"{path}: removed")
+
+
+def watch_directory(
+    root: str,
+    index_path: Optional[str] = None,
+    interval=DEFAULT_INTERVAL,
+    workers: Optional[int] = None,
+    iterations: Optional[int] = None,
+    callback=print_update,
+):
+    """Poll a directory tree and analyze the new and changed files
+
+    The index is persistent (`get_index_path` by default), so a restart
+    resumes without analyzing the files again. `iterations`: number of
+    scans, None to run until interrupted.
+    """
+    index = WatchIndex(index_path or get_index_path(root))
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            count = 0
+            while iterations is None or count < iterations:
+                if count > 0:
+                    time.sleep(interval)
+                update = scan_changes(root, index, executor)
+                callback(update)
+                count += 1
+    except KeyboardInterrupt:
+        print("Stopped")
+    finally:
+        index.close()
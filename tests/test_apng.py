@@ -0,0 +1,153 @@
+"""Unit tests for animated PNG files."""
+
+import random
+import pytest
+from PIL import Image
+from pngtools import (
+    ERROR_CODE,
+    fix_chunk,
+    get_errors_of_chunk,
+    get_type_of_chunk,
+    read_animation,
+    read_file,
+    write_png,
+)
+from pngtools.apng import _blend_over
+from pngtools.lib import new_chunk
+
+
+def _create_apng(filename, disposal, blend, default_image=False, mode="RGBA"):
+    """Create an animation where each frame changes a small part of the image
+
+    Returns the images of the frames
+    """
+    rnd = random.Random(disposal * 2 + blend)
+    frames = []
+    img = Image.new("RGBA", (40, 30), (0, 0, 0, 0))
+    for i in range(5):
+        img = img.copy()
+        pixels = img.load()
+        for _ in range(50):
+            x = rnd.randrange(5 + 5 * i, 15 + 5 * i)
+            y = rnd.randrange(3 + 3 * i, 10 + 3 * i)
+            color = (rnd.randrange(256), rnd.randrange(256), rnd.randrange(256))
+            pixels[x, y] = color + (rnd.choice([0, 255]),)
+        frames.append(img)
+    frames = [frame.convert(mode) for frame in frames]
+    frames[0].save(
+        filename,
+        save_all=True,
+        append_images=frames[1:],
+        duration=[100, 200, 300, 400, 500],
+        disposal=disposal,
+        blend=blend,
+        default_image=default_image,
+    )
+    return frames
+
+
+def _clear_transparent(pixels):
+    """Set the color of the fully transparent pixels to black"""
+    pixels = bytearray(pixels)
+    for i in range(0, len(pixels), 4):
+        if pixels[i + 3] == 0:
+            pixels[i : i + 4] = b"\x00\x00\x00\x00"
+    return pixels
+
+
+def test_apng_chunks(tmp_path):
+    """Test that the animation chunks are known chunks."""
+    filename = str(tmp_path / "animation.png")
+    _create_apng(filename, 0, 0)
+    for one_chunk in read_file(filename):
+        assert ERROR_CODE["WRONG_TYPE"] not in get_errors_of_chunk(one_chunk)
+
+
+def test_apng_frames(tmp_path):
+    """Test indexing and decoding the frames of an animation."""
+    filename = str(tmp_path / "animation.png")
+    _create_apng(filename, 0, 0)
+    animation = read_animation(filename)
+    assert animation.num_frames == 5
+    assert len(animation.frames) == 5
+    assert animation.frames[0].is_default_image
+    assert [
+        1000 * frame.control.delay_num // frame.control.delay_den
+        for frame in animation.frames
+    ] == [100, 200, 300, 400, 500]
+    frame = animation.frames[2].control
+    pixels = animation.decode_frame(2)
+    assert len(pixels) == frame.width * frame.height * 4
+    assert len(animation.decode_frames(workers=2)) == 5
+
+
+def test_apng_compose(tmp_path):
+    """Test composing the frames with every dispose and blend op."""
+    filename = str(tmp_path / "animation.png")
+    for disposal in [0, 1, 2]:
+        for blend in [0, 1]:
+            _create_apng(filename, disposal, blend)
+            rendered = read_animation(filename).compose_frames(workers=1)
+            with Image.open(filename) as img:
+                assert img.n_frames == len(rendered)
+                for i, pixels in enumerate(rendered):
+                    img.seek(i)
+                    expected = img.convert("RGBA").tobytes()
+                    assert _clear_transparent(pixels) == _clear_transparent(expected)
+
+
+def test_apng_hidden_default_image(tmp_path):
+    """Test that a default image without fcTL is not part of the animation."""
+    filename = str(tmp_path / "animation.png")
+    frames = _create_apng(filename, 0, 0, default_image=True)
+    animation = read_animation(filename)
+    assert animation.num_frames == 4
+    assert not any(frame.is_default_image for frame in animation.frames)
+    rendered = animation.compose_frames(workers=1)
+    assert [bytes(pixels) for pixels in rendered] == [
+        frame.tobytes() for frame in frames[1:]
+    ]
+
+
+def test_apng_frame_outside(tmp_path):
+    """A frame outside the canvas is rejected."""
+    filename = str(tmp_path / "animation.png")
+    _create_apng(filename, 0, 0)
+    chunks = read_file(filename)
+    index = [get_type_of_chunk(c) for c in chunks].index(b"fcTL", 3)
+    length, chunk_type, data, crc, errors = chunks[index]
+    # x offset of 39 for a frame wider than one pixel
+    data = data[:12] + (39).to_bytes(4, "big") + data[16:]
+    chunks[index] = fix_chunk(new_chunk(length, chunk_type, data, crc, errors))
+    write_png(chunks, str(tmp_path / "outside.png"))
+    with pytest.raises(ValueError):
+        read_animation(str(tmp_path / "outside.png"))
+
+
+def test_apng_compose_gray_alpha(tmp_path):
+    """Test blending the frames of a gray and alpha animation."""
+    filename = str(tmp_path / "animation.png")
+    for blend in [0, 1]:
+        _create_apng(filename, 0, blend, mode="LA")
+        animation = read_animation(filename)
+        assert animation.color_type == 4
+        rendered = animation.compose_frames(workers=1)
+        with Image.open(filename) as img:
+            for i, pixels in enumerate(rendered):
+                img.seek(i)
+                expected = img.convert("LA").tobytes()
+                for j in range(0, len(pixels), 2):
+                    if pixels[j + 1] == 0:
+                        assert expected[j + 1] == 0
+                    else:
+                        assert pixels[j : j + 2] == expected[j : j + 2]
+
+
+def test_blend_over_16_bit():
+    """Test blending 16-bit RGBA pixels."""
+    source = bytes.fromhex("ffff00000000ffffffff000000008000ffff000000000000")
+    destination = bytes.fromhex("00000000ffffffff" * 3)
+    result = _blend_over(source, destination, 4, 2)
+    assert result[:8] == source[:8]
+    assert result[8:16] == bytes.fromhex("800000007fffffff")
+    assert result[16:] == destination[16:]
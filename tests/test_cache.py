@@ -0,0 +1,107 @@
+"""Unit tests for the chunk table cache."""
+
+from os import listdir, utime
+import shutil
+from pngtools import (
+    ChunkCache,
+    read_chunk_table,
+    scan_chunk_table,
+    read_file,
+    get_length_of_chunk,
+    get_type_of_chunk,
+)
+from pngtools import cache
+from pngtools.cache import decode_chunk_table, encode_chunk_table
+
+
+def test_scan_chunk_table():
+    """Test the chunk table of a file."""
+    table = scan_chunk_table("tests/511-200x300.png")
+    chunks = read_file("tests/511-200x300.png")
+    assert table.signatures == [0]
+    assert table.ihdr == (200, 300, 8, 2, 0, 0, 0)
+    assert [entry.chunk_type for entry in table.chunks] == [
+        get_type_of_chunk(one_chunk) for one_chunk in chunks
+    ]
+    assert [entry.length for entry in table.chunks] == [
+        get_length_of_chunk(one_chunk) for one_chunk in chunks
+    ]
+    assert all(entry.crc_ok for entry in table.chunks)
+    assert table.chunks[0].offset == 8
+    last = table.chunks[-1]
+    assert last.offset + 12 + last.length == table.size
+
+
+def test_scan_chunk_table_broken():
+    """Test the chunk table of files with several or misplaced signatures."""
+    table = scan_chunk_table("tests/double_png.png")
+    assert table.signatures == [0, 112276]
+    table = scan_chunk_table("tests/broken_file.bin")
+    assert table.signatures == [10]
+    assert len(table.chunks) == 23
+    assert table.chunks[0].offset == 18
+
+
+def test_encode_chunk_table():
+    """Test the binary format of the chunk tables."""
+    table = scan_chunk_table("tests/acropalypse.png")
+    key, decoded = decode_chunk_table(encode_chunk_table(table, b"key"))
+    assert key == b"key"
+    assert decoded == table
+
+
+def test_chunk_cache(tmp_path):
+    """Test that unchanged files are read from the cache."""
+    filename = str(tmp_path / "image.png")
+    shutil.copy("tests/511-200x300.png", filename)
+    cache = ChunkCache(str(tmp_path / "cache"))
+    assert cache.get(filename) is None
+    table = read_chunk_table(filename, cache)
+    assert cache.get(filename) == table
+    assert read_chunk_table(filename, cache) == table
+    # a modified file is scanned again
+    utime(filename, ns=(0, 0))
+    assert cache.get(filename) is None
+    # the content key does not depend on the modification time
+    read_chunk_table(filename, cache, by_content=True)
+    utime(filename, ns=(10**9, 10**9))
+    assert cache.get(filename, by_content=True) == table
+
+
+def test_chunk_cache_eviction(tmp_path):
+    """Test that the least recently used entries are removed."""
+    cache_dir = str(tmp_path / "cache")
+    filenames = []
+    for i, source in enumerate(["tests/511-200x300.png", "tests/double_png.png"]):
+        filename = str(tmp_path / f"image{i}.png")
+        shutil.copy(source, filename)
+        filenames.append(filename)
+    cache = ChunkCache(cache_dir)
+    entry_size = len(encode_chunk_table(scan_chunk_table(filenames[0]), b"x" * 200))
+    cache.max_size = entry_size + 50
+    cache.put(filenames[0], scan_chunk_table(filenames[0]))
+    cache.put(filenames[1], scan_chunk_table(filenames[1]))
+    assert len(listdir(cache_dir)) == 1
+    assert cache.get(filenames[0]) is None
+    assert cache.get(filenames[1]) is not None
+
+
+def test_chunk_cache_size(tmp_path, monkeypatch):
+    """Test that the directory is only listed by the evictions."""
+    listed = []
+    monkeypatch.setattr(
+        cache, "listdir", lambda path: listed.append(path) or listdir(path)
+    )
+    table = scan_chunk_table("tests/511-200x300.png")
+    entry_size = len(encode_chunk_table(table, b"x" * 200))
+    cache_dir = tmp_path / "cache"
+    chunk_cache = ChunkCache(str(cache_dir), max_size=20 * entry_size)
+    for i in range(100):
+        filename = str(tmp_path / f"image{i}.png")
+        shutil.copy("tests/511-200x300.png", filename)
+        chunk_cache.put(filename, table)
+    # the first put and an eviction every few puts
+    assert 1 < len(listed) < 100 // 2
+    sizes = [entry.stat().st_size for entry in cache_dir.iterdir()]
+    assert sum(sizes) <= chunk_cache.max_size
+    assert len(sizes) >= 10
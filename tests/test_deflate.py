@@ -0,0 +1,138 @@
+"""Unit tests for the deflate block headers."""
+
+import random
+import zlib
+import pytest
+from pngtools.deflate import (
+    BLOCK_DYNAMIC,
+    BLOCK_FIXED,
+    BLOCK_STORED,
+    BitReader,
+    huffman_code,
+    iter_zlib_blocks,
+    read_block_header,
+)
+from pngtools.lib import extract_idat, read_file
+
+
+def _compressed_text():
+    """Compress some text, with a dynamic block"""
+    words = [b"red", b"green", b"blue", b"alpha", b"pixel", b"chunk", b"scanline"]
+    rand = random.Random(42)
+    text = b" ".join(rand.choice(words) for _ in range(2000))
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+    return compressor.compress(text) + compressor.flush()
+
+
+def test_read_block_header():
+    """Test reading the header of the blocks."""
+    data = _compressed_text()
+    header = read_block_header(BitReader(data))
+    assert header.offset == 0
+    assert header.final
+    assert header.block_type == BLOCK_DYNAMIC
+    assert len(header.literal_lengths) >= 257
+    assert header.literal_lengths[256] > 0
+    assert header.length > 17
+
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -15, 9, zlib.Z_FIXED)
+    data = compressor.compress(b"abc") + compressor.flush()
+    header = read_block_header(BitReader(data))
+    assert header.block_type == BLOCK_FIXED
+    assert header.length == 3
+
+    compressor = zlib.compressobj(0, zlib.DEFLATED, -15)
+    data = compressor.compress(b"abc") + compressor.flush()
+    assert read_block_header(BitReader(data)).block_type == BLOCK_STORED
+
+    with pytest.raises(ValueError):
+        read_block_header(BitReader(b"\x07"))
+    with pytest.raises(ValueError):
+        read_block_header(BitReader(b"\x04"))
+
+
+def test_huffman_code():
+    """Test building the Huffman codes."""
+    assert huffman_code([2, 1, 3, 3]) == {
+        (1, 0): 1,
+        (2, 2): 0,
+        (3, 6): 2,
+        (3, 7): 3,
+    }
+    with pytest.raises(ValueError):
+        huffman_code([1, 1, 1])
+    with pytest.raises(ValueError):
+        huffman_code([2, 2, 2])
+    # a single code of one bit is allowed, but not for the code lengths
+    assert huffman_code([0, 1]) == {(1, 0): 1}
+    with pytest.raises(ValueError):
+        huffman_code([0, 1], allow_incomplete=False)
+
+
+def test_header_check_matches_zlib():
+    """The header check only rejects the blocks that zlib rejects too."""
+    data = _compressed_text()
+    bits = int.from_bytes(data, "little")
+    window = zlib.decompressobj(wbits=-15, zdict=bytes(32 * 1024))
+    dynamic = 0
+    rejected = 0
+    for offset in range(len(data) * 8):
+        is_dynamic = (bits >> (offset + 1)) & 3 == BLOCK_DYNAMIC
+        dynamic += is_dynamic
+        try:
+            read_block_header(BitReader(data, offset))
+            continue
+        except ValueError:
+            rejected += is_dynamic
+        truncated = (bits >> offset).to_bytes(len(data) - offset // 8, "little")
+        decompressor = window.copy()
+        with pytest.raises(zlib.error):
+            decompressor.decompress(truncated)
+            decompressor.flush(zlib.Z_FINISH)
+            if not decompressor.eof:
+                raise zlib.error("incomplete")
+    # almost all the dynamic block headers at random offsets are invalid
+    assert rejected > dynamic * 0.99
+
+
+def test_deflate_blocks_match_zlib():
+    """The block map covers the data compressed with every block type."""
+    text = _compressed_text()
+    text = zlib.decompress(text, -15)
+    for level, strategy in ((0, zlib.Z_DEFAULT_STRATEGY), (6, zlib.Z_FIXED), (9, 0)):
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 15, 9, strategy)
+        data = compressor.compress(text) + compressor.flush(zlib.Z_FULL_FLUSH)
+        data += compressor.compress(text[:100]) + compressor.flush()
+        blocks = list(iter_zlib_blocks(data))
+        assert blocks[0].offset == 16
+        assert blocks[-1].final
+        assert blocks[-1].output_end == len(text) + 100
+        for previous, block in zip(blocks, blocks[1:]):
+            assert block.offset == previous.offset + previous.length
+            assert block.output_start == previous.output_end
+        # the Adler-32 checksum follows the final block
+        assert (blocks[-1].offset + blocks[-1].length + 7) // 8 + 4 == len(data)
+        types = {block.block_type for block in blocks}
+        if level == 0:
+            assert types == {BLOCK_STORED}
+        elif strategy == zlib.Z_FIXED:
+            assert BLOCK_FIXED in types
+
+
+def test_deflate_blocks_of_png():
+    """The blocks of the IDAT data produce the scanlines."""
+    chunks = read_file("tests/511-200x300.png")
+    blocks = list(iter_zlib_blocks(b"".join(extract_idat(chunks))))
+    assert blocks[-1].output_end == 300 * (200 * 3 + 1)
+
+
+def test_deflate_blocks_errors():
+    """The valid blocks are yielded before the invalid one."""
+    data = zlib.compress(_compressed_text() * 3)
+    with pytest.raises(ValueError):
+        list(iter_zlib_blocks(data[: len(data) // 2]))
+    with pytest.raises(ValueError):
+        list(iter_zlib_blocks(b"\x00" + data[1:]))
+    # block type 3
+    with pytest.raises(ValueError):
+        list(iter_zlib_blocks(data[:2] + b"\xff" + data[3:]))
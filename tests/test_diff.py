@@ -0,0 +1,88 @@
+"""Unit tests for the diff of PNG files."""
+
+from PIL import Image, PngImagePlugin
+from pngtools import diff_files, read_chunk_headers, read_file
+
+
+def _create_image(width=32, height=24):
+    """Create an RGB image with a gradient"""
+    pixels = bytes(
+        (x * 7 + y * 3 + c) & 0xFF
+        for y in range(height)
+        for x in range(width)
+        for c in range(3)
+    )
+    return Image.frombytes("RGB", (width, height), pixels)
+
+
+def test_read_chunk_headers():
+    """Test reading the chunk headers without the data."""
+    chunks = read_file("tests/511-200x300.png")
+    with open("tests/511-200x300.png", "rb") as fp:
+        headers = read_chunk_headers(fp)
+    assert [header.chunk_type for header in headers] == [c[1] for c in chunks]
+    assert [header.crc for header in headers] == [c[3] for c in chunks]
+
+
+def test_diff_same_file():
+    """Test comparing a file with itself."""
+    diff = diff_files("tests/511-200x300.png", "tests/511-200x300.png")
+    assert all(chunk.status == "same" for chunk in diff.chunks)
+    assert diff.same_pixels
+
+
+def test_diff_metadata(tmp_path):
+    """Test comparing files with different text chunks."""
+    img = _create_image()
+    info_a = PngImagePlugin.PngInfo()
+    info_a.add_text("Title", "first")
+    info_a.add_text("Author", "someone")
+    info_b = PngImagePlugin.PngInfo()
+    info_b.add_text("Title", "fixed")
+    img.save(tmp_path / "a.png", pnginfo=info_a)
+    img.save(tmp_path / "b.png", pnginfo=info_b)
+    diff = diff_files(str(tmp_path / "a.png"), str(tmp_path / "b.png"))
+    changed = [chunk for chunk in diff.chunks if chunk.status != "same"]
+    assert [(chunk.status, chunk.chunk_type) for chunk in changed] == [
+        ("changed", b"tEXt"),
+        ("removed", b"tEXt"),
+    ]
+    # "Title\0fi" is the same
+    assert changed[0].first_difference == 8
+    assert diff.same_pixels
+
+
+def test_diff_pixels(tmp_path):
+    """Test finding the first different pixel."""
+    img = _create_image()
+    img.save(tmp_path / "a.png")
+    img.putpixel((5, 10), (1, 2, 3))
+    img.putpixel((7, 12), (1, 2, 3))
+    img.save(tmp_path / "b.png")
+    diff = diff_files(str(tmp_path / "a.png"), str(tmp_path / "b.png"))
+    assert [chunk.status for chunk in diff.chunks] == ["same", "changed", "same"]
+    assert not diff.same_pixels
+    assert (diff.first_different_row, diff.first_different_column) == (10, 5)
+    # different encoding of the same pixels
+    img = _create_image()
+    img.save(tmp_path / "b.png", compress_level=1)
+    diff = diff_files(str(tmp_path / "a.png"), str(tmp_path / "b.png"))
+    assert diff.chunks[1].status == "changed"
+    assert diff.same_pixels
+    # different sizes
+    _create_image(16, 16).save(tmp_path / "b.png")
+    diff = diff_files(str(tmp_path / "a.png"), str(tmp_path / "b.png"))
+    assert diff.same_pixels is False
+    assert diff.first_different_row is None
+
+
+def test_diff_palette(tmp_path):
+    """The pixels of unsupported formats are not compared."""
+    img = _create_image().convert("P")
+    img.save(tmp_path / "a.png")
+    img.putpixel((5, 10), 0 if img.getpixel((5, 10)) else 1)
+    img.save(tmp_path / "b.png")
+    diff = diff_files(str(tmp_path / "a.png"), str(tmp_path / "b.png"))
+    assert diff.chunks[0].status == "same"
+    assert diff.same_pixels is None
+    assert diff.first_different_row is None
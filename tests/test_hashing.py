@@ -0,0 +1,88 @@
+"""Unit tests for the hashes of PNG files."""
+
+import shutil
+from PIL import Image
+from pngtools import (
+    find_duplicates,
+    hamming_distance,
+    hash_file,
+    hash_stream,
+    scan_hashes,
+)
+
+
+def test_pixel_hash(tmp_path):
+    """The pixel hash does not depend on the compression and the chunks."""
+    original = hash_file("tests/511-200x300.png")
+    with Image.open("tests/511-200x300.png") as img:
+        img.save(tmp_path / "fast.png", compress_level=1)
+        img.save(tmp_path / "small.png", optimize=True)
+        changed = img.copy()
+    changed.putpixel((10, 10), (0, 0, 0))
+    changed.save(tmp_path / "changed.png")
+    for name in ("fast.png", "small.png"):
+        hashes = hash_file(str(tmp_path / name))
+        assert hashes.pixels == original.pixels
+        assert hashes.ahash == original.ahash
+        assert hashes.dhash == original.dhash
+        assert hashes.structure != original.structure
+    hashes = hash_file(str(tmp_path / "changed.png"))
+    assert hashes.pixels != original.pixels
+    assert hamming_distance(hashes.ahash, original.ahash) <= 2
+    assert hamming_distance(hashes.dhash, original.dhash) <= 2
+
+    # the data after IEND changes the structure only
+    hashes = hash_file("tests/double_png.png")
+    assert hashes.pixels == original.pixels
+    assert hashes.structure != original.structure
+
+    # the hashes of a stream and of a file are the same
+    with open("tests/511-200x300.png", "rb") as fp:
+        assert hash_stream(fp.read()) == original
+
+
+def test_perceptual_hash(tmp_path):
+    """Test the perceptual hashes of simple images."""
+    # dark left half, bright right half
+    img = Image.new("L", (16, 16))
+    img.paste(200, (8, 0, 16, 16))
+    img.save(tmp_path / "halves.png")
+    hashes = hash_file(str(tmp_path / "halves.png"))
+    assert hashes.ahash == "0f0f0f0f0f0f0f0f"
+    # horizontal gradient, in RGB
+    img = Image.new("RGB", (90, 20))
+    for x in range(90):
+        img.paste((x * 2, x, x * 3), (x, 0, x + 1, 20))
+    img.save(tmp_path / "gradient.png")
+    hashes = hash_file(str(tmp_path / "gradient.png"))
+    assert hashes.dhash == "ffffffffffffffff"
+    brighter = img.point(lambda value: min(255, value + 10))
+    brighter.save(tmp_path / "brighter.png")
+    assert (
+        hamming_distance(hash_file(str(tmp_path / "brighter.png")).dhash, hashes.dhash)
+        == 0
+    )
+
+    # unsupported format: only the structural hash
+    img.convert("P").save(tmp_path / "palette.png")
+    hashes = hash_file(str(tmp_path / "palette.png"))
+    assert hashes.pixels is None
+    assert hashes.structure is not None
+
+
+def test_scan_hashes(tmp_path):
+    """Test finding the duplicates of a directory."""
+    shutil.copy("tests/511-200x300.png", tmp_path / "a.png")
+    shutil.copy("tests/511-200x300.png", tmp_path / "b.png")
+    shutil.copy("tests/double_png.png", tmp_path / "c.png")
+    shutil.copy("tests/acropalypse.png", tmp_path / "d.png")
+    (tmp_path / "e.png").write_bytes(b"not a PNG")
+    hashes = scan_hashes([str(tmp_path)], workers=2)
+    assert len(hashes) == 5
+    assert hashes[-1][1] is None
+    assert find_duplicates(hashes) == [
+        [str(tmp_path / name) for name in ("a.png", "b.png", "c.png")]
+    ]
+    assert find_duplicates(hashes, "structure") == [
+        [str(tmp_path / "a.png"), str(tmp_path / "b.png")]
+    ]
@@ -2,10 +2,22 @@
 
 from os.path import getsize
 import filecmp
+import io
+import os
+import threading
+import tracemalloc
+import random
+import struct
+import zlib
+import pytest
 from PIL import Image  # python -m pip install pillow
 
+from pngtools import cli
 from pngtools import (
+    CLI,
+    fix_chunk,
     read_file,
+    split_png_chunks,
     read_broken_file,
     remove_chunk_by_type,
     create_iend_chunk,
@@ -27,8 +39,24 @@ from pngtools import (
     get_errors_of_chunk,
     acropalypse,
     print_chunks,
+    try_decompress,
+    iter_scanlines,
+    decode_region,
+    decode_preview,
+    iter_chunks,
+    parallel_decompress,
+    write_png,
 )
-from pngtools.ppm import convert_rgba_to_rgb
+from pngtools.lib import (
+    ReaderHelper,
+    find_flush_points,
+    new_chunk,
+    read_chunk,
+    paeth_predictor,
+)
+from pngtools.bmp import stream_bmp
+from pngtools.preview import downscale_scanlines
+from pngtools.ppm import convert_rgba_to_rgb, stream_ppm
 
 
 def test_signature():
@@ -117,7 +145,7 @@ def test_decode_phy():
     assert unit == 1
 
 
-def test_acropalypse_to_bitmap():
+def test_acropalypse_to_bitmap(tmp_path):
     """Convert PNG to BMP format."""
     chunks = read_file("tests/acropalypse.png")
     (
@@ -158,7 +186,7 @@ def test_acropalypse_to_bitmap():
         f"Expected {expected_size}, but got {len(raw_data)}"
     )
     create_bmp(
-        "tests/acropalypse.bmp",
+        str(tmp_path / "acropalypse.bmp"),
         width,
         height,
         bit_depth,
@@ -245,6 +273,57 @@ def test_convert_to_ppm():
     )
 
 
+def test_stream_bmp_ppm(tmp_path):
+    """Test exporting BMP and PPM files one scanline at a time."""
+    chunks = read_file("tests/511-200x300.png")
+    width, height, bit_depth, color_type, _, _, _ = decode_ihdr(
+        get_data_of_chunk(chunks[0])
+    )
+    raw_data = parse_idat(extract_data(chunks), width, height, bit_depth, color_type)
+    create_bmp(
+        str(tmp_path / "full.bmp"), width, height, bit_depth, color_type, raw_data
+    )
+    scanlines = iter_scanlines(
+        extract_idat(chunks), width, height, bit_depth, color_type
+    )
+    stream_bmp(
+        str(tmp_path / "stream.bmp"), width, height, bit_depth, color_type, scanlines
+    )
+    assert filecmp.cmp(tmp_path / "full.bmp", tmp_path / "stream.bmp", shallow=False)
+    with Image.open("tests/511-200x300.png") as img:
+        img.save(tmp_path / "pil.bmp")
+    assert filecmp.cmp(tmp_path / "pil.bmp", tmp_path / "stream.bmp", shallow=False)
+
+    create_ppm(str(tmp_path / "full.ppm"), width, height, raw_data, binary=True)
+    scanlines = iter_scanlines(
+        extract_idat(chunks), width, height, bit_depth, color_type
+    )
+    stream_ppm(str(tmp_path / "stream.ppm"), width, height, color_type, scanlines)
+    assert filecmp.cmp(tmp_path / "full.ppm", tmp_path / "stream.ppm", shallow=False)
+
+
+def test_stream_bmp_memory(tmp_path):
+    """Test that the memory used by the export does not depend on the height."""
+    width, height = 64, 8000
+    img = _create_png(str(tmp_path / "tall.png"), width, height, "RGBA")
+    chunks = read_file(str(tmp_path / "tall.png"))
+    tracemalloc.start()
+    stream_bmp(
+        str(tmp_path / "tall.bmp"),
+        width,
+        height,
+        8,
+        6,
+        iter_scanlines(extract_idat(chunks), width, height, 8, 6),
+    )
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert peak < width * height * 4 // 4
+    with Image.open(tmp_path / "tall.bmp") as bmp:
+        # the alpha of 32 bits BMP files is ignored
+        assert bmp.convert("RGB").tobytes() == img.convert("RGB").tobytes()
+
+
 def test_interlaced():
     """Test reading an interlaced PNG file."""
     chunks = read_file("tests/pnglogo-grr.png")
@@ -267,7 +346,7 @@ def test_interlaced():
     assert interlace_method == 1
 
 
-def test_acropalypse():
+def test_acropalypse(tmp_path):
     """Test reading an acropalypse PNG file."""
     chunks = read_file("tests/acropalypse.png")
     assert get_type_of_chunk(chunks[0]) == b"IHDR"
@@ -300,4 +379,344 @@ def test_acropalypse():
     assert data is not None
     if color_type == 6:
         data = convert_rgba_to_rgb(data)
-    create_ppm("tests/acropalypsed.ppm", orig_width, orig_height, data, binary=True)
+    create_ppm(
+        str(tmp_path / "acropalypsed.ppm"), orig_width, orig_height, data, binary=True
+    )
+
+
+def test_interlaced_decompressed_length():
+    """Test the expected length of interlaced IDAT data."""
+    chunks = read_file("tests/pnglogo-grr.png")
+    (
+        width,
+        height,
+        bit_depth,
+        color_type,
+        _,
+        _,
+        interlace_method,
+    ) = decode_ihdr(get_data_of_chunk(chunks[0]))
+    data = extract_data(chunks)
+    assert len(data) == calculate_decompressed_length(
+        width, height, bit_depth, color_type, interlace_method
+    )
+
+
+def test_decompressed_length_formats():
+    """Test the length of the image data of the formats."""
+    assert calculate_decompressed_length(200, 300, 8, 2) == (200 * 3 + 1) * 300
+    assert calculate_decompressed_length(10, 3, 1, 0) == 3 * 3
+    assert calculate_decompressed_length(10, 3, 16, 6) == (10 * 8 + 1) * 3
+    # interlaced: 1x1, 1x1, 2x1, 2x2, 4x2, 4x4 and 8x4 pixels
+    assert calculate_decompressed_length(8, 8, 8, 0, 1) == 2 + 2 + 3 + 6 + 10 + 20 + 36
+    assert calculate_decompressed_length(8, 8, 1, 0, 1) == 2 + 2 + 2 + 4 + 4 + 8 + 8
+
+
+def test_sub_byte_decompressed_length(tmp_path):
+    """Test the expected length of the image data of a 1-bit grayscale file."""
+    Image.new("1", (64, 40), 1).save(tmp_path / "bilevel.png")
+    chunks = read_file(str(tmp_path / "bilevel.png"))
+    width, height, bit_depth, color_type, _, _, _ = decode_ihdr(
+        get_data_of_chunk(chunks[0])
+    )
+    assert (bit_depth, color_type) == (1, 0)
+    data = extract_data(chunks)
+    assert len(data) == 360
+    assert len(data) == calculate_decompressed_length(
+        width, height, bit_depth, color_type
+    )
+
+
+def test_decompress_memory_limit():
+    """Test that inflating stops at the memory limit."""
+    bomb = zlib.compress(b"\x00" * (4 * 1024 * 1024))
+    assert len(try_decompress(bomb)) == 4 * 1024 * 1024
+    with pytest.raises(ValueError):
+        try_decompress(bomb, memory_limit=1024 * 1024)
+    with pytest.raises(ValueError):
+        try_decompress(bomb, expected_length=2048, memory_limit=1024)
+    # only the expected length is inflated
+    data = try_decompress(bomb, expected_length=1000)
+    assert data == b"\x00" * 1000
+    # truncated stream
+    assert try_decompress(bomb[:-10], expected_length=8 * 1024 * 1024) is None
+
+
+def _compress_with_flushes(data, parts, flush_mode, level=6):
+    """Compress data with a flush after each part"""
+    compressor = zlib.compressobj(level)
+    step = len(data) // parts
+    compressed = []
+    for start in range(0, len(data), step):
+        compressed.append(compressor.compress(data[start : start + step]))
+        compressed.append(compressor.flush(flush_mode))
+    compressed.append(compressor.flush())
+    return b"".join(compressed)
+
+
+def test_parallel_decompress():
+    """Test inflating the segments between flush points in parallel."""
+    rnd = random.Random(0)
+    data = bytes(rnd.choice(b"abcdef") for _ in range(200000)) * 4
+    # full flush: independent segments
+    compressed = _compress_with_flushes(data, 8, zlib.Z_FULL_FLUSH)
+    assert len(find_flush_points(compressed, 1000)) >= 7
+    assert parallel_decompress(compressed, 4, min_segment_size=1000) == data
+    assert try_decompress(compressed, workers=4) == data
+    assert try_decompress(compressed, expected_length=1000, workers=4) == data[:1000]
+    # sync flush: the segments refer to the previous ones
+    compressed = _compress_with_flushes(data, 8, zlib.Z_SYNC_FLUSH)
+    assert parallel_decompress(compressed, 4, min_segment_size=1000) == data
+    # no flush point
+    compressed = zlib.compress(data)
+    assert find_flush_points(compressed, 1000) == []
+    assert parallel_decompress(compressed, 4, min_segment_size=1000) == data
+    # markers in stored blocks are not restart points
+    data = b"\x00\x00\xff\xff" * 100000
+    compressed = _compress_with_flushes(data, 4, zlib.Z_FULL_FLUSH, level=0)
+    assert parallel_decompress(compressed, 4, min_segment_size=1000) == data
+    # wrong checksum
+    compressed = _compress_with_flushes(data, 4, zlib.Z_FULL_FLUSH)
+    assert try_decompress(compressed[:-1] + b"\x00", workers=4) is None
+    with pytest.raises(ValueError):
+        parallel_decompress(compressed, 4, min_segment_size=1000, memory_limit=1000)
+
+
+def test_read_chunk_memory_limit():
+    """Test that a declared chunk length over the memory limit is not read."""
+    with open("tests/511-200x300.png", "rb") as f:
+        data = f.read()
+    reader = ReaderHelper(data[len(PNG_MAGIC) :])
+    with pytest.raises(ValueError):
+        read_chunk(reader, len(data), memory_limit=12)
+    with pytest.raises(ValueError):
+        read_file("tests/511-200x300.png", memory_limit=1024)
+
+
+def _filter_scanlines(pixels, width, height, bpp):
+    """Filter the scanlines with every filter type in turn (reference encoder)"""
+    stride = width * bpp
+    filtered = bytearray()
+    prev = bytes(stride)
+    for y in range(height):
+        line = pixels[y * stride : (y + 1) * stride]
+        filter_type = y % 5
+        filtered.append(filter_type)
+        for i, x in enumerate(line):
+            a = line[i - bpp] if i >= bpp else 0
+            b = prev[i]
+            c = prev[i - bpp] if i >= bpp else 0
+            predictor = [0, a, b, (a + b) // 2, paeth_predictor(a, b, c)]
+            filtered.append((x - predictor[filter_type]) % 256)
+        prev = line
+    return bytes(filtered)
+
+
+def test_unfilter_all_filter_types():
+    """Test unfiltering scanlines using every filter type."""
+    rnd = random.Random(42)
+    for width, height, color_type, bpp in [(37, 23, 2, 3), (16, 11, 6, 4)]:
+        pixels = bytes(rnd.getrandbits(8) for _ in range(width * height * bpp))
+        filtered = _filter_scanlines(pixels, width, height, bpp)
+        raw_data = parse_idat(filtered, width, height, 8, color_type)
+        assert raw_data == pixels
+
+
+def test_unfilter_unknown_filter():
+    """Test unknown filter types."""
+    width, height = 4, 2
+    filtered = bytearray(_filter_scanlines(bytes(range(24)), width, height, 3))
+    filtered[0] = 7
+    with pytest.raises(ValueError):
+        parse_idat(filtered, width, height, 8, 2)
+    raw_data = parse_idat(filtered, width, height, 8, 2, raise_error=False)
+    assert raw_data[:12] == bytes(range(12))
+
+
+def _create_png(filename, width, height, mode="RGB", seed=0):
+    """Create a noisy PNG file with PIL and return the image"""
+    rnd = random.Random(seed)
+    size = width * height * len(mode)
+    pixels = bytes(rnd.getrandbits(8) & 0xF0 for _ in range(size))
+    img = Image.frombytes(mode, (width, height), pixels)
+    img.save(filename)
+    return img
+
+
+def _region_rows(img, y0, y1):
+    """Get the pixels of the rows [y0, y1) of a PIL image"""
+    return img.crop((0, y0, img.width, y1)).tobytes()
+
+
+def test_iter_scanlines():
+    """Test decoding scanline by scanline."""
+    chunks = read_file("tests/pnglogo-grr.png")
+    width, height, bit_depth, color_type, _, _, interlace_method = decode_ihdr(
+        get_data_of_chunk(chunks[0])
+    )
+    rows = list(
+        iter_scanlines(
+            extract_idat(chunks),
+            width,
+            height,
+            bit_depth,
+            color_type,
+            interlace_method,
+        )
+    )
+    assert len(rows) == height
+    with Image.open("tests/pnglogo-grr.png") as img:
+        assert b"".join(rows) == img.tobytes()
+
+
+def test_decode_region(tmp_path):
+    """Test decoding a region of a tall image."""
+    filename = str(tmp_path / "tall.png")
+    width, height = 120, 3000
+    img = _create_png(filename, width, height)
+    chunks = read_file(filename)
+    idat = extract_idat(chunks)
+    assert len(idat) > 1
+    region = decode_region(idat, width, height, 8, 2, (0, 100), (10, 50))
+    assert region == img.crop((10, 0, 50, 100)).tobytes()
+    # the first rows only need the first IDAT chunk
+    assert decode_region(idat[:1], width, height, 8, 2, (0, 10)) == _region_rows(
+        img, 0, 10
+    )
+    assert decode_region(idat, width, height, 8, 2, (2000, 2100)) == _region_rows(
+        img, 2000, 2100
+    )
+    with pytest.raises(ValueError):
+        decode_region(idat, width, height, 8, 2, (0, height + 1))
+
+
+def test_preview_interlaced():
+    """Test previews of an interlaced image from the first passes."""
+    chunks = read_file("tests/pnglogo-grr.png")
+    idat = extract_idat(chunks)
+    with Image.open("tests/pnglogo-grr.png") as img:
+        width, height = img.size
+        pixels = img.tobytes()
+    for scale in [8, 4, 2]:
+        preview_width, preview_height, data = decode_preview(
+            idat, width, height, 8, 2, 1, scale
+        )
+        assert (preview_width, preview_height) == (width // scale, height // scale)
+        expected = bytearray()
+        for y in range(0, height, scale):
+            for x in range(0, width, scale):
+                expected += pixels[(y * width + x) * 3 : (y * width + x + 1) * 3]
+        assert data == expected
+
+
+def test_preview_box_filter():
+    """Test previews of an image downscaled with a box filter."""
+    chunks = read_file("tests/511-200x300.png")
+    with Image.open("tests/511-200x300.png") as img:
+        width, height = img.size
+        pixels = img.tobytes()
+    scale = 7
+    preview_width, preview_height, data = decode_preview(
+        extract_idat(chunks), width, height, 8, 2, 0, scale
+    )
+    assert (preview_width, preview_height) == (29, 43)
+    expected = bytearray()
+    for box_y in range(preview_height):
+        for box_x in range(preview_width):
+            for channel in range(3):
+                values = [
+                    pixels[(y * width + x) * 3 + channel]
+                    for y in range(box_y * scale, min((box_y + 1) * scale, height))
+                    for x in range(box_x * scale, min((box_x + 1) * scale, width))
+                ]
+                expected.append((sum(values) + len(values) // 2) // len(values))
+    assert data == expected
+
+
+def test_preview_16_bit():
+    """Test the box filter averages whole 16-bit samples."""
+    scanlines = [b"\x00\xff\x01\x00", b"\x00\xff\x01\x00"]
+    assert downscale_scanlines(scanlines, 2, 2, 2, 2, 2) == (1, 1, b"\x01\x00")
+
+
+def test_cli_preview(tmp_path, monkeypatch):
+    """Test the CLI writes 16-bit RGBA previews as RGB and rejects gray."""
+    monkeypatch.setattr(cli, "PATH_HISTORY", str(tmp_path / "history.dat"))
+    rows = [
+        bytes(random.Random(y).randrange(256) for _ in range(16 * 8)) for y in range(8)
+    ]
+    chunk_data = [
+        (b"IHDR", struct.pack(">IIBBBBB", 16, 8, 16, 6, 0, 0, 0)),
+        (b"IDAT", zlib.compress(b"".join(b"\x00" + row for row in rows))),
+        (b"IEND", b""),
+    ]
+    chunks = [
+        fix_chunk(new_chunk(len(data), chunk_type, data, b"", []))
+        for chunk_type, data in chunk_data
+    ]
+    write_png(chunks, str(tmp_path / "rgba16.png"))
+    shell = CLI()
+    shell.onecmd(f"read_file {tmp_path / 'rgba16.png'}")
+    shell.onecmd(f"create_preview {tmp_path / 'preview.ppm'} --scale 8")
+    _, _, expected = downscale_scanlines(rows, 16, 8, 8, 8, 2)
+    ppm = (tmp_path / "preview.ppm").read_bytes()
+    assert ppm == b"P6\n2 1\n65535\n" + expected[:6] + expected[8:14]
+
+    Image.new("L", (16, 8)).save(tmp_path / "gray.png")
+    shell.onecmd(f"read_file {tmp_path / 'gray.png'}")
+    with pytest.raises(NotImplementedError):
+        shell.onecmd(f"create_preview {tmp_path / 'gray.ppm'}")
+    assert not (tmp_path / "gray.ppm").exists()
+
+
+class _StreamOnly:
+    """Readable stream without fileno, seek or tell (like an HTTP response)"""
+
+    def __init__(self, data, max_read=1000):
+        self.data = io.BytesIO(data)
+        self.max_read = max_read
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        """Read at most `max_read` bytes at once, like a socket"""
+        if size < 0:
+            size = self.max_read
+        data = self.data.read(min(size, self.max_read))
+        self.bytes_read += len(data)
+        return data
+
+
+def test_iter_chunks():
+    """Test reading chunks from a stream without knowing its size."""
+    with open("tests/511-200x300.png", "rb") as f:
+        data = f.read()
+    chunks = read_file("tests/511-200x300.png")
+    assert list(iter_chunks(_StreamOnly(data))) == chunks
+    assert list(iter_chunks(data)) == chunks
+    # stop after the IHDR chunk
+    stream = _StreamOnly(data)
+    assert len(list(iter_chunks(stream, stop_at=b"IHDR"))) == 1
+    assert stream.bytes_read == 8 + 12 + 13
+    # truncated stream
+    truncated = list(iter_chunks(data[:50000]))
+    assert len(truncated) == 8
+    assert ERROR_CODE["EOF"] in get_errors_of_chunk(truncated[-1])
+    assert all(len(get_errors_of_chunk(one_chunk)) == 0 for one_chunk in truncated[:-1])
+
+
+def test_read_pipe():
+    """Test reading chunks from a pipe."""
+    with open("tests/511-200x300.png", "rb") as f:
+        data = f.read()
+    read_fd, write_fd = os.pipe()
+
+    def writer():
+        with os.fdopen(write_fd, "wb") as pipe:
+            pipe.write(data)
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    with os.fdopen(read_fd, "rb") as pipe:
+        chunks = split_png_chunks(ReaderHelper(pipe))
+    thread.join()
+    assert chunks == read_file("tests/511-200x300.png")
@@ -0,0 +1,67 @@
+"""Unit tests for the metadata of PNG files."""
+
+import io
+from pngtools import inspect_file, scan_chunk_table
+from pngtools.lib import calculate_crc, create_iend_chunk, get_binary_chunk
+
+
+class CountingReader(io.FileIO):
+    """File counting the number of bytes read"""
+
+    bytes_read = 0
+
+    def read(self, size=-1):
+        data = super().read(size)
+        self.bytes_read += len(data)
+        return data
+
+
+def _binary_chunk(chunk_type, data):
+    """Get the binary representation of a chunk"""
+    length = len(data).to_bytes(4, byteorder="big")
+    return length + chunk_type + data + calculate_crc(chunk_type, data)
+
+
+def test_inspect_file():
+    """Test reading the metadata of a file."""
+    info = inspect_file("tests/511-200x300.png")
+    table = scan_chunk_table("tests/511-200x300.png")
+    assert info.ihdr == (200, 300, 8, 2, 0, 0, 0)
+    assert info.phys == (2834, 2834, 1)
+    assert len(info.texts) == 11
+    assert [entry[:3] for entry in info.chunks] == [entry[:3] for entry in table.chunks]
+    for entry in info.chunks:
+        if entry.chunk_type == b"IDAT":
+            assert entry.crc_ok is None
+        else:
+            assert entry.crc_ok
+    assert info.bytes_read < info.size // 10
+
+
+def test_inspect_huge_file(tmp_path):
+    """Test that the IDAT data of a 1 GB file is skipped."""
+    filename = str(tmp_path / "huge.png")
+    idat_length = 1024 * 1024 * 1024
+    ihdr = (65535).to_bytes(4, "big") * 2 + b"\x08\x06\x00\x00\x00"
+    with open(filename, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(_binary_chunk(b"IHDR", ihdr))
+        f.write(_binary_chunk(b"tEXt", b"Comment\x00huge"))
+        f.write(idat_length.to_bytes(4, "big") + b"IDAT")
+        f.seek(idat_length, io.SEEK_CUR)
+        f.write(b"\x00" * 4)
+        f.write(get_binary_chunk(create_iend_chunk()))
+    with CountingReader(filename, "rb") as f:
+        info = inspect_file(f)
+        bytes_read = f.bytes_read
+    # the IDAT data is skipped with seek, not read
+    assert bytes_read < 4096
+    assert info.size > idat_length
+    assert info.ihdr[:2] == (65535, 65535)
+    assert info.texts == [(b"tEXt", b"Comment\x00huge")]
+    assert [entry.chunk_type for entry in info.chunks] == [
+        b"IHDR",
+        b"tEXt",
+        b"IDAT",
+        b"IEND",
+    ]
@@ -0,0 +1,105 @@
+"""Unit tests for the in-place patches."""
+
+import random
+from pngtools import cli
+from pngtools import (
+    CLI,
+    fix_chunk,
+    get_modified_chunks,
+    patch_file,
+    plan_patch,
+    read_file,
+    write_png,
+)
+from pngtools.lib import get_data_of_chunk, get_type_of_chunk, new_chunk
+from pngtools.patch import _changed_range
+
+
+def _damaged_copy(tmp_path):
+    """Write a copy of a file with a wrong CRC on its first IDAT chunk"""
+    chunks = read_file("tests/511-200x300.png")
+    index = [get_type_of_chunk(c) for c in chunks].index(b"IDAT")
+    length, chunk_type, data, _, errors = chunks[index]
+    chunks[index] = new_chunk(length, chunk_type, data, b"\x00" * 4, errors)
+    filename = str(tmp_path / "damaged.png")
+    write_png(chunks, filename)
+    return filename, index
+
+
+def test_patch_in_place(tmp_path):
+    """Test fixing a CRC by writing only the CRC."""
+    filename, index = _damaged_copy(tmp_path)
+    original = read_file(filename)
+    edited = list(original)
+    edited[index] = fix_chunk(edited[index])
+    assert get_modified_chunks(original, edited) == [index]
+    patch = patch_file(filename, original, edited)
+    assert patch.in_place
+    assert patch.bytes_written == 4
+    write_png(edited, str(tmp_path / "expected.png"))
+    with open(filename, "rb") as fp, open(tmp_path / "expected.png", "rb") as fp2:
+        assert fp.read() == fp2.read()
+
+
+def test_patch_rewrite(tmp_path):
+    """Test rewriting the chunks from the first chunk changing its size."""
+    filename, index = _damaged_copy(tmp_path)
+    original = read_file(filename)
+    # a longer chunk after the IDAT chunks: the chunks before are not written
+    edited = list(original)
+    last = len(edited) - 2
+    data = get_data_of_chunk(edited[last]) + b"more data"
+    edited[last] = fix_chunk(new_chunk(len(data), b"tEXt", data, b"", []))
+    patch = patch_file(filename, original, edited)
+    assert not patch.in_place
+    assert len(patch.writes) == 2
+    assert patch.bytes_written == 12 + len(data) + 12
+    write_png(edited, str(tmp_path / "expected.png"))
+    with open(filename, "rb") as fp, open(tmp_path / "expected.png", "rb") as fp2:
+        assert fp.read() == fp2.read()
+
+    # removing the last chunk truncates the file
+    shorter = edited[:-1]
+    patch = plan_patch(edited, shorter)
+    assert patch.writes == []
+    assert patch_file(filename, edited, shorter).size == patch.size
+    assert read_file(filename) == shorter
+
+
+def test_patch_other_layout(tmp_path):
+    """Test writing the whole file when it has trailing data."""
+    filename, index = _damaged_copy(tmp_path)
+    with open(filename, "ab") as fp:
+        fp.write(b"trailing data")
+    original = read_file(filename)
+    edited = list(original)
+    edited[index] = fix_chunk(edited[index])
+    assert patch_file(filename, original, edited) is None
+    assert read_file(filename) == edited
+
+
+def test_changed_range():
+    """Test finding the modified bytes of data."""
+    rand = random.Random(3)
+    old = bytes(rand.getrandbits(8) for _ in range(300000))
+    new = bytearray(old)
+    new[70000] ^= 1
+    new[200001] ^= 1
+    assert _changed_range(old, bytes(new)) == (70000, 200002)
+    assert _changed_range(b"abc", b"abd") == (2, 3)
+    assert _changed_range(b"abc", b"abc") is None
+
+
+def test_cli_patch_after_repair(tmp_path, capsys, monkeypatch):
+    """The chunks of another source are never patched in the file read."""
+    monkeypatch.setattr(cli, "PATH_HISTORY", str(tmp_path / "history.dat"))
+    write_png(read_file("tests/511-200x300.png"), str(tmp_path / "a.png"))
+    _damaged_copy(tmp_path)
+    before = (tmp_path / "a.png").read_bytes()
+    shell = CLI()
+    shell.onecmd(f"read_file {tmp_path / 'a.png'}")
+    shell.onecmd(f"repair_file {tmp_path / 'damaged.png'}")
+    capsys.readouterr()
+    shell.onecmd("patch_png")
+    assert "not read as is from a file" in capsys.readouterr().out
+    assert (tmp_path / "a.png").read_bytes() == before
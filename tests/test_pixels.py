@@ -0,0 +1,94 @@
+"""Unit tests for the pixel buffers."""
+
+import random
+import pytest
+from PIL import Image
+from pngtools import (
+    PixelBuffer,
+    decode_pixels,
+    extract_data,
+    parse_idat,
+    read_file,
+)
+
+
+def _decode_file(filename):
+    """Decode a file into a pixel buffer"""
+    chunks = read_file(filename)
+    with Image.open(filename) as img:
+        width, height = img.size
+        bit_depth = 16 if img.mode.startswith("I;16") else 8
+        color_type = {"RGB": 2, "RGBA": 6, "L": 0, "LA": 4}.get(img.mode, 0)
+    return decode_pixels(extract_data(chunks), width, height, bit_depth, color_type)
+
+
+def _create_png(filename, mode, width=13, height=7):
+    """Create a noisy PNG file with PIL and return the image"""
+    rnd = random.Random(1)
+    size = width * height * len(mode)
+    img = Image.frombytes(
+        mode, (width, height), bytes(rnd.getrandbits(8) for _ in range(size))
+    )
+    img.save(filename)
+    return img
+
+
+def test_pixel_buffer(tmp_path):
+    """Test that the pixel buffer is the result of parse_idat."""
+    for mode, color_type in [("RGB", 2), ("RGBA", 6), ("L", 0), ("LA", 4)]:
+        filename = str(tmp_path / f"{mode}.png")
+        img = _create_png(filename, mode)
+        pixels = _decode_file(filename)
+        assert isinstance(pixels, bytearray)
+        assert pixels.shape == (7, 13, len(mode))
+        assert pixels.color_type == color_type
+        assert pixels == img.tobytes()
+        assert pixels == parse_idat(
+            extract_data(read_file(filename)), 13, 7, 8, color_type
+        )
+        # buffer protocol
+        assert memoryview(pixels).nbytes == 13 * 7 * len(mode)
+        # array interface and shared memory
+        pil_img = pixels.as_pil()
+        assert pil_img.tobytes() == img.tobytes()
+        if len(mode) > 1:
+            # Pillow expects a 2D array for one channel
+            assert Image.fromarray(pixels).tobytes() == img.tobytes()
+        if mode in ("L", "RGBA"):
+            # memory shared with Pillow
+            pixels[0] ^= 0xFF
+            assert pil_img.tobytes()[0] == pixels[0]
+
+
+def test_pixel_buffer_16_bit(tmp_path):
+    """Test decoding 16-bit images."""
+    img = Image.frombytes("I;16", (5, 3), bytes(range(30)))
+    img.save(tmp_path / "gray16.png")
+    with Image.open(tmp_path / "gray16.png") as saved:
+        assert saved.mode.startswith("I;16")
+    pixels = _decode_file(str(tmp_path / "gray16.png"))
+    assert pixels.bit_depth == 16
+    assert pixels.__array_interface__["typestr"] == ">u2"
+    # PNG samples are big-endian
+    assert pixels == bytes(b for i in range(0, 30, 2) for b in (i + 1, i))
+
+
+def test_as_numpy(tmp_path):
+    """Test the NumPy arrays sharing the memory of the buffer."""
+    numpy = pytest.importorskip("numpy")
+    filename = str(tmp_path / "image.png")
+    img = _create_png(filename, "RGBA")
+    pixels = _decode_file(filename)
+    array = pixels.as_numpy()
+    assert array.shape == (7, 13, 4)
+    assert array.dtype == numpy.uint8
+    assert (array == numpy.asarray(img)).all()
+    array[1, 2, 3] = 42
+    assert pixels[(1 * 13 + 2) * 4 + 3] == 42
+    with pytest.raises(BufferError):
+        pixels.append(0)
+    del array
+    pixels16 = PixelBuffer(bytes(range(12)), 1, 2, 16, 2)
+    array = pixels16.as_numpy()
+    assert array.shape == (2, 1, 3)
+    assert array[1, 0, 0] == 6 * 256 + 7
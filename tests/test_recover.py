@@ -0,0 +1,71 @@
+"""Unit tests for the recovery of the IHDR fields."""
+
+import random
+import zlib
+from PIL import Image
+from pngtools import (
+    extract_idat,
+    infer_dimensions,
+    read_file,
+    recover_ihdr,
+    recover_ihdr_of_chunks,
+)
+from pngtools.lib import get_crc_of_chunk, get_data_of_chunk, new_chunk
+from pngtools.recover import create_ihdr_from_fields
+
+
+def _zero_dimensions(one_chunk):
+    """Set the width and height of an IHDR chunk to 0, keeping its CRC"""
+    data = bytes(8) + get_data_of_chunk(one_chunk)[8:]
+    return new_chunk(13, b"IHDR", data, get_crc_of_chunk(one_chunk), [])
+
+
+def test_recover_dimensions():
+    """Test finding the width and height from the CRC."""
+    chunks = read_file("tests/511-200x300.png")
+    damaged = _zero_dimensions(chunks[0])
+    candidates = recover_ihdr(get_data_of_chunk(damaged), get_crc_of_chunk(damaged))
+    assert (200, 300, 8, 2, 0, 0, 0) in candidates
+    # the length of the image data removes the wrong candidates
+    candidates = recover_ihdr(
+        get_data_of_chunk(damaged),
+        get_crc_of_chunk(damaged),
+        decompressed_length=(200 * 3 + 1) * 300,
+    )
+    assert candidates == [(200, 300, 8, 2, 0, 0, 0)]
+    assert create_ihdr_from_fields(candidates[0]) == chunks[0]
+
+
+def test_recover_all_fields(tmp_path):
+    """Test finding all the IHDR fields from the CRC and the IDAT data."""
+    img = Image.frombytes("LA", (37, 21), bytes(range(256)) * 6 + bytes(18))
+    img.save(tmp_path / "image.png")
+    chunks = read_file(str(tmp_path / "image.png"))
+    damaged = new_chunk(13, b"IHDR", bytes(13), get_crc_of_chunk(chunks[0]), [])
+    index, candidates = recover_ihdr_of_chunks(
+        [damaged] + chunks[1:], search_fields=True
+    )
+    assert index == 0
+    assert candidates == [(37, 21, 8, 4, 0, 0, 0)]
+
+
+def test_infer_dimensions(tmp_path):
+    """Test inferring the dimensions from the end of the scanlines."""
+    rand = random.Random(7)
+    width, height = 301, 120
+    # gradients with some noise, like a photo
+    pixels = bytearray(
+        (x + y + rand.getrandbits(2)) % 256
+        for y in range(height)
+        for x in range(width * 3)
+    )
+    Image.frombytes("RGB", (width, height), bytes(pixels)).save(tmp_path / "image.png")
+    chunks = read_file(str(tmp_path / "image.png"))
+    scanlines = zlib.decompress(b"".join(extract_idat(chunks)))
+    assert infer_dimensions(scanlines, 8, 2) == (width, height)
+    # only the end of the image, starting in the middle of a scanline
+    assert infer_dimensions(scanlines[-50 * (width * 3 + 1) - 7 :], 8, 2) == (
+        width,
+        51,
+    )
+    assert infer_dimensions(b"\xff" * 1000, 8, 2) is None
@@ -0,0 +1,132 @@
+"""Unit tests for the repair of corrupted chunk streams."""
+
+from types import SimpleNamespace
+import zlib
+from PIL import Image, PngImagePlugin
+from pngtools import (
+    ERROR_CODE,
+    PNG_MAGIC,
+    extract_data,
+    get_errors_of_chunk,
+    get_type_of_chunk,
+    read_file,
+    repair_chunks,
+)
+from pngtools import repair
+from pngtools.lib import get_binary_chunk
+
+
+def _create_chunks(tmp_path):
+    """Create a file with a text chunk and several IDAT chunks"""
+    pixels = bytes((x * 5 + y) & 0xFF for y in range(64) for x in range(64 * 3))
+    img = Image.frombytes("RGB", (64, 64), pixels)
+    info = PngImagePlugin.PngInfo()
+    info.add_text("Comment", "repair me")
+    img.save(tmp_path / "image.png", pnginfo=info)
+    chunks = read_file(str(tmp_path / "image.png"))
+    # split the IDAT data into 4 chunks
+    idat = [c for c in chunks if get_type_of_chunk(c) == b"IDAT"][0]
+    data = idat[2]
+    step = len(data) // 4 + 1
+    parts = [data[i : i + step] for i in range(0, len(data), step)]
+    others = [c for c in chunks if get_type_of_chunk(c) != b"IDAT"]
+    binary = [get_binary_chunk(c) for c in others[:-1]]
+    for part in parts:
+        crc = zlib.crc32(b"IDAT" + part).to_bytes(4, byteorder="big")
+        binary.append(len(part).to_bytes(4, byteorder="big") + b"IDAT" + part + crc)
+    binary.append(get_binary_chunk(others[-1]))
+    return binary, extract_data(chunks)
+
+
+def test_repair_valid_file(tmp_path):
+    """Test that a valid file is not changed."""
+    binary, pixels = _create_chunks(tmp_path)
+    chunks, repairs = repair_chunks(PNG_MAGIC + b"".join(binary) + b"trailing data")
+    assert repairs == []
+    assert [get_binary_chunk(c) for c in chunks] == binary
+    assert extract_data(chunks) == pixels
+
+
+def test_repair_wrong_length(tmp_path):
+    """Test resynchronizing after a chunk with a wrong length."""
+    binary, pixels = _create_chunks(tmp_path)
+    for length in [b"\x00\x00\x00\x00", b"\xff\xff\xff\xff", b"\x00\x00\x00\x10"]:
+        damaged = list(binary)
+        damaged[4] = length + damaged[4][4:]
+        chunks, repairs = repair_chunks(PNG_MAGIC + b"".join(damaged))
+        assert len(repairs) == 1
+        assert repairs[0].chunk_type == b"IDAT"
+        assert repairs[0].crc_ok
+        assert [get_binary_chunk(c) for c in chunks] == binary
+        assert extract_data(chunks) == pixels
+
+
+def test_repair_wrong_type(tmp_path):
+    """Test recovering the type of a chunk from its CRC."""
+    binary, pixels = _create_chunks(tmp_path)
+    damaged = list(binary)
+    # tEXt chunk, then IDAT chunks
+    assert damaged[1][4:8] == b"tEXt"
+    assert damaged[3][4:8] == b"IDAT"
+    damaged[1] = damaged[1][:4] + b"t\x00Xt" + damaged[1][8:]
+    damaged[3] = damaged[3][:4] + b"\x00\x00\x00\x00" + damaged[3][8:]
+    chunks, repairs = repair_chunks(PNG_MAGIC + b"".join(damaged))
+    assert [(r.chunk_type, r.crc_ok) for r in repairs] == [
+        (b"tEXt", True),
+        (b"IDAT", True),
+    ]
+    assert [get_binary_chunk(c) for c in chunks] == binary
+    assert extract_data(chunks) == pixels
+
+
+def test_repair_wrong_crc(tmp_path):
+    """Test that a chunk with damaged data is kept with its error."""
+    binary, _ = _create_chunks(tmp_path)
+    damaged = list(binary)
+    damaged[3] = damaged[3][:20] + b"\x00" + damaged[3][21:]
+    chunks, repairs = repair_chunks(PNG_MAGIC + b"".join(damaged))
+    assert repairs == []
+    assert len(chunks) == len(binary)
+    assert ERROR_CODE["WRONG_CRC"] in get_errors_of_chunk(chunks[3])
+
+
+def test_repair_garbage(tmp_path, monkeypatch):
+    """Test dropping garbage between chunks, in linear time."""
+    binary, pixels = _create_chunks(tmp_path)
+    garbage = b"\x12\x34" * 1000000
+    data = PNG_MAGIC + b"".join(binary[:2] + [garbage] + binary[2:])
+    crc_bytes = []
+
+    def crc32(data, value=0):
+        crc_bytes.append(len(data))
+        return zlib.crc32(data, value)
+
+    monkeypatch.setattr(repair, "zlib", SimpleNamespace(crc32=crc32))
+    chunks, repairs = repair_chunks(data)
+    assert sum(crc_bytes) < 3 * len(data)
+    assert len(repairs) == 1
+    assert repairs[0].chunk_type is None
+    assert repairs[0].length == len(garbage)
+    assert extract_data(chunks) == pixels
+
+
+def test_repair_fake_headers(tmp_path, monkeypatch):
+    """Garbage made of fake headers whose lengths land on other fake headers
+    is searched in linear time: the CRCs cover a bounded number of bytes."""
+    binary, pixels = _create_chunks(tmp_path)
+    # length + 12 is a multiple of the size of the pattern
+    garbage = b"garbage!" + b"\x00\x0f\xff\xf4IDAT" * 500000
+    data = PNG_MAGIC + b"".join(binary[:2] + [garbage] + binary[2:])
+    crc_bytes = []
+
+    def crc32(data, value=0):
+        crc_bytes.append(len(data))
+        return zlib.crc32(data, value)
+
+    monkeypatch.setattr(repair, "zlib", SimpleNamespace(crc32=crc32))
+    chunks, repairs = repair_chunks(data)
+    assert sum(crc_bytes) < 3 * len(data)
+    assert len(repairs) == 1
+    assert repairs[0].chunk_type is None
+    assert repairs[0].length == len(garbage)
+    assert extract_data(chunks) == pixels
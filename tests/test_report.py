@@ -0,0 +1,80 @@
+"""Unit tests for the NDJSON reports."""
+
+import io
+import json
+from pngtools import (
+    inspect_file,
+    iter_chunk_records,
+    iter_file_records,
+    iter_records,
+    read_file,
+    write_records,
+)
+
+
+def test_file_records():
+    """Test the records of a file."""
+    records = list(iter_file_records("tests/acropalypse.png"))
+    file_record = records[0]
+    assert file_record["record"] == "file"
+    assert file_record["signatures"] == [0]
+    assert file_record["ihdr"]["width"] == 1298
+    assert file_record["ihdr"]["color_type"] == 6
+    assert file_record["phys"] == {
+        "x_pixels_per_unit": 3779,
+        "y_pixels_per_unit": 3779,
+        "unit_specifier": 1,
+    }
+    assert file_record["acropalypse"]["flagged"]
+    assert file_record["acropalypse"]["iend_end"] == 162168
+    # the metadata read from the chunk table, as read by inspect_file
+    info = inspect_file("tests/511-200x300.png")
+    other_record = next(iter_file_records("tests/511-200x300.png"))
+    assert other_record["texts"] == len(info.texts) == 11
+    assert other_record["phys"]["x_pixels_per_unit"] == info.phys[0]
+    chunk_records = records[1:]
+    assert len(chunk_records) == file_record["chunks"]
+    assert [r["type"] for r in chunk_records[:5]] == [
+        "IHDR",
+        "sRGB",
+        "gAMA",
+        "pHYs",
+        "IDAT",
+    ]
+    assert chunk_records[0]["offset"] == 8
+    # the data after IEND is not reported as chunks
+    assert chunk_records[-1]["type"] == "IEND"
+    assert chunk_records[-1]["offset"] + 12 == file_record["acropalypse"]["iend_end"]
+    assert file_record["errors"] == 0
+
+
+def test_chunk_records():
+    """Test the records of chunks read in memory."""
+    chunks = read_file("tests/511-200x300.png")
+    records = list(iter_chunk_records(chunks, "511-200x300.png"))
+    assert len(records) == len(chunks)
+    assert records[0]["type"] == "IHDR"
+    assert records[0]["length"] == 13
+    assert records[0]["crc_ok"]
+    assert records[0]["errors"] == []
+    assert records[-1]["type"] == "IEND"
+
+
+def test_write_records(tmp_path):
+    """Test writing the records of files as NDJSON."""
+    (tmp_path / "broken.png").write_bytes(b"not a PNG")
+    output = io.StringIO()
+    count = write_records(
+        iter_records(["tests/511-200x300.png", str(tmp_path)]), output
+    )
+    lines = output.getvalue().splitlines()
+    assert len(lines) == count
+    records = [json.loads(line) for line in lines]
+    files = [r for r in records if r["record"] == "file"]
+    assert [r["file"] for r in files] == [
+        "tests/511-200x300.png",
+        str(tmp_path / "broken.png"),
+    ]
+    assert files[0]["acropalypse"]["flagged"] is False
+    assert files[1]["error"] == "File is not a PNG"
+    assert files[1]["signatures"] == []
@@ -0,0 +1,83 @@
+"""Unit tests for the acropalypse scan."""
+
+import shutil
+from pngtools import (
+    ERROR_CODE,
+    check_acropalypse,
+    extract_sub_chunks,
+    get_errors_of_chunk,
+    read_file,
+    reconstruct_acropalypse,
+    scan_acropalypse,
+)
+from pngtools.scan import get_trailing_chunks
+
+
+def test_check_acropalypse():
+    """Test the detection of the data after IEND."""
+    check = check_acropalypse("tests/acropalypse.png")
+    assert check.flagged
+    assert check.iend_end == 162168
+    assert check.trailing == 581420 - 162168
+    assert check.ends_with_iend
+    # the headers, then the start and the end of the trailing data
+    assert check.bytes_read < 200 * 1024
+
+    check = check_acropalypse("tests/511-200x300.png")
+    assert not check.flagged
+    assert check.trailing == 0
+    assert check.bytes_read < 1024
+
+    # a PNG file after another one
+    check = check_acropalypse("tests/double_png.png")
+    assert check.appended_png
+    assert not check.flagged
+
+
+def test_scan_directory(tmp_path):
+    """Test scanning the files of a directory in parallel."""
+    for name in ["acropalypse.png", "511-200x300.png", "double_png.png"]:
+        shutil.copy(f"tests/{name}", tmp_path / name)
+    (tmp_path / "notes.txt").write_text("not a PNG")
+    (tmp_path / "broken.png").write_bytes(b"not a PNG")
+    # a dangling link does not stop the scan
+    (tmp_path / "dangling.png").symlink_to(tmp_path / "missing.png")
+    checks = scan_acropalypse([str(tmp_path)], workers=2)
+    assert len(checks) == 5
+    flagged = [check.filename for check in checks if check.flagged]
+    assert flagged == [str(tmp_path / "acropalypse.png")]
+    errors = [check.filename for check in checks if check.error is not None]
+    assert errors == [str(tmp_path / "dangling.png")]
+
+
+def test_trailing_chunks():
+    """Test splitting the trailing data in IDAT pieces."""
+    check = check_acropalypse("tests/acropalypse.png")
+    with open("tests/acropalypse.png", "rb") as fp:
+        trailing = fp.read()[check.iend_end :]
+    chunks = get_trailing_chunks(trailing)
+    # same IDAT chunks as with the sub chunks of the damaged chunk
+    damaged = [
+        chunk
+        for chunk in read_file("tests/acropalypse.png")
+        if ERROR_CODE["WRONG_CRC"] in get_errors_of_chunk(chunk)
+    ]
+    sub_chunks = extract_sub_chunks(damaged[0])
+    assert [c[2] for c in chunks[1:]] == [c[2] for c in sub_chunks[1:]]
+    # the first piece is without the CRC and the length of the next chunk
+    assert chunks[0][2] == sub_chunks[0][2][:-8]
+    assert reconstruct_acropalypse("tests/511-200x300.png", 200, 300)[2] is None
+
+
+def test_reconstruct_acropalypse():
+    """Test reconstructing the image from the trailing data only."""
+    width, height, data = reconstruct_acropalypse("tests/acropalypse.png", 1920, 1080)
+    assert (width, height) == (1920, 1080)
+    assert len(data) == 1920 * 1080 * 4
+
+    # the dimensions are inferred from the recovered scanlines
+    width, height, inferred = reconstruct_acropalypse("tests/acropalypse.png")
+    assert width == 1920
+    # the recovered rows at the bottom of the image
+    assert height == 757
+    assert inferred == data[-len(inferred) :]
@@ -0,0 +1,161 @@
+"""Unit tests for the HTTP analysis service."""
+
+import base64
+import http.client
+import io
+import json
+import struct
+import threading
+import time
+import zlib
+from PIL import Image
+from pngtools import AnalysisServer
+from pngtools.lib import PNG_MAGIC, get_binary_chunk, new_chunk
+
+
+def _start_server(**kwargs):
+    """Start a server on a free port of localhost"""
+    server = AnalysisServer(("127.0.0.1", 0), **kwargs)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def _stop_server(server):
+    server.shutdown()
+    server.server_close()
+
+
+def _post(connection, path, body):
+    connection.request("POST", path, body=body)
+    response = connection.getresponse()
+    return response.status, json.loads(response.read())
+
+
+def test_analyze():
+    """Test analyzing files on a kept-alive connection."""
+    server = _start_server(workers=1)
+    try:
+        connection = http.client.HTTPConnection("127.0.0.1", server.server_port)
+        with open("tests/511-200x300.png", "rb") as fp:
+            png = fp.read()
+        status, analysis = _post(connection, "/analyze", png)
+        assert status == 200
+        assert analysis["ihdr"]["width"] == 200
+        assert analysis["chunks"][0]["type"] == "IHDR"
+        assert analysis["errors"] == 0
+        assert analysis["image"]["decompressed_length"] == (200 * 3 + 1) * 300
+        assert "decoded" not in analysis
+
+        # same connection, decoded to PPM
+        status, analysis = _post(connection, "/analyze?decode=ppm", png)
+        assert status == 200
+        assert analysis["decoded"]["format"] == "ppm"
+        ppm = base64.b64decode(analysis["decoded"]["data"])
+        with Image.open("tests/511-200x300.png") as img:
+            with Image.open(io.BytesIO(ppm)) as decoded:
+                assert decoded.tobytes() == img.convert("RGB").tobytes()
+
+        status, analysis = _post(connection, "/analyze?decode=bmp", png)
+        assert status == 200
+        bmp = base64.b64decode(analysis["decoded"]["data"])
+        assert bmp[:2] == b"BM"
+
+        status, analysis = _post(connection, "/analyze", b"not a PNG")
+        assert status == 400
+        assert analysis["error"] == "File is not a PNG"
+
+        connection.request("GET", "/metrics")
+        response = connection.getresponse()
+        assert response.status == 200
+        metrics = json.loads(response.read())
+        assert metrics["requests"] == 4
+        assert metrics["errors"] == 1
+        assert metrics["bytes_received"] == 3 * len(png) + 9
+        assert metrics["latency_p50_ms"] > 0
+        connection.close()
+    finally:
+        _stop_server(server)
+
+
+def test_body_limit():
+    """Test the request size limit."""
+    server = _start_server(workers=0, max_body_size=1000)
+    try:
+        connection = http.client.HTTPConnection("127.0.0.1", server.server_port)
+        # the response comes before the body is sent
+        connection.putrequest("POST", "/analyze")
+        connection.putheader("Content-Length", "5000")
+        connection.endheaders()
+        response = connection.getresponse()
+        assert response.status == 413
+        assert response.getheader("Connection") == "close"
+        assert "error" in json.loads(response.read())
+        connection.close()
+        connection = http.client.HTTPConnection("127.0.0.1", server.server_port)
+        status, _ = _post(connection, "/analyze?decode=gif", b"")
+        assert status == 400
+        connection.close()
+    finally:
+        _stop_server(server)
+
+
+def _wait_for_requests(server, count, timeout=5):
+    """Get the metrics once `count` requests are recorded (a handler records
+    its request after sending the response)"""
+    deadline = time.monotonic() + timeout
+    metrics = server.metrics.snapshot()
+    while metrics["requests"] < count and time.monotonic() < deadline:
+        time.sleep(0.01)
+        metrics = server.metrics.snapshot()
+    return metrics
+
+
+def _png_of_size(width, height):
+    """Small PNG file whose IHDR declares an RGBA image of any size"""
+    ihdr = struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)
+    chunks = [(b"IHDR", ihdr), (b"IDAT", zlib.compress(b"\x00" * 16)), (b"IEND", b"")]
+    return PNG_MAGIC + b"".join(
+        get_binary_chunk(
+            new_chunk(
+                len(data),
+                chunk_type,
+                data,
+                zlib.crc32(chunk_type + data).to_bytes(4, "big"),
+                [],
+            )
+        )
+        for chunk_type, data in chunks
+    )
+
+
+def test_invalid_requests():
+    """Invalid lengths and huge images are answered, and counted."""
+    server = _start_server(workers=1)
+    try:
+        connection = http.client.HTTPConnection("127.0.0.1", server.server_port)
+        png = _png_of_size(65535, 65535)
+        status, analysis = _post(connection, "/analyze", png)
+        assert status == 413
+        assert "memory limit" in analysis["error"]
+        # small dimensions but more data than the body can produce
+        status, _ = _post(connection, "/analyze", _png_of_size(4000, 4000))
+        assert status == 413
+        connection.close()
+
+        for length in ("abc", "-5"):
+            connection = http.client.HTTPConnection("127.0.0.1", server.server_port)
+            connection.putrequest("POST", "/analyze")
+            connection.putheader("Content-Length", length)
+            connection.endheaders()
+            response = connection.getresponse()
+            assert response.status == 400
+            assert response.getheader("Connection") == "close"
+            response.read()
+            connection.close()
+
+        metrics = _wait_for_requests(server, 4)
+        assert metrics["requests"] == 4
+        assert metrics["errors"] == 4
+    finally:
+        _stop_server(server)
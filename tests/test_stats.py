@@ -0,0 +1,68 @@
+"""Unit tests for the image statistics."""
+
+import random
+from PIL import Image
+from pngtools import stats_file
+
+
+def test_stats_rgb():
+    """Histograms and colors of an RGB image, compared with Pillow."""
+    stats = stats_file("tests/511-200x300.png")
+    with Image.open("tests/511-200x300.png") as img:
+        img = img.convert("RGB")
+        histogram = img.histogram()
+        colors = img.getcolors(256)
+    assert (stats.width, stats.height) == (200, 300)
+    for channel, channel_histogram in enumerate(stats.histograms):
+        assert channel_histogram == histogram[channel * 256 : (channel + 1) * 256]
+    if colors is None:
+        assert stats.unique_colors is None
+    else:
+        assert stats.unique_colors == len(colors)
+    assert stats.opaque is None
+    assert stats.binary_alpha is None
+
+
+def test_stats_palette_and_alpha(tmp_path):
+    """Few colors, opaque and binary alpha, gray pixels."""
+    rand = random.Random(0)
+    img = Image.new("RGBA", (50, 40))
+    img.putdata(
+        [
+            (value, value, value, 255)
+            for value in (rand.randrange(4) * 60 for _ in range(2000))
+        ]
+    )
+    img.save(tmp_path / "opaque.png")
+    stats = stats_file(str(tmp_path / "opaque.png"))
+    assert stats.unique_colors == len(img.getcolors(256))
+    assert stats.opaque is True
+    assert stats.binary_alpha is True
+    assert stats.gray is True
+    assert stats.histograms[3][255] == 40 * 50
+
+    img.putpixel((0, 0), (1, 2, 3, 0))
+    img.save(tmp_path / "binary.png")
+    stats = stats_file(str(tmp_path / "binary.png"))
+    assert stats.unique_colors == len(img.getcolors(256))
+    assert stats.opaque is False
+    assert stats.binary_alpha is True
+    assert stats.gray is False
+
+    img.putpixel((1, 0), (0, 0, 0, 128))
+    img.save(tmp_path / "alpha.png")
+    stats = stats_file(str(tmp_path / "alpha.png"), max_colors=5)
+    assert stats.unique_colors is None
+    assert stats.binary_alpha is False
+
+
+def test_stats_16_bit(tmp_path):
+    """16-bit samples: histogram of the high byte, colors of both bytes."""
+    img = Image.new("I;16", (10, 10), 65535)
+    img.putpixel((0, 0), 0xFF00)
+    img.save(tmp_path / "gray16.png")
+    stats = stats_file(str(tmp_path / "gray16.png"))
+    assert stats.bit_depth == 16
+    assert stats.unique_colors == 2
+    assert stats.histograms[0][255] == 100
+    assert stats.gray is None
@@ -0,0 +1,68 @@
+"""Unit tests for the text chunks."""
+
+from os import utime
+from PIL import Image, PngImagePlugin
+from pngtools import (
+    TextIndex,
+    build_text_index,
+    get_text_chunks,
+    read_file,
+)
+
+
+def _create_png_with_texts(filename, texts):
+    """Create a small PNG file with a tEXt, a zTXt and an iTXt chunk"""
+    info = PngImagePlugin.PngInfo()
+    info.add_text("Title", texts[0])
+    info.add_text("Comment", texts[1], zip=True)
+    info.add_itxt("Description", texts[2], lang="fr", tkey="Légende", zip=True)
+    Image.new("RGB", (4, 4)).save(filename, pnginfo=info)
+
+
+def test_text_chunks():
+    """Test decoding the text chunks of a file."""
+    texts = get_text_chunks(read_file("tests/511-200x300.png"))
+    assert len(texts) == 11
+    assert all(text.chunk_type == b"tEXt" for text in texts)
+    assert texts[0].keyword == "date:create"
+
+
+def test_compressed_text_chunks(tmp_path):
+    """Test that compressed values are only inflated when read."""
+    filename = str(tmp_path / "texts.png")
+    _create_png_with_texts(filename, ["title", "comment " * 100, "légende ✓"])
+    texts = get_text_chunks(read_file(filename))
+    assert [(text.chunk_type, text.keyword) for text in texts] == [
+        (b"tEXt", "Title"),
+        (b"zTXt", "Comment"),
+        (b"iTXt", "Description"),
+    ]
+    ztxt, itxt = texts[1], texts[2]
+    assert ztxt.compressed and ztxt._value is None
+    assert ztxt.value == "comment " * 100
+    assert itxt.language == "fr"
+    assert itxt.translated_keyword == "Légende"
+    assert itxt.value == "légende ✓"
+
+
+def test_text_index(tmp_path):
+    """Test indexing the texts of several files."""
+    filenames = []
+    for i in range(3):
+        filename = str(tmp_path / f"image{i}.png")
+        _create_png_with_texts(filename, [f"title {i}", f"comment {i}", "same"])
+        filenames.append(filename)
+    index_file = str(tmp_path / "index.json")
+    index = build_text_index(filenames, index_file, workers=2)
+    assert len(index.search(keyword="Description")) == 3
+    assert [path for path, _, _ in index.search(contains="comment 1")] == [
+        str(tmp_path / "image1.png")
+    ]
+    assert index.keywords() == {"Title": 3, "Comment": 3, "Description": 3}
+    # unchanged files are not read again
+    index = TextIndex.load(index_file)
+    assert index.add_files(filenames, workers=2) == 0
+    _create_png_with_texts(filenames[0], ["new title", "comment", "same"])
+    utime(filenames[0], ns=(0, 0))
+    assert index.add_files(filenames, workers=2) == 1
+    assert len(index.search(keyword="Title", contains="new")) == 1
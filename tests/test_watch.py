@@ -0,0 +1,101 @@
+"""Unit tests for the incremental processing of directories."""
+
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from pngtools import WatchIndex, scan_changes, watch
+
+
+def test_scan_changes(tmp_path):
+    """Test analyzing only the new and changed files."""
+    folder = tmp_path / "drop"
+    (folder / "sub").mkdir(parents=True)
+    shutil.copy("tests/511-200x300.png", folder / "a.png")
+    shutil.copy("tests/acropalypse.png", folder / "sub" / "b.png")
+    (folder / "notes.txt").write_text("not a PNG")
+    index_path = str(tmp_path / "index.sqlite")
+
+    index = WatchIndex(index_path)
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        update = scan_changes(str(folder), index, executor)
+    analyzed = {state.path: result for state, result in update.analyzed}
+    assert sorted(analyzed) == [str(folder / "a.png"), str(folder / "sub" / "b.png")]
+    assert analyzed[str(folder / "sub" / "b.png")]["acropalypse"]["flagged"]
+    assert len(index) == 2
+
+    update = scan_changes(str(folder), index)
+    assert update.analyzed == []
+    assert update.unchanged == 2
+
+    # a changed file, a new file and a removed file
+    with open(folder / "a.png", "ab") as fp:
+        fp.write(b"trailing data")
+    shutil.copy("tests/double_png.png", folder / "c.png")
+    os.remove(folder / "sub" / "b.png")
+    update = scan_changes(str(folder), index)
+    assert sorted(state.path for state, _ in update.analyzed) == [
+        str(folder / "a.png"),
+        str(folder / "c.png"),
+    ]
+    assert update.removed == [str(folder / "sub" / "b.png")]
+    assert update.unchanged == 0
+    assert index.get_result(str(folder / "a.png"))["size"] == 112276 + 13
+    index.close()
+
+    # a restart resumes from the index
+    index = WatchIndex(index_path)
+    update = scan_changes(str(folder), index)
+    assert update.analyzed == []
+    assert update.unchanged == 2
+    index.close()
+
+
+class _RemovedEntry:
+    """Directory entry of a file removed before its stat"""
+
+    name = "removed.png"
+    path = "removed.png"
+
+    def is_dir(self, follow_symlinks=True):  # pylint: disable=unused-argument
+        return False
+
+    def is_file(self):
+        return True
+
+    def stat(self):
+        raise FileNotFoundError(self.path)
+
+
+def test_scan_errors(tmp_path, monkeypatch):
+    """Removed and unreadable files do not stop the scan, the unreadable
+    files are analyzed again and the files which are not PNG are not."""
+    folder = tmp_path / "drop"
+    folder.mkdir()
+    shutil.copy("tests/511-200x300.png", folder / "a.png")
+    (folder / "text.png").write_text("not a PNG")
+    scandir = watch.scandir
+    monkeypatch.setattr(
+        watch, "scandir", lambda path: list(scandir(path)) + [_RemovedEntry()]
+    )
+
+    def unreadable(filename):
+        raise PermissionError(filename)
+
+    monkeypatch.setattr(watch, "iter_file_records", unreadable)
+    index = WatchIndex(str(tmp_path / "index.sqlite"))
+    update = scan_changes(str(folder), index)
+    assert len(update.analyzed) == 2
+    assert all("error" in result for _, result in update.analyzed)
+    assert len(index) == 0
+    monkeypatch.undo()
+    update = scan_changes(str(folder), index)
+    analyzed = {state.path: result for state, result in update.analyzed}
+    assert "error" not in analyzed[str(folder / "a.png")]
+    assert analyzed[str(folder / "text.png")]["error"] == "File is not a PNG"
+    assert len(index) == 2
+
+    # the file which is not a PNG is not analyzed again
+    update = scan_changes(str(folder), index)
+    assert update.analyzed == []
+    assert update.unchanged == 2
+    index.close()